@@ -0,0 +1,31 @@
+# Tiny command line helper shared by the Anarchivist scripts
+#
+# Anything of the form "--name" or "--name=value" is a flag, everything else is a target (app id, username, VOD id).
+# So "python dl_steam.py --media-workers=16 440 620" has targets ['440', '620'] and flags {'media-workers': '16'}
+
+import sys
+
+def ParseArgs(argv):
+    targets = []
+    flags = {}
+    for arg in argv:
+        if arg.startswith('--'):
+            name, sep, value = arg[2:].partition('=')
+            if sep:
+                flags[name] = value
+            else:
+                flags[name] = True
+        else:
+            targets.append(arg)
+
+    return targets, flags
+
+def GetIntFlag(flags, name, default):
+    if name not in flags:
+        return default
+
+    try:
+        return int(flags[name])
+    except (TypeError, ValueError):
+        print('Flag "--%s" needs an integer value, using %d' % (name, default), file=sys.stderr)
+        return default
@@ -0,0 +1,273 @@
+# Compressed, content-addressed storage for the big raw payloads (page HTML, tweet/comment JSON)
+#
+# Payloads go into a Blobs table keyed by the sha256 of their contents, so identical payloads are only stored once,
+# and each one is compressed. The tables that used to hold the raw text keep their text column (older rows still
+# have it filled in) and get a blob column next to it holding the hash, e.g. Guides(id, pageHTML, pageBlob).
+# New rows leave the text column NULL and only fill in the blob column.
+#
+# Most of every payload of a given kind is the same boilerplate (Steam's page chrome, the keys of a tweet's JSON),
+# which individual blobs are too small to get much out of. So once a run has stored BLOB_DICT_TRAIN_SAMPLES blobs of a kind
+# without a dictionary, a shared dictionary is trained from them and stored in BlobDictionaries, and later blobs of that kind
+# are compressed against it. Blobs remember which dictionary (if any) they used, so old ones can still be read.
+#
+# Dictionaries are zstd ones if the zstandard package is installed, otherwise zlib preset dictionaries
+# (which are capped at 32KB and built by picking the substrings most of the samples have in common).
+#
+# While crawling, blobs are compressed at a fast level, so storing a page doesn't hold up the crawl. compact_blobs.py
+# uses GetBlobStore(db, archival=True), which compresses at the slow, small level instead. Compressors and decompressors
+# (with their dictionary already loaded) are kept for each dictionary, rather than made again for every blob.
+#
+# Each database has one BlobStore, which can be used from several threads (Put/GetData take its lock), and is dropped
+# once the connection is.
+#
+# The blob store is for payloads of a few KB and up. It isn't worth it for tiny ones like chat comments: the hash and
+# the row cost about as much as compression saves, so those stay inline.
+#
+# Reading:
+#   text = ReadStoredText(db, row[0], row[1])   # for a (textColumn, blobColumn) pair
+# or in SQL, after RegisterBlobFunctions(db):
+#   SELECT COALESCE(pageHTML, blob_text(pageBlob)) FROM Guides;
+#
+# Dependencies:
+#  - Python 3
+#  - zstandard (optional, https://pypi.org/project/zstandard/)
+
+import re
+import time
+import zlib
+import hashlib
+import weakref
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Levels used while crawling, and by compact_blobs.py
+BLOB_COMPRESSION_LEVEL = 6
+BLOB_ZSTD_LEVEL = 3
+BLOB_ARCHIVAL_COMPRESSION_LEVEL = 9
+BLOB_ARCHIVAL_ZSTD_LEVEL = 19
+
+# How many blobs of a kind to collect before training a dictionary for it, and how big the dictionary can be
+BLOB_DICT_TRAIN_SAMPLES = 256
+BLOB_ZSTD_DICT_SIZE = 112 * 1024
+BLOB_ZLIB_DICT_SIZE = 32 * 1024
+
+# Pieces shorter than this aren't worth putting in a zlib dictionary
+BLOB_ZLIB_DICT_MIN_PIECE = 8
+
+def CreateBlobTables(db):
+    # WITHOUT ROWID so the hash is only stored once: for small payloads like chat comments it's a good chunk of the row
+    db.execute('CREATE TABLE IF NOT EXISTS Blobs(hash VARCHAR(64) PRIMARY KEY, kind VARCHAR(255), codec VARCHAR(16), dictID INTEGER, rawSize INTEGER, data BLOB) WITHOUT ROWID;')
+    db.execute('CREATE TABLE IF NOT EXISTS BlobDictionaries(id INTEGER PRIMARY KEY AUTOINCREMENT, kind VARCHAR(255), codec VARCHAR(16), data BLOB, createdAt INTEGER);')
+    db.commit()
+
+# For databases created before the blob column was part of the table
+def AddBlobColumn(db, table, column):
+    columns = [row[1] for row in db.execute('PRAGMA table_info(%s);' % table)]
+    if column not in columns:
+        db.execute('ALTER TABLE %s ADD COLUMN %s VARCHAR(64);' % (table, column))
+        db.commit()
+
+def RegisterBlobFunctions(db):
+    db.create_function('blob_text', 1, lambda blobHash: GetBlobText(db, blobHash))
+
+def GetDefaultBlobCodec():
+    if zstandard is not None:
+        return 'zstd'
+    return 'zlib'
+
+# Picks the substrings (split at tag/JSON boundaries) that show up in the most samples, most useful last,
+# since zlib can reach the end of the dictionary most cheaply
+def TrainZlibDictionary(samples, maxSize=BLOB_ZLIB_DICT_SIZE):
+    pieceCounts = {}
+    for sample in samples:
+        pieces = set(re.split(rb'(?<=[>\n,{}\]])', sample))
+        for piece in pieces:
+            if len(piece) >= BLOB_ZLIB_DICT_MIN_PIECE:
+                pieceCounts[piece] = pieceCounts.get(piece, 0) + 1
+
+    common = [(count * len(piece), piece) for piece, count in pieceCounts.items() if count > 1]
+    common.sort(reverse=True)
+
+    chosen = []
+    size = 0
+    for score, piece in common:
+        if size + len(piece) > maxSize:
+            continue
+        chosen.append(piece)
+        size += len(piece)
+
+    chosen.reverse()
+    return b''.join(chosen)
+
+def TrainDictionary(codec, samples):
+    if codec == 'zstd':
+        try:
+            return zstandard.train_dictionary(BLOB_ZSTD_DICT_SIZE, samples).as_bytes()
+        except zstandard.ZstdError:
+            # Too few/too small samples
+            return None
+    else:
+        data = TrainZlibDictionary(samples)
+        return data if len(data) > 0 else None
+
+# Returns a function that compresses one blob. zlib objects can't be reused once they're flushed, so this keeps one
+# with the dictionary already loaded and copies it for each blob
+def MakeCompressor(codec, dictData, archival):
+    if codec == 'zstd':
+        level = BLOB_ARCHIVAL_ZSTD_LEVEL if archival else BLOB_ZSTD_LEVEL
+        if dictData is not None:
+            compressor = zstandard.ZstdCompressor(level=level, dict_data=zstandard.ZstdCompressionDict(dictData))
+        else:
+            compressor = zstandard.ZstdCompressor(level=level)
+        return compressor.compress
+    else:
+        level = BLOB_ARCHIVAL_COMPRESSION_LEVEL if archival else BLOB_COMPRESSION_LEVEL
+        if dictData is not None:
+            primed = zlib.compressobj(level, zdict=dictData)
+        else:
+            primed = zlib.compressobj(level)
+        def Compress(data):
+            compressor = primed.copy()
+            return compressor.compress(data) + compressor.flush()
+        return Compress
+
+def MakeDecompressor(codec, dictData):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise Exception('This blob is zstd compressed, the zstandard package needs to be installed to read it')
+        if dictData is not None:
+            decompressor = zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(dictData))
+        else:
+            decompressor = zstandard.ZstdDecompressor()
+        return decompressor.decompress
+    elif codec == 'zlib':
+        if dictData is not None:
+            primed = zlib.decompressobj(zdict=dictData)
+        else:
+            primed = zlib.decompressobj()
+        def Decompress(data):
+            decompressor = primed.copy()
+            return decompressor.decompress(data) + decompressor.flush()
+        return Decompress
+    else:
+        return lambda data: data
+
+# Per-database state: dictionaries we've loaded, and the current dictionary/training samples for each kind
+class BlobStore:
+    def __init__(self, db, archival=False):
+        # A proxy, so the store doesn't keep the connection alive (see blobStores)
+        self.db = weakref.proxy(db)
+        self.codec = GetDefaultBlobCodec()
+        self.archival = archival
+        self.lock = threading.RLock()
+        self.dictionaries = {}
+        self.currentDictIDs = {}
+        self.trainingSamples = {}
+        # dictID -> compress function (for our codec), (codec, dictID) -> decompress function
+        self.compressors = {}
+        self.decompressors = {}
+
+    def GetDictionary(self, dictID):
+        if dictID is None:
+            return None
+        if dictID not in self.dictionaries:
+            row = self.db.execute('SELECT data FROM BlobDictionaries WHERE id = ?;', (dictID,)).fetchone()
+            self.dictionaries[dictID] = row[0] if row is not None else None
+        return self.dictionaries[dictID]
+
+    def GetCurrentDictID(self, kind):
+        if kind not in self.currentDictIDs:
+            row = self.db.execute('SELECT id FROM BlobDictionaries WHERE kind = ? AND codec = ? ORDER BY createdAt DESC LIMIT 1;', (kind, self.codec)).fetchone()
+            self.currentDictIDs[kind] = row[0] if row is not None else None
+        return self.currentDictIDs[kind]
+
+    def TrainKind(self, kind, samples):
+        dictData = TrainDictionary(self.codec, samples)
+        if dictData is None:
+            return None
+
+        # The id comes from the dictionary's contents rather than lastrowid, so this works through a DBWriter too
+        dictID = int(hashlib.sha256(dictData).hexdigest()[:15], 16)
+        self.db.execute('INSERT OR IGNORE INTO BlobDictionaries(id, kind, codec, data, createdAt) VALUES(?,?,?,?,?);', (dictID, kind, self.codec, dictData, int(time.time())))
+        self.dictionaries[dictID] = dictData
+        self.currentDictIDs[kind] = dictID
+        print('Trained a %d byte %s dictionary for "%s" blobs from %d samples' % (len(dictData), self.codec, kind, len(samples)))
+        return dictID
+
+    def MaybeTrain(self, kind, data):
+        samples = self.trainingSamples.setdefault(kind, [])
+        samples.append(data)
+        if len(samples) < BLOB_DICT_TRAIN_SAMPLES:
+            return
+
+        # If it doesn't work out, try again once there's a new batch to go on
+        self.trainingSamples[kind] = []
+        self.TrainKind(kind, samples)
+
+    def GetCompressor(self, dictID):
+        if dictID not in self.compressors:
+            self.compressors[dictID] = MakeCompressor(self.codec, self.GetDictionary(dictID), self.archival)
+        return self.compressors[dictID]
+
+    def GetDecompressor(self, codec, dictID):
+        key = (codec, dictID)
+        if key not in self.decompressors:
+            self.decompressors[key] = MakeDecompressor(codec, self.GetDictionary(dictID))
+        return self.decompressors[key]
+
+    def Put(self, kind, data):
+        blobHash = hashlib.sha256(data).hexdigest()
+        if self.db.execute('SELECT 1 FROM Blobs WHERE hash = ?;', (blobHash,)).fetchone() is not None:
+            return blobHash
+
+        with self.lock:
+            dictID = self.GetCurrentDictID(kind)
+            compressed = self.GetCompressor(dictID)(data)
+            # OR IGNORE since the same blob could still be on its way in through a DBWriter
+            self.db.execute('INSERT OR IGNORE INTO Blobs VALUES(?,?,?,?,?,?);', (blobHash, kind, self.codec, dictID, len(data), compressed))
+
+            if dictID is None:
+                self.MaybeTrain(kind, data)
+
+        return blobHash
+
+    def GetData(self, blobHash):
+        row = self.db.execute('SELECT codec, dictID, data FROM Blobs WHERE hash = ?;', (blobHash,)).fetchone()
+        if row is None:
+            return None
+        codec, dictID, data = row
+        with self.lock:
+            return self.GetDecompressor(codec, dictID)(data)
+
+# db -> BlobStore. Weak, so a store goes away with its connection
+blobStores = weakref.WeakKeyDictionary()
+blobStoresLock = threading.Lock()
+
+# archival only matters for the call that creates the database's store
+def GetBlobStore(db, archival=False):
+    with blobStoresLock:
+        if db not in blobStores:
+            blobStores[db] = BlobStore(db, archival)
+        return blobStores[db]
+
+# Stores the text (if it isn't already there) and returns its hash, for the blob column. Doesn't commit
+def PutBlobText(db, kind, text):
+    return GetBlobStore(db).Put(kind, text.encode('utf-8', 'surrogatepass'))
+
+def GetBlobText(db, blobHash):
+    if blobHash is None:
+        return None
+    data = GetBlobStore(db).GetData(blobHash)
+    if data is None:
+        return None
+    return data.decode('utf-8', 'surrogatepass')
+
+# Rows written before the blob store have the text inline, newer ones only have the blob hash
+def ReadStoredText(db, text, blobHash):
+    if text is not None:
+        return text
+    return GetBlobText(db, blobHash)
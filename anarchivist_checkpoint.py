@@ -0,0 +1,32 @@
+# Crawl checkpoints for the Anarchivist scripts
+#
+# Each script keeps a CrawlCheckpoints table in its database, with a row per crawl that is in progress
+# (a section of a Steam app, a Twitter user's search, a Twitch VOD) holding whatever it needs to pick up where it left off:
+# a page index, a cursor, an offset, detail pages that were found but not stored yet...
+#
+# Checkpoints are written in the same transaction as the data they describe, so after a crash the checkpoint always
+# matches what made it into the database. When a crawl finishes, its checkpoint is cleared.
+#
+# The scripts only read checkpoints back when they're run with --resume, otherwise they start from the beginning
+# (but still write checkpoints as they go, so a later --resume can use them).
+
+import json
+import time
+
+def CreateCheckpointTable(db):
+    db.execute('CREATE TABLE IF NOT EXISTS CrawlCheckpoints(name VARCHAR(255) PRIMARY KEY, state TEXT, updatedAt INTEGER);')
+    db.commit()
+
+# Doesn't commit: call it inside the transaction for the batch the checkpoint covers
+def SaveCheckpoint(db, name, state):
+    db.execute('INSERT OR REPLACE INTO CrawlCheckpoints VALUES(?,?,?);', (name, json.dumps(state), int(time.time())))
+
+def LoadCheckpoint(db, name):
+    row = db.execute('SELECT state FROM CrawlCheckpoints WHERE name = ?;', (name,)).fetchone()
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+# Doesn't commit either
+def ClearCheckpoint(db, name):
+    db.execute('DELETE FROM CrawlCheckpoints WHERE name = ?;', (name,))
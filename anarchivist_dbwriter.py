@@ -0,0 +1,334 @@
+# Database writes on a dedicated thread, in batches
+#
+# DBWriter looks enough like a sqlite3 connection that the scripts (and the shared modules) can use it as their db:
+#  - SELECTs and PRAGMAs run right away on a reader connection
+#  - INSERT/UPDATE/DELETE/REPLACE are held until the transaction they're in is committed (db.commit(), or an
+#    explicit BEGIN TRANSACTION;/COMMIT;), and then the whole transaction is handed to the writer thread as one unit.
+#    ROLLBACK drops it. Nothing is sent to sqlite before that, so a transaction left open across slow network
+#    fetches doesn't lock anyone else out of the database
+#  - Anything else (CREATE TABLE, ALTER TABLE...) waits for the queued writes and then runs on the writer thread
+#  - A WITH statement goes wherever its main verb would (WITH ... INSERT is a write)
+#
+# The writer thread collects committed units until it has DB_WRITER_BATCH_ROWS rows or DB_WRITER_FLUSH_INTERVAL
+# seconds have passed, then writes them all in one sqlite transaction, with runs of the same statement going through
+# executemany. Units are never split and are written in the order they were committed, so after a crash the database
+# has some prefix of what was committed: a checkpoint saved along with (or after) the rows it covers is still accurate.
+# For the same reason, if a unit can't be written, nothing committed after it is written either: the writer stops, and
+# the next commit(), Flush() or close() (from any thread) raises the error.
+#
+# It can be shared between threads (e.g. targets run with --parallel): each thread gets its own reader connection
+# and its own transaction, so one thread's commit or rollback doesn't touch another's writes.
+#
+# The database is put in WAL mode with synchronous=NORMAL, so readers (another script, the sqlite3 shell) aren't
+# blocked by the writer, and a commit doesn't wait on an fsync.
+#
+# Connections from OpenDatabase (which the writer thread uses too) count the rows each transaction inserts into each
+# table, and report them to anarchivist_metrics.py once the transaction is committed, when --metrics is on.
+#
+# Things to keep in mind:
+#  - Reads don't see writes that are still queued (db.Flush() waits for them if you need that)
+#  - execute() returns None for writes, so there's no rowcount/lastrowid
+#  - db.close() writes out everything committed so far. Anything committed is also written at interpreter exit,
+#    anything not committed yet is dropped, same as it would be with sqlite
+#
+# Dependencies:
+#  - Python 3
+#  - anarchivist_metrics.py and anarchivist_trace.py from this repo
+
+import re
+import sys
+import time
+import atexit
+import sqlite3
+import threading
+import traceback
+import queue
+
+import anarchivist_metrics
+from anarchivist_trace import Traced
+
+DB_WRITER_BATCH_ROWS = 2000
+DB_WRITER_FLUSH_INTERVAL = 2.0
+
+# How many committed units can be waiting before commit() starts blocking
+DB_WRITER_QUEUE_UNITS = 1024
+
+DB_TIMEOUT = 60.0
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+READ_STATEMENTS = ('SELECT', 'PRAGMA', 'EXPLAIN')
+
+INSERT_TABLE_REG = re.compile(r'\bINTO\s+["`\[]?(\w+)', re.IGNORECASE)
+
+# Counts inserted rows per table for anarchivist_metrics.py. Rows only count once they're committed
+class MetricsConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.insertedRows = {}
+
+    def CountRows(self, sql, cursor):
+        statementType = GetStatementType(sql)
+        if statementType in ('INSERT', 'REPLACE') and cursor.rowcount > 0:
+            match = INSERT_TABLE_REG.search(sql)
+            if match:
+                table = match.group(1)
+                self.insertedRows[table] = self.insertedRows.get(table, 0) + cursor.rowcount
+        elif statementType == 'ROLLBACK':
+            self.insertedRows = {}
+        if not self.in_transaction and len(self.insertedRows) > 0:
+            anarchivist_metrics.RecordRows(self.insertedRows)
+            self.insertedRows = {}
+
+    def execute(self, sql, params=()):
+        cursor = super().execute(sql, params)
+        if anarchivist_metrics.metricsEnabled:
+            self.CountRows(sql, cursor)
+        return cursor
+
+    def executemany(self, sql, paramsList):
+        cursor = super().executemany(sql, paramsList)
+        if anarchivist_metrics.metricsEnabled:
+            self.CountRows(sql, cursor)
+        return cursor
+
+    @Traced('db commit', 'db')
+    def commit(self):
+        super().commit()
+        if len(self.insertedRows) > 0:
+            anarchivist_metrics.RecordRows(self.insertedRows)
+            self.insertedRows = {}
+
+    def rollback(self):
+        super().rollback()
+        self.insertedRows = {}
+
+# For scripts that keep using a plain connection, but still want WAL
+def OpenDatabase(filename):
+    db = sqlite3.connect(filename, timeout=DB_TIMEOUT, factory=MetricsConnection)
+    db.execute('PRAGMA journal_mode=WAL;')
+    db.execute('PRAGMA synchronous=NORMAL;')
+    return db
+
+# The main verb of the statement. For "WITH ... AS (...) INSERT ..." that's the first SELECT/INSERT/UPDATE/DELETE/REPLACE
+# outside the parentheses and quotes, not WITH
+def GetStatementType(sql):
+    words = sql.lstrip().split(None, 1)
+    if len(words) == 0:
+        return ''
+    statementType = words[0].rstrip(';').upper()
+    if statementType != 'WITH':
+        return statementType
+
+    depth = 0
+    quote = None
+    topLevel = []
+    for c in sql:
+        if quote is not None:
+            if c == quote:
+                quote = None
+        elif c in '\'"`':
+            quote = c
+        elif c == '(':
+            depth += 1
+            topLevel.append(' ')
+        elif c == ')':
+            depth -= 1
+            topLevel.append(' ')
+        elif depth == 0:
+            topLevel.append(c)
+    for word in re.findall(r'[A-Za-z_]+', ''.join(topLevel)):
+        if word.upper() in READ_STATEMENTS + WRITE_STATEMENTS:
+            return word.upper()
+    return statementType
+
+# Writes queued units in one transaction, executemany'ing runs of the same statement
+@Traced('db write', 'db')
+def WriteUnits(conn, units):
+    conn.execute('BEGIN;')
+    for unit in units:
+        i = 0
+        while i < len(unit):
+            sql = unit[i][0]
+            j = i
+            while j < len(unit) and unit[j][0] == sql:
+                j += 1
+            conn.executemany(sql, [params for stmt, params in unit[i:j]])
+            i = j
+    conn.execute('COMMIT;')
+
+class DBWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        self.local = threading.local()
+        self.readers = []
+        self.readersLock = threading.Lock()
+        self.functions = []
+        self.units = queue.Queue(maxsize=DB_WRITER_QUEUE_UNITS)
+        self.closed = False
+        # Set on the writer thread if a unit couldn't be written, after which nothing else is
+        self.error = None
+        self.writtenRows = 0
+        self.writtenBatches = 0
+        self.thread = threading.Thread(target=self.WriterLoop, name='DBWriter', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    # The calling thread's reader connection and open transaction
+    def GetReader(self):
+        if not hasattr(self.local, 'reader'):
+            reader = OpenDatabase(self.filename)
+            with self.readersLock:
+                for args, kwargs in self.functions:
+                    reader.create_function(*args, **kwargs)
+                self.readers.append(reader)
+            self.local.reader = reader
+        return self.local.reader
+
+    def GetPending(self):
+        if not hasattr(self.local, 'pending'):
+            self.local.pending = []
+        return self.local.pending
+
+    # sqlite3.Connection-style interface, so this can be passed anywhere a db is
+    def execute(self, sql, params=()):
+        statementType = GetStatementType(sql)
+        if statementType in READ_STATEMENTS:
+            return self.GetReader().execute(sql, params)
+        elif statementType in WRITE_STATEMENTS:
+            self.GetPending().append((sql, params))
+        elif statementType in ('BEGIN', 'END', 'COMMIT'):
+            self.commit()
+        elif statementType == 'ROLLBACK':
+            self.rollback()
+        else:
+            self.commit()
+            self.RunNow(sql, params)
+        return None
+
+    def executemany(self, sql, paramsList):
+        for params in paramsList:
+            self.execute(sql, params)
+
+    def RaiseIfFailed(self):
+        if self.error is not None:
+            raise sqlite3.DatabaseError('Writes to "%s" stopped after one failed: %s' % (self.filename, str(self.error)))
+
+    @Traced('db commit', 'db')
+    def commit(self):
+        self.RaiseIfFailed()
+        pending = self.GetPending()
+        if len(pending) > 0:
+            self.units.put(('write', pending))
+            self.local.pending = []
+
+    def rollback(self):
+        self.local.pending = []
+
+    def create_function(self, *args, **kwargs):
+        with self.readersLock:
+            self.functions.append((args, kwargs))
+        # Readers made after this pick it up from self.functions
+        if hasattr(self.local, 'reader'):
+            self.local.reader.create_function(*args, **kwargs)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.commit()
+            self.Flush()
+        finally:
+            self.closed = True
+            self.units.put(('stop', None))
+            self.thread.join()
+            with self.readersLock:
+                for reader in self.readers:
+                    try:
+                        reader.close()
+                    except sqlite3.ProgrammingError:
+                        # Made on another thread
+                        pass
+            atexit.unregister(self.close)
+
+    # Runs the statement on the writer thread after everything queued before it, and waits for it
+    def RunNow(self, sql, params=()):
+        done = threading.Event()
+        result = {}
+        self.units.put(('now', (sql, params, done, result)))
+        done.wait()
+        if 'error' in result:
+            raise result['error']
+        self.RaiseIfFailed()
+
+    # Waits until everything committed so far is in the database
+    def Flush(self):
+        if not self.closed:
+            self.RunNow('SELECT 1;')
+
+    def WriteBatch(self, conn, batch):
+        if len(batch) == 0:
+            return
+        if self.error is not None:
+            print('Dropping %d writes to "%s", an earlier write failed' % (sum(len(unit) for unit in batch), self.filename), file=sys.stderr)
+            return
+        try:
+            WriteUnits(conn, batch)
+        except Exception:
+            traceback.print_exc()
+            if conn.in_transaction:
+                conn.execute('ROLLBACK;')
+            # Write them one at a time, to get everything up to the bad unit in. Nothing after it can go in, since it
+            # could be a checkpoint that counts on the bad unit being there
+            for i, unit in enumerate(batch):
+                try:
+                    WriteUnits(conn, [unit])
+                except Exception as e:
+                    if conn.in_transaction:
+                        conn.execute('ROLLBACK;')
+                    self.error = e
+                    print('Could not write %d rows to "%s": %s. Dropping them and the %d units after them' % (len(unit), self.filename, str(e), len(batch) - i - 1), file=sys.stderr)
+                    batch = batch[:i]
+                    break
+        self.writtenRows += sum(len(unit) for unit in batch)
+        self.writtenBatches += 1
+
+    def WriterLoop(self):
+        conn = OpenDatabase(self.filename)
+        conn.isolation_level = None
+
+        batch = []
+        batchRows = 0
+        batchStart = None
+        while True:
+            timeout = None
+            if batchStart is not None:
+                timeout = max(0, batchStart + DB_WRITER_FLUSH_INTERVAL - time.monotonic())
+            try:
+                kind, job = self.units.get(timeout=timeout)
+            except queue.Empty:
+                kind, job = ('flush', None)
+
+            if kind == 'write':
+                batch.append(job)
+                batchRows += len(job)
+                if batchStart is None:
+                    batchStart = time.monotonic()
+                if batchRows < DB_WRITER_BATCH_ROWS:
+                    continue
+
+            self.WriteBatch(conn, batch)
+            batch = []
+            batchRows = 0
+            batchStart = None
+
+            if kind == 'now':
+                sql, params, done, result = job
+                try:
+                    conn.execute(sql, params)
+                except Exception as e:
+                    result['error'] = e
+                done.set()
+            elif kind == 'stop':
+                break
+
+        conn.close()
@@ -0,0 +1,232 @@
+# Twitter guest tokens, shared between everything that's searching
+#
+# Getting a guest token means downloading a whole search page and picking the token out of its cookies, so instead
+# of doing that before every user (and again, after a 10 second sleep, every time a request fails) a GuestTokenPool
+# keeps a few of them around:
+#  - Acquire() hands them out in turn, so concurrent searches (--parallel) don't all lean on the same one
+#  - Cooldown(token, seconds) is for when the API rate limits a token: Acquire() hands out the others until it's rested
+#    (and waits for the first one to come off cooldown if they're all on it), and the background thread fetches
+#    another in the meantime, since a token on cooldown doesn't count towards the pool
+#  - Invalidate(token) is for when the API stops taking a token. It's dropped from the pool, and how long it lasted is
+#    remembered: the pool assumes tokens live for the median of the last few lifetimes it has seen (or
+#    GUEST_TOKEN_LIFETIME until it has seen one), and a background thread fetches a replacement for each token once
+#    it's GUEST_TOKEN_REFRESH_AT of the way through that, so a search normally never has to wait on one
+#  - The tokens and the lifetime are saved to a small JSON file, so the next run (an hourly re-sync, say) can pick
+#    them up instead of starting from nothing
+#
+# Only Acquire() ever waits on a fetch, and only when there's no usable token at all. Failed fetches back off
+# exponentially (up to GUEST_TOKEN_MAX_BACKOFF seconds) instead of retrying on a fixed sleep. Getting back a token
+# that's already in the pool counts as a failed fetch too: the site can keep handing out the same one, and it's no
+# newer than when we first got it. On top of that the background thread never fetches more often than every
+# GUEST_TOKEN_MIN_REFRESH_INTERVAL seconds, whatever the pool looks like.
+#
+# Only call Invalidate() when the API says the token is bad (see dl_twitter.py), not for any failed request: that would
+# throw away good tokens and count their lifetime as however long it was until the network hiccuped.
+#
+# Dependencies:
+#  - Python 3
+
+import os
+import sys
+import json
+import time
+import threading
+import traceback
+
+GUEST_TOKEN_POOL_SIZE = 2
+
+# How long a token is assumed to last until we've seen one expire, and the shortest we'll ever assume
+GUEST_TOKEN_LIFETIME = 3 * 60 * 60
+GUEST_TOKEN_MIN_LIFETIME = 60
+
+# How many observed lifetimes the estimate is taken from, so one token that got rejected early doesn't
+# have us refreshing every minute from then on
+GUEST_TOKEN_LIFETIME_SAMPLES = 5
+
+# Fraction of its lifetime after which a token gets replaced in the background
+GUEST_TOKEN_REFRESH_AT = 0.8
+
+GUEST_TOKEN_MAX_BACKOFF = 60.0
+
+GUEST_TOKEN_MIN_REFRESH_INTERVAL = 10.0
+
+# How long a rate limited token rests if the API doesn't say
+GUEST_TOKEN_COOLDOWN = 60.0
+
+DEFAULT_GUEST_TOKEN_CACHE = 'guest_tokens.json'
+
+class GuestTokenPool:
+    # fetchToken() returns a new token, or None if it couldn't get one
+    def __init__(self, fetchToken, size=GUEST_TOKEN_POOL_SIZE, cacheFilename=None):
+        self.fetchToken = fetchToken
+        self.size = max(1, size)
+        self.cacheFilename = cacheFilename
+        self.lifetime = GUEST_TOKEN_LIFETIME
+        self.observedLifetimes = []
+        # [token, fetchedAt] (wall clock time, so they can be saved)
+        self.tokens = []
+        self.nextIndex = 0
+        self.failedFetches = 0
+        self.fetchCount = 0
+        self.lastFetchAt = None
+        # token -> time.monotonic() it can be used again
+        self.cooldowns = {}
+        self.lock = threading.Condition()
+        self.fetchLock = threading.Lock()
+        self.wakeRefresher = threading.Event()
+        self.LoadCache()
+        self.refresher = threading.Thread(target=self.RefreshLoop, name='GuestTokenRefresh', daemon=True)
+        self.refresher.start()
+
+    def LoadCache(self):
+        if self.cacheFilename is None or not os.path.exists(self.cacheFilename):
+            return
+        try:
+            with open(self.cacheFilename, 'r') as f:
+                cache = json.load(f)
+            self.observedLifetimes = cache.get('observedLifetimes', [])[-GUEST_TOKEN_LIFETIME_SAMPLES:]
+            self.UpdateLifetime()
+            now = time.time()
+            self.tokens = [[token, fetchedAt] for token, fetchedAt in cache.get('tokens', []) if now - fetchedAt < self.lifetime]
+            if len(self.tokens) > 0:
+                print('Reusing %d cached guest tokens' % len(self.tokens))
+        except Exception as e:
+            print('Could not read guest token cache "%s": %s' % (self.cacheFilename, str(e)), file=sys.stderr)
+
+    # Call with self.lock held
+    def SaveCache(self):
+        if self.cacheFilename is None:
+            return
+        try:
+            tempFilename = self.cacheFilename + '.tmp'
+            with open(tempFilename, 'w') as f:
+                json.dump({'observedLifetimes': self.observedLifetimes, 'tokens': self.tokens}, f)
+            os.replace(tempFilename, self.cacheFilename)
+        except OSError as e:
+            print('Could not write guest token cache "%s": %s' % (self.cacheFilename, str(e)), file=sys.stderr)
+
+    def UpdateLifetime(self):
+        if len(self.observedLifetimes) == 0:
+            self.lifetime = GUEST_TOKEN_LIFETIME
+        else:
+            self.lifetime = max(GUEST_TOKEN_MIN_LIFETIME, sorted(self.observedLifetimes)[len(self.observedLifetimes) // 2])
+
+    # Call with self.lock held
+    def GetUsableTokens(self):
+        now = time.time()
+        return [entry for entry in self.tokens if now - entry[1] < self.lifetime]
+
+    # Call with self.lock held. The usable tokens that aren't on cooldown
+    def GetReadyTokens(self, usable):
+        now = time.monotonic()
+        self.cooldowns = dict((token, until) for token, until in self.cooldowns.items() if until > now)
+        return [entry for entry in usable if entry[0] not in self.cooldowns]
+
+    # Fetches one token and adds it to the pool. Only one fetch happens at a time
+    def FetchOne(self):
+        with self.fetchLock:
+            try:
+                token = self.fetchToken()
+            except Exception:
+                traceback.print_exc()
+                token = None
+
+            with self.lock:
+                self.lastFetchAt = time.monotonic()
+                if token is None:
+                    self.failedFetches += 1
+                    return False
+                # Expired ones don't count: if the site still hands one out, it's still good
+                self.tokens = self.GetUsableTokens()
+                if any(entry[0] == token for entry in self.tokens):
+                    print('Got guest token "%s" again, it is already in the pool' % token)
+                    self.failedFetches += 1
+                    return False
+                self.failedFetches = 0
+                self.fetchCount += 1
+                self.tokens.append([token, time.time()])
+                self.SaveCache()
+                self.lock.notify_all()
+                return True
+
+    def GetBackoff(self):
+        if self.failedFetches == 0:
+            return 0
+        return min(GUEST_TOKEN_MAX_BACKOFF, 2.0 ** (self.failedFetches - 1))
+
+    def Acquire(self):
+        while True:
+            with self.lock:
+                usable = self.GetUsableTokens()
+                ready = self.GetReadyTokens(usable)
+                if len(ready) > 0:
+                    self.nextIndex = (self.nextIndex + 1) % len(ready)
+                    return ready[self.nextIndex][0]
+                if len(usable) > 0:
+                    # All on cooldown: wait for the first one to come off it, or for a new one to be fetched
+                    delay = min(self.cooldowns[entry[0]] for entry in usable) - time.monotonic()
+                    print('All guest tokens are rate limited, waiting up to %.0f seconds' % delay)
+                    self.lock.wait(timeout=max(0.0, delay))
+                    continue
+                backoff = self.GetBackoff()
+
+            if backoff > 0:
+                print('Could not get a guest token, trying again in %.0f seconds' % backoff)
+                time.sleep(backoff)
+            if not self.fetchLock.locked():
+                self.FetchOne()
+            else:
+                # Someone else is already fetching one
+                with self.lock:
+                    self.lock.wait(timeout=1.0)
+
+    # The API rate limited token: don't hand it out for seconds
+    def Cooldown(self, token, seconds):
+        with self.lock:
+            self.cooldowns[token] = time.monotonic() + seconds
+        self.wakeRefresher.set()
+
+    # The API stopped accepting token
+    def Invalidate(self, token):
+        with self.lock:
+            for entry in self.tokens:
+                if entry[0] == token:
+                    age = time.time() - entry[1]
+                    self.observedLifetimes = (self.observedLifetimes + [age])[-GUEST_TOKEN_LIFETIME_SAMPLES:]
+                    self.UpdateLifetime()
+                    print('Guest token lasted %d seconds, now assuming they last %d' % (age, self.lifetime))
+                    break
+            self.tokens = [entry for entry in self.tokens if entry[0] != token]
+            self.SaveCache()
+        self.wakeRefresher.set()
+
+    # How long until the pool next needs a fetch (0 if it needs one now)
+    def GetRefreshDelay(self):
+        with self.lock:
+            # The backoff and the minimum interval both count from the last fetch
+            sinceLastFetch = float('inf') if self.lastFetchAt is None else time.monotonic() - self.lastFetchAt
+            minDelay = max(0, GUEST_TOKEN_MIN_REFRESH_INTERVAL - sinceLastFetch)
+            fetchNowDelay = max(minDelay, self.GetBackoff() - sinceLastFetch)
+            usable = self.GetReadyTokens(self.GetUsableTokens())
+            if len(usable) < self.size:
+                return fetchNowDelay
+            now = time.time()
+            # The ones that are due for replacing still get used until they expire, but don't count towards the pool
+            fresh = [entry for entry in usable if now - entry[1] < self.lifetime * GUEST_TOKEN_REFRESH_AT]
+            if len(fresh) < self.size:
+                return fetchNowDelay
+            oldest = min(entry[1] for entry in fresh)
+            return max(minDelay, oldest + self.lifetime * GUEST_TOKEN_REFRESH_AT - now)
+
+    def RefreshLoop(self):
+        while True:
+            delay = self.GetRefreshDelay()
+            if delay > 0:
+                self.wakeRefresher.wait(timeout=delay)
+                self.wakeRefresher.clear()
+                continue
+
+            self.FetchOne()
+            with self.lock:
+                # Don't let the old ones pile up
+                self.tokens = self.tokens[-self.size * 2:]
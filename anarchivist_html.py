@@ -0,0 +1,58 @@
+# Small helpers for pulling text out of the HTML the scripts archive
+#
+# Not a real HTML parser: Steam's markup is regular enough that finding an element by its opening tag with a regex,
+# and then its end by counting <div>s, gets what we need, and is a lot faster over millions of pages.
+#
+# Dependencies:
+#  - Python 3
+
+import re
+import html
+
+divTagReg = re.compile(r'<(/?)div\b', re.IGNORECASE)
+breakTagReg = re.compile(r'<br\s*/?>|</?(?:p|li|h[1-6]|div)\b[^>]*>', re.IGNORECASE)
+anyTagReg = re.compile(r'<[^>]*>')
+spaceReg = re.compile(r'[ \t\r\f\v]+')
+
+# The inner HTML of the <div> whose opening tag is match
+def GetDivContentsAt(pageHTML, match):
+    depth = 1
+    for tag in divTagReg.finditer(pageHTML, match.end()):
+        depth += -1 if tag.group(1) else 1
+        if depth == 0:
+            return pageHTML[match.end():tag.start()]
+    return pageHTML[match.end():]
+
+# The inner HTML of the first <div> matched by startReg (which should match its whole opening tag), or None
+def GetDivContents(pageHTML, startReg):
+    match = startReg.search(pageHTML)
+    if match is None:
+        return None
+    return GetDivContentsAt(pageHTML, match)
+
+def HTMLToText(fragment):
+    if fragment is None:
+        return None
+    text = html.unescape(anyTagReg.sub('', breakTagReg.sub('\n', fragment)))
+    lines = [spaceReg.sub(' ', line).strip() for line in text.split('\n')]
+    return '\n'.join(line for line in lines if len(line) > 0)
+
+def ParseCount(text):
+    if text is None:
+        return None
+    try:
+        return int(text.replace(',', '').strip())
+    except ValueError:
+        return None
+
+def GetGroup(reg, text, group=1):
+    match = reg.search(text)
+    if match is None:
+        return None
+    return match.group(group)
+
+steamReplyTextReg = re.compile(r'<div class="commentthread_comment_text"[^>]*>')
+
+# The text of a Steam discussion reply, from the HTML dl_steam.py keeps in DiscussionReplies.contents
+def GetSteamReplyText(contents):
+    return HTMLToText(GetDivContents(contents, steamReplyTextReg))
@@ -0,0 +1,558 @@
+# Shared HTTP client for the Anarchivist scripts
+#
+# dl_steam.py, dl_twitter.py and dl_twitch_vod_chat.py all go through this module to talk to the network.
+#
+# It keeps a small pool of keep-alive connections for each host. Response bodies are always drained, even on
+# errors, so a connection can be handed to the next request instead of being thrown away. When a connection
+# does go bad, only that one is replaced: the other connections to the host keep working.
+#
+# Requests ask for gzip/deflate, and the response is decoded before it's returned, so callers always see plain bytes.
+#
+# Media should go through DownloadToFile instead, which streams the body to disk in chunks, only puts the file in
+# place once it's complete, and picks up where it left off with a Range request if a download gets interrupted.
+#
+# Every host also has a HostRateLimiter, shared by all requests to that host. It's a token bucket whose rate adapts
+# to how the server is treating us: it halves when the server says we're going too fast (429, 403, or a 408/5XX with a
+# Retry-After), pausing every request to the host for Retry-After if the server sent one, and climbs back up by
+# RATE_LIMIT_INCREASE for every RATE_LIMIT_INCREASE_SECONDS that go by without being throttled again. A stray 5XX or
+# timeout is the server having a bad moment, not a sign we're too fast, so it only backs off the request that got it.
+#
+# With SetResponseRecorder, every response (including the errors and throttles) is also handed to a recorder along with
+# the request that got it, as it came off the wire: that's how --warc works (see anarchivist_warc.py).
+#
+# Latencies, bytes, retries, reconnects and the time spent waiting are all reported to anarchivist_metrics.py, per host.
+# Requests, downloads and decoding are also spans for --trace (see anarchivist_trace.py).
+#
+# There is one retry policy for everything:
+#  - 200 returns the body
+#  - 304 returns NOT_MODIFIED (only happens if the caller sent If-None-Match/If-Modified-Since)
+#  - 3XX returns None (or a Redir301 if the caller asks for redirects)
+#  - 403 slows the host down and retries a couple of times (Steam uses it for throttling), then returns None
+#  - 429 (or a 408/5XX with a Retry-After) slows the host down and retries
+#  - 408/5XX without a Retry-After back off and retry, without slowing down the rest of the host's requests
+#  - 404/410 return None straight away (as do any statuses the caller passes in noRetryStatuses, for a site where they
+#    mean something retrying won't fix)
+#  - Any other status backs off and retries (without slowing down the rest of the host's requests)
+#  - A keep-alive connection the server had already dropped is retried right away on a fresh connection. Every other
+#    error (refused or reset on a fresh connection, timeouts...) backs off first, so a host that's down doesn't use up
+#    all the retries in a few milliseconds
+# When a request gives up on an error status, outError (if given) gets the last (status, body, headers), so the caller
+# can tell what the site objected to.
+#
+# Dependencies:
+#  - Python 3
+#  - anarchivist_metrics.py and anarchivist_trace.py from this repo
+
+import os
+import sys
+import re
+import time
+import random
+import traceback
+import threading
+
+import datetime
+import email.utils
+
+import gzip
+import zlib
+
+import http.client
+
+from anarchivist_metrics import RecordRequest, RecordRetry, RecordReconnect, RecordBackoff
+from anarchivist_trace import Span, Traced
+
+# How many connections we will have open to any one host at once
+MAX_CONNS_PER_HOST = 8
+
+CONN_TIMEOUT = 50
+
+# Backoff between retries is exponential, starting at RETRY_BASE_DELAY seconds, and capped at RETRY_MAX_DELAY
+RETRY_BASE_DELAY = 2.0
+RETRY_MAX_DELAY = 60.0
+
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+# Statuses that won't be any different if we ask again
+NO_RETRY_STATUSES = (404, 410)
+
+# How much of a download is read into memory at a time by DownloadToFile
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+# 403 can mean either "slow down" or "you really can't see this", so it only gets retried this many times
+FORBIDDEN_RETRIES = 2
+
+# Requests per second for each host's rate limiter. Every host starts at RATE_LIMIT_START,
+# and the rate is kept between RATE_LIMIT_MIN and RATE_LIMIT_MAX
+RATE_LIMIT_START = 10.0
+RATE_LIMIT_MIN = 0.2
+RATE_LIMIT_MAX = 100.0
+
+# How many requests can go out back to back after the host has been quiet for a while
+RATE_LIMIT_BURST = 10.0
+
+# The rate is multiplied by RATE_LIMIT_DECREASE when we get throttled, and by RATE_LIMIT_INCREASE for every
+# RATE_LIMIT_INCREASE_SECONDS since then (or since the last increase), counted when a request succeeds. It goes by time
+# rather than by how many requests succeeded, so it comes back just as quickly at RATE_LIMIT_MIN (about 15 seconds from
+# there to RATE_LIMIT_START) as at full speed
+RATE_LIMIT_DECREASE = 0.5
+RATE_LIMIT_INCREASE = 1.25
+RATE_LIMIT_INCREASE_SECONDS = 1.0
+
+class Redir301:
+    url = ''
+    def __init__(self, _url):
+        self.url = _url
+
+# Returned instead of a body when the server answers a conditional request with 304
+class NotModified304:
+    pass
+
+NOT_MODIFIED = NotModified304()
+
+class HostRateLimiter:
+    def __init__(self, origin, rate=RATE_LIMIT_START):
+        self.origin = origin
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = RATE_LIMIT_BURST
+        self.lastRefill = time.monotonic()
+        self.pausedUntil = 0.0
+        self.lastIncrease = self.lastRefill
+
+    # Blocks until we're allowed to send another request to the host
+    def Wait(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.pausedUntil:
+                    delay = self.pausedUntil - now
+                else:
+                    self.tokens = min(RATE_LIMIT_BURST, self.tokens + max(0.0, now - self.lastRefill) * self.rate)
+                    self.lastRefill = now
+                    if self.tokens >= 1.0:
+                        self.tokens -= 1.0
+                        return
+                    delay = (1.0 - self.tokens) / self.rate
+                reason = 'throttled' if now < self.pausedUntil else 'rate-limit'
+
+            RecordBackoff(self.origin, reason, delay)
+            time.sleep(delay)
+
+    def OnSuccess(self):
+        with self.lock:
+            now = time.monotonic()
+            # Time spent paused doesn't count
+            since = now - max(self.lastIncrease, self.pausedUntil)
+            if since >= RATE_LIMIT_INCREASE_SECONDS:
+                self.rate = min(RATE_LIMIT_MAX, self.rate * RATE_LIMIT_INCREASE ** (since / RATE_LIMIT_INCREASE_SECONDS))
+                self.lastIncrease = now
+
+    # Stops all requests to the host for pauseSeconds, and slows it down afterwards
+    def OnThrottled(self, pauseSeconds):
+        with self.lock:
+            now = time.monotonic()
+            self.lastIncrease = now
+            # A bunch of requests that were in flight at the same time will often all get throttled together,
+            # so only slow down once for each pause
+            if now >= self.pausedUntil:
+                self.rate = max(RATE_LIMIT_MIN, self.rate * RATE_LIMIT_DECREASE)
+                print('Throttled by %s, slowing down to %.2f requests/sec' % (self.origin, self.rate), file=sys.stderr)
+            self.pausedUntil = max(self.pausedUntil, now + pauseSeconds)
+            self.tokens = 0.0
+            self.lastRefill = self.pausedUntil
+
+class HostPool:
+    # siteURL is the scheme and host the requests are for, when that's not where they're sent (see OverrideHost)
+    def __init__(self, origin, doSSL=True, maxConns=MAX_CONNS_PER_HOST, siteURL=None):
+        self.origin = origin
+        self.doSSL = doSSL
+        self.siteURL = siteURL or '%s://%s' % ('https' if doSSL else 'http', origin)
+        # What it's called in messages and metrics
+        self.siteHost = self.siteURL.partition('://')[2]
+        self.limiter = HostRateLimiter(self.siteHost)
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(maxConns)
+
+    def NewConn(self):
+        if self.doSSL:
+            return http.client.HTTPSConnection(self.origin, timeout=CONN_TIMEOUT)
+        else:
+            return http.client.HTTPConnection(self.origin, timeout=CONN_TIMEOUT)
+
+    def Acquire(self):
+        self.slots.acquire()
+        with self.lock:
+            if len(self.idle) > 0:
+                return self.idle.pop()
+        return self.NewConn()
+
+    # Only safe to call before the pool is being used
+    def SetMaxConns(self, maxConns):
+        self.slots = threading.BoundedSemaphore(maxConns)
+
+    def Release(self, conn, reusable=True):
+        if reusable:
+            with self.lock:
+                self.idle.append(conn)
+        else:
+            conn.close()
+        self.slots.release()
+
+    # If one keep-alive connection timed out, the ones that have been sitting idle alongside it probably did too
+    def DropIdle(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn in idle:
+            conn.close()
+
+hostPools = {}
+hostPoolsLock = threading.Lock()
+
+# origin -> (address, doSSL) to send its requests to instead, e.g. a local stand-in for the site (see benchmark.py).
+# Each origin still gets its own pool and rate limiter. Has to be set before the script asks for the pool
+hostOverrides = {}
+
+def OverrideHost(origin, address, doSSL=False):
+    hostOverrides[origin] = (address, doSSL)
+
+def GetHostPool(origin, doSSL=True):
+    with hostPoolsLock:
+        key = (origin, doSSL)
+        if key not in hostPools:
+            address, addressSSL = hostOverrides.get(origin, (origin, doSSL))
+            hostPools[key] = HostPool(address, addressSSL, siteURL='%s://%s' % ('https' if doSSL else 'http', origin))
+        return hostPools[key]
+
+# Something with a RecordResponse(siteURL, method, url, requestHeaders, postData, res, body) method, e.g. a WARCWriter.
+# body is the raw bytes, or (filename, offset, length) of where DownloadToFile put them. Set before any requests are made
+responseRecorder = None
+
+def SetResponseRecorder(recorder):
+    global responseRecorder
+    responseRecorder = recorder
+
+def RecordResponse(pool, method, url, headers, postData, res, body):
+    try:
+        responseRecorder.RecordResponse(pool.siteURL, method, url, headers, postData, res, body)
+    except Exception:
+        traceback.print_exc()
+        print('Could not record the response for "%s"' % url, file=sys.stderr)
+
+@Traced('decode', 'decode')
+def DecodeBody(data, contentEncoding):
+    contentEncoding = (contentEncoding or '').strip().lower()
+    if contentEncoding == 'gzip' or contentEncoding == 'x-gzip':
+        return gzip.decompress(data)
+    elif contentEncoding == 'deflate':
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            # Some servers send a raw deflate stream without the zlib header
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+    else:
+        return data
+
+def GetRetryDelay(attempt):
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt))
+    return delay * random.uniform(0.75, 1.25)
+
+# Retry-After is either a number of seconds or an HTTP date. Returns None if it's missing or we can't make sense of it
+def ParseRetryAfter(retryAfter):
+    if retryAfter is None:
+        return None
+
+    retryAfter = retryAfter.strip()
+    try:
+        return max(0.0, float(retryAfter))
+    except ValueError:
+        pass
+
+    try:
+        when = email.utils.parsedate_to_datetime(retryAfter)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+# Prints what happened and slows the host down if the server is throttling us.
+# Returns True if the request is worth retrying. forbiddenCount is how many 403s the request has had so far
+def ShouldRetryStatus(pool, res, attempt, forbiddenCount, noRetryStatuses=()):
+    if res.status in noRetryStatuses:
+        print('Got status %d' % res.status)
+        return False
+    elif res.status == 403:
+        print('Got status 403...waiting...')
+        pool.limiter.OnThrottled(ParseRetryAfter(res.getheader('Retry-After')) or 5.0)
+        return forbiddenCount <= FORBIDDEN_RETRIES
+    elif res.status == 429 or (res.status in RETRY_STATUSES and res.getheader('Retry-After') is not None):
+        print('Got status %d...' % res.status)
+        retryAfter = ParseRetryAfter(res.getheader('Retry-After'))
+        if retryAfter is None:
+            retryAfter = GetRetryDelay(attempt)
+        pool.limiter.OnThrottled(retryAfter)
+        return True
+    elif res.status in NO_RETRY_STATUSES:
+        print('Got status %d' % res.status)
+        return False
+    else:
+        delay = GetRetryDelay(attempt)
+        print('Got status %d...retrying in %.0fs' % (res.status, delay))
+        RecordBackoff(pool.siteHost, 'error', delay)
+        time.sleep(delay)
+        return True
+
+# A keep-alive connection that sat idle until the server closed it is worth retrying right away on a fresh one.
+# Anything else means the host is having trouble, so back off the same way as for any other error
+def OnConnectionError(pool, e, attempt, retryNow):
+    print('Connection got %s, retrying...' % type(e).__name__, file=sys.stderr)
+    RecordReconnect(pool.siteHost)
+    pool.DropIdle()
+    if not retryNow:
+        delay = GetRetryDelay(attempt)
+        RecordBackoff(pool.siteHost, 'error', delay)
+        time.sleep(delay)
+
+# "Content-Range: bytes 100-999/1000" -> 100, or None if there isn't one
+def GetContentRangeStart(res):
+    contentRange = res.getheader('Content-Range')
+    if contentRange is None:
+        return None
+
+    match = re.match(r'\s*bytes\s+([0-9]+)-', contentRange)
+    if match:
+        return int(match.group(1))
+    return None
+
+# "Content-Range: bytes 100-999/1000" -> 1000, or None if there isn't one (or the server doesn't know, "/*")
+def GetContentRangeTotal(res):
+    contentRange = res.getheader('Content-Range')
+    if contentRange is None:
+        return None
+
+    match = re.match(r'\s*bytes\s+[0-9]+-[0-9]+/([0-9]+)', contentRange)
+    if match:
+        return int(match.group(1))
+    return None
+
+def GetMessageWithRetries(pool, url, headersData={}, postData=None, maxRetries=13, outHeaders=None, returnRedirects=False, noRetryStatuses=(), outError=None):
+    headers = dict(headersData)
+    if 'Accept-Encoding' not in headers:
+        headers['Accept-Encoding'] = 'gzip, deflate'
+
+    with Span('fetch', 'fetch', host=pool.siteHost, url=url) as span:
+        forbiddenCount = 0
+        droppedBefore = False
+        for i in range(maxRetries):
+            if i > 0:
+                RecordRetry(pool.siteHost)
+            pool.limiter.Wait()
+            conn = pool.Acquire()
+            # Whether this is a keep-alive connection that's been used before
+            wasOpen = conn.sock is not None
+            reusable = False
+            res = None
+            start = time.monotonic()
+            try:
+                #print('Making request "%s"...' % url)
+                if postData is None:
+                    conn.request('GET', url, headers=headers)
+                else:
+                    conn.request('POST', url, postData, headers)
+                res = conn.getresponse()
+
+                # Always read the whole body, otherwise the connection can't be used for the next request
+                data = res.read()
+                reusable = not res.will_close
+                RecordRequest(pool.siteHost, res.status, time.monotonic() - start, len(data))
+                span.Set('status', res.status)
+                span.Set('attempts', i + 1)
+
+                if responseRecorder is not None:
+                    RecordResponse(pool, 'GET' if postData is None else 'POST', url, headers, postData, res, data)
+
+                if res.status == 200:
+                    data = DecodeBody(data, res.getheader('Content-Encoding'))
+
+            except (http.client.ResponseNotReady, http.client.RemoteDisconnected, ConnectionError) as e:
+                RecordRequest(pool.siteHost, 'error', time.monotonic() - start, 0)
+                OnConnectionError(pool, e, i, retryNow=wasOpen and not droppedBefore)
+                droppedBefore = droppedBefore or wasOpen
+                continue
+            except Exception as e:
+                traceback.print_exc()
+                print("Error, got exception: '%s'" % str(e), file=sys.stderr)
+                if res is None:
+                    RecordRequest(pool.siteHost, 'error', time.monotonic() - start, 0)
+                delay = GetRetryDelay(i)
+                RecordBackoff(pool.siteHost, 'error', delay)
+                time.sleep(delay)
+                continue
+            finally:
+                pool.Release(conn, reusable)
+
+            if res.status == 200:
+                pool.limiter.OnSuccess()
+                if outHeaders is not None:
+                    outHeaders.extend(res.getheaders())
+                return data
+            elif res.status == 304:
+                pool.limiter.OnSuccess()
+                if outHeaders is not None:
+                    outHeaders.extend(res.getheaders())
+                return NOT_MODIFIED
+            elif res.status in REDIRECT_STATUSES:
+                print('Location: %s' % res.getheader('Location'))
+                if returnRedirects:
+                    return Redir301(res.getheader('Location'))
+                return None
+            else:
+                if res.status == 403:
+                    forbiddenCount += 1
+                if outError is not None:
+                    try:
+                        outError[:] = [(res.status, DecodeBody(data, res.getheader('Content-Encoding')), res.getheaders())]
+                    except (OSError, EOFError, zlib.error):
+                        outError[:] = [(res.status, data, res.getheaders())]
+                if not ShouldRetryStatus(pool, res, i, forbiddenCount, noRetryStatuses):
+                    return None
+
+        return None
+
+# Streams url into filename without ever holding the whole body in memory.
+# The body goes into "{filename}.part" first, and is only renamed to filename once all of it has arrived,
+# so if filename exists it's complete. If a .part file is left over from an earlier attempt (or an earlier run),
+# only the rest of it is requested, with a Range request. A 206 for any other range than the one asked for (or without a
+# Content-Range) means the .part file can't be trusted, so it's thrown away and the download starts over. A resumed
+# file is only put in place once its size matches the total in the Content-Range.
+# Returns True if the file was downloaded
+def DownloadToFile(pool, url, filename, headersData={}, maxRetries=13):
+    partFilename = filename + '.part'
+    dirname = os.path.dirname(filename)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+
+    with Span('download', 'fetch', host=pool.siteHost, url=url) as span:
+        forbiddenCount = 0
+        droppedBefore = False
+        for i in range(maxRetries):
+            headers = dict(headersData)
+            # Range offsets are into the body as it's sent, so don't let the server compress it
+            headers['Accept-Encoding'] = 'identity'
+
+            resumeFrom = 0
+            if os.path.exists(partFilename):
+                resumeFrom = os.path.getsize(partFilename)
+            if resumeFrom > 0:
+                headers['Range'] = 'bytes=%d-' % resumeFrom
+
+            if i > 0:
+                RecordRetry(pool.siteHost)
+            pool.limiter.Wait()
+            conn = pool.Acquire()
+            # Whether this is a keep-alive connection that's been used before
+            wasOpen = conn.sock is not None
+            reusable = False
+            res = None
+            rangeMismatch = False
+            start = time.monotonic()
+            try:
+                conn.request('GET', url, headers=headers)
+                res = conn.getresponse()
+
+                if res.status == 206 and GetContentRangeStart(res) != resumeFrom:
+                    # Not the range we asked for, so there's no telling where it goes
+                    data = res.read()
+                    RecordRequest(pool.siteHost, res.status, time.monotonic() - start, len(data))
+                    span.Set('status', res.status)
+                    if responseRecorder is not None:
+                        RecordResponse(pool, 'GET', url, headers, None, res, data)
+                    rangeMismatch = True
+                elif res.status == 200 or res.status == 206:
+                    if res.status == 206 and resumeFrom > 0:
+                        print('Resuming "%s" from byte %d' % (url, resumeFrom))
+                        mode = 'ab'
+                    else:
+                        # The server sent the whole thing, so start the file over
+                        mode = 'wb'
+
+                    written = 0
+                    with open(partFilename, mode) as f:
+                        startOffset = f.tell()
+                        while True:
+                            chunk = res.read(DOWNLOAD_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            f.write(chunk)
+                            written += len(chunk)
+
+                    RecordRequest(pool.siteHost, res.status, time.monotonic() - start, written)
+                    span.Set('status', res.status)
+                    span.Set('bytes', written)
+                    if responseRecorder is not None:
+                        RecordResponse(pool, 'GET', url, headers, None, res, (partFilename, startOffset, written))
+
+                    expected = res.getheader('Content-Length')
+                    if expected is not None and written != int(expected):
+                        # Keep what we got, the next attempt will pick up from there
+                        raise http.client.IncompleteRead(b'', int(expected) - written)
+
+                    total = GetContentRangeTotal(res) if res.status == 206 else None
+                    if total is not None:
+                        size = os.path.getsize(partFilename)
+                        if size > total:
+                            os.remove(partFilename)
+                            raise ValueError('"%s" came to %d bytes, but should be %d, starting over' % (url, size, total))
+                        if size < total:
+                            raise http.client.IncompleteRead(b'', total - size)
+                else:
+                    data = res.read()
+                    RecordRequest(pool.siteHost, res.status, time.monotonic() - start, len(data))
+                    span.Set('status', res.status)
+                    if responseRecorder is not None:
+                        RecordResponse(pool, 'GET', url, headers, None, res, data)
+
+                reusable = not res.will_close
+
+            except (http.client.ResponseNotReady, http.client.RemoteDisconnected, ConnectionError) as e:
+                RecordRequest(pool.siteHost, 'error', time.monotonic() - start, 0)
+                OnConnectionError(pool, e, i, retryNow=wasOpen and not droppedBefore)
+                droppedBefore = droppedBefore or wasOpen
+                continue
+            except Exception as e:
+                traceback.print_exc()
+                print("Error, got exception: '%s'" % str(e), file=sys.stderr)
+                if res is None:
+                    RecordRequest(pool.siteHost, 'error', time.monotonic() - start, 0)
+                delay = GetRetryDelay(i)
+                RecordBackoff(pool.siteHost, 'error', delay)
+                time.sleep(delay)
+                continue
+            finally:
+                pool.Release(conn, reusable)
+
+            if rangeMismatch:
+                print('Got a different range than asked for from "%s", starting over' % url)
+                if os.path.exists(partFilename):
+                    os.remove(partFilename)
+            elif res.status == 200 or res.status == 206:
+                pool.limiter.OnSuccess()
+                os.replace(partFilename, filename)
+                return True
+            elif res.status == 416:
+                # Whatever is in the .part file doesn't line up with what's on the server, so start over
+                print('Range not satisfiable for "%s", starting over' % url)
+                os.remove(partFilename)
+            elif res.status in REDIRECT_STATUSES:
+                print('Location: %s' % res.getheader('Location'))
+                return False
+            else:
+                if res.status == 403:
+                    forbiddenCount += 1
+                if not ShouldRetryStatus(pool, res, i, forbiddenCount):
+                    return False
+
+        return False
@@ -0,0 +1,121 @@
+# A manifest of the media files a script has downloaded, kept in the same database as the rest of the target's data
+#
+# The MediaManifest table has a row for every image/video that was downloaded all the way: its path (relative to the
+# database's directory), the URL it came from, its size, a SHA-256 of its contents and when it was fetched.
+# That way:
+#  - whether a file still needs downloading is a lookup in a set that's loaded once when the target starts, instead of
+#    a stat per image (which adds up over hundreds of thousands of files)
+#  - a file that's on disk but isn't complete (a crash mid-write with an older version, a disk problem later on) doesn't
+#    count as done just because it exists: verify_media.py checks every file against its row, in parallel, and with
+#    --repair downloads the ones that don't match again
+#
+# Usage:
+#   manifest = MediaManifest(db, 'data/440')
+#   if not manifest.Has(filename):
+#       mediaPool.Submit(pool, urlPath, filename, manifest=manifest)   # or DownloadToManifest() on a thread of your own
+#
+# Files are only added once DownloadToFile has moved them into place, so the size and hash are of the whole file.
+# Whether the rows can be written from the download threads depends on the db:
+#  - a DBWriter can be written from any thread, so pass writeFromWorkers=True and each row is committed (as its own
+#    small unit, which the writer batches up) as soon as its file is done
+#  - a plain sqlite3 connection can't, so the rows are queued up, and WriteCompleted() writes them on the db's thread
+#    (it doesn't commit, so it can go in whatever transaction the caller has open)
+# Either way the file is in the set as soon as it's done, so it won't be downloaded twice in one run.
+#
+# Has() only ever looks at the set, never the disk, so it stays cheap on the crawl's thread. That means archives from
+# before the manifest existed, which don't have rows for the files that are already there, would get them all
+# downloaded again: run verify_media.py --adopt on those once first. It hashes the files on its worker threads and adds
+# them with url and fetchedAt left NULL, since we don't know where they came from or when they were fetched (or whether
+# they were complete at the time).
+#
+# Dependencies:
+#  - Python 3
+#  - anarchivist_http.py and anarchivist_trace.py from this repo
+
+import os
+import time
+import queue
+import hashlib
+import threading
+
+from anarchivist_http import DownloadToFile
+from anarchivist_trace import Traced
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def CreateManifestTable(db):
+    db.execute('CREATE TABLE IF NOT EXISTS MediaManifest(path VARCHAR(255) PRIMARY KEY, url VARCHAR(255), size INTEGER, contentHash VARCHAR(64), fetchedAt INTEGER);')
+    db.commit()
+
+# Returns (size, SHA-256 hex digest) of the file
+@Traced('hash file', 'fs')
+def HashFile(filename):
+    hasher = hashlib.sha256()
+    size = 0
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            size += len(chunk)
+    return (size, hasher.hexdigest())
+
+class MediaManifest:
+    # rootDir is the directory the paths in the table are relative to: the database's directory
+    def __init__(self, db, rootDir, writeFromWorkers=False):
+        self.db = db
+        self.rootDir = os.path.normpath(rootDir)
+        self.writeFromWorkers = writeFromWorkers
+        self.completed = queue.Queue()
+        self.lock = threading.Lock()
+
+        CreateManifestTable(db)
+        self.paths = set(row[0] for row in db.execute('SELECT path FROM MediaManifest;'))
+        print('%d files in the media manifest for "%s"' % (len(self.paths), rootDir))
+
+    def GetPath(self, filename):
+        path = os.path.normpath(filename)
+        if self.rootDir != '.' and path.startswith(self.rootDir + os.sep):
+            return path[len(self.rootDir) + len(os.sep):]
+        return os.path.relpath(path, self.rootDir)
+
+    # Whether the file has been downloaded
+    def Has(self, filename):
+        path = self.GetPath(filename)
+        with self.lock:
+            return path in self.paths
+
+    # Call once the file is complete and in place. Safe to call from any thread
+    def Add(self, filename, url):
+        size, contentHash = HashFile(filename)
+        self.AddRow((self.GetPath(filename), url, size, contentHash, int(time.time())), commit=True)
+
+    def AddRow(self, row, commit):
+        with self.lock:
+            self.paths.add(row[0])
+
+        if self.writeFromWorkers:
+            self.db.execute('INSERT OR REPLACE INTO MediaManifest VALUES(?,?,?,?,?);', row)
+            if commit:
+                self.db.commit()
+        else:
+            self.completed.put(row)
+
+    # Call on the db's thread (not needed with writeFromWorkers)
+    def WriteCompleted(self):
+        rows = []
+        while True:
+            try:
+                rows.append(self.completed.get_nowait())
+            except queue.Empty:
+                break
+        if len(rows) > 0:
+            self.db.executemany('INSERT OR REPLACE INTO MediaManifest VALUES(?,?,?,?,?);', rows)
+
+# DownloadToFile, and adds the file to the manifest if it worked
+def DownloadToManifest(manifest, pool, urlPath, filename, headers={}):
+    if not DownloadToFile(pool, urlPath, filename, headers):
+        return False
+    manifest.Add(filename, pool.siteURL + urlPath)
+    return True
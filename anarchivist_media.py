@@ -0,0 +1,109 @@
+# Background media downloads for the Anarchivist scripts
+#
+# Images (and other media) are handed to a MediaDownloadPool, which downloads them on a fixed number of worker
+# threads while the script carries on crawling pages. The queue in front of the workers is bounded, so if the
+# crawl gets too far ahead of the downloads, Submit() blocks until the workers catch up.
+#
+# The workers use the shared connection pools from anarchivist_http.py, so the number of connections to the
+# media host should be at least the number of workers (see HostPool.SetMaxConns). Files are streamed to disk
+# with DownloadToFile, so they only show up under their final name once they're complete. Jobs submitted with a
+# manifest (see anarchivist_manifest.py) are added to it once they're done.
+#
+# When targets are crawled in parallel (see anarchivist_targets.py) they all share one pool, so each job can be
+# submitted with a group (the target), and Wait(group) only waits for that target's jobs, and reports their stats.
+#
+# Dependencies:
+#  - Python 3
+#  - anarchivist_http.py (shared HTTP client) and anarchivist_manifest.py from this repo
+
+import os
+import sys
+import threading
+import traceback
+import queue
+
+from anarchivist_http import DownloadToFile
+from anarchivist_manifest import DownloadToManifest
+
+DEFAULT_MEDIA_WORKER_COUNT = 8
+
+# How many jobs can be waiting per worker before Submit() starts blocking
+QUEUED_JOBS_PER_WORKER = 16
+
+class MediaDownloadPool:
+    def __init__(self, workerCount=DEFAULT_MEDIA_WORKER_COUNT):
+        self.workerCount = max(1, workerCount)
+        self.jobs = queue.Queue(maxsize=self.workerCount * QUEUED_JOBS_PER_WORKER)
+        self.statsLock = threading.Lock()
+        self.groupDone = threading.Condition(self.statsLock)
+        self.downloadedCount = 0
+        self.failedCount = 0
+        # group -> [queued or running, downloaded, failed]
+        self.groups = {}
+        self.workers = []
+        for i in range(self.workerCount):
+            worker = threading.Thread(target=self.WorkerLoop, name='MediaWorker%d' % i, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    # onDone (if given) is called on the worker thread with True/False once the job is finished
+    def Submit(self, pool, urlPath, filename, headers={}, onDone=None, manifest=None, group=None):
+        if group is not None:
+            with self.statsLock:
+                self.groups.setdefault(group, [0, 0, 0])[0] += 1
+        self.jobs.put((pool, urlPath, filename, headers, onDone, manifest, group))
+
+    def WorkerLoop(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                self.RunJob(*job)
+            finally:
+                self.jobs.task_done()
+
+    def RunJob(self, pool, urlPath, filename, headers, onDone, manifest, group):
+        success = False
+        try:
+            if manifest is not None:
+                success = DownloadToManifest(manifest, pool, urlPath, filename, headers)
+            else:
+                success = DownloadToFile(pool, urlPath, filename, headers)
+            if not success:
+                print('Could not download "%s"...' % urlPath)
+        except Exception as e:
+            traceback.print_exc()
+            print("Error downloading '%s': '%s'" % (urlPath, str(e)), file=sys.stderr)
+
+        with self.statsLock:
+            if success:
+                self.downloadedCount += 1
+            else:
+                self.failedCount += 1
+
+        if onDone is not None:
+            try:
+                onDone(success)
+            except Exception:
+                traceback.print_exc()
+
+        # Only once onDone has run, so whatever it saves is there when Wait(group) returns
+        if group is not None:
+            with self.statsLock:
+                counts = self.groups[group]
+                counts[0] -= 1
+                counts[1 if success else 2] += 1
+                self.groupDone.notify_all()
+
+    # Blocks until everything submitted so far has been downloaded (or has failed). With a group, only that group's jobs
+    def Wait(self, group=None):
+        if group is None:
+            self.jobs.join()
+            with self.statsLock:
+                print('Media downloads finished: %d downloaded, %d failed' % (self.downloadedCount, self.failedCount))
+            return
+
+        with self.statsLock:
+            while self.groups.get(group, [0])[0] > 0:
+                self.groupDone.wait()
+            counts = self.groups.pop(group, [0, 0, 0])
+        print('Media downloads for "%s" finished: %d downloaded, %d failed' % (group, counts[1], counts[2]))
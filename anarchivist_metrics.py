@@ -0,0 +1,227 @@
+# Crawl metrics: what the requests and the database writes are actually doing
+#
+# anarchivist_http.py and anarchivist_dbwriter.py report into here as they go:
+#  - every response (or connection error), as a latency histogram per host and status, with the bytes received
+#  - retries, and reconnects after a dropped keep-alive connection, per host
+#  - time spent sleeping instead of sending: waiting on a host's rate limiter, paused because the host throttled us,
+#    or backing off after an error
+#  - rows inserted, per table (counted when they're committed, so rolled back ones don't count)
+# and scripts can report how far through they are with SetProgress(task, done, total), which is where the ETA comes from.
+# That needs a total up front, so only dl_twitch_vod_chat.py reports progress (a VOD's length is known before its chat
+# is fetched). Steam's listings and Twitter's timelines are paged through with cursors until they run out, with nothing
+# saying how many pages there are, so dl_steam.py and dl_twitter.py don't report any, and their progress line has no ETA.
+#
+# Recording is always on (it's a few dict updates per request). With --metrics[=FILE] (StartMetricsFromFlags), every
+# --metrics-interval seconds (default 10):
+#  - FILE (default metrics.json) is rewritten with everything as JSON
+#  - the same file with a .prom extension is rewritten in the Prometheus text format, for node_exporter's textfile
+#    collector or anything else that reads it
+#  - a progress line goes to stderr: requests and MB so far (and their rates), retries, backoff, rows, and an ETA if
+#    the script reports progress (only Twitch, see above)
+# They're written once more when the script exits.
+#
+# Dependencies:
+#  - Python 3
+#  - anarchivist_args.py from this repo
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+
+from anarchivist_args import GetIntFlag
+
+# Upper bounds (seconds) of the request latency histogram buckets. Everything slower goes in +Inf
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRICS_INTERVAL = 10
+
+DEFAULT_METRICS_FILE = 'metrics.json'
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def Observe(self, value):
+        i = 0
+        while i < len(LATENCY_BUCKETS) and value > LATENCY_BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+metricsLock = threading.Lock()
+startTime = time.time()
+
+# (host, status) -> Histogram. status is the HTTP status, or 'error' if there wasn't a response
+requestLatency = {}
+receivedBytes = {}
+retryCounts = {}
+reconnectCounts = {}
+# (host, reason) -> seconds. reason is 'rate-limit', 'throttled' or 'error'
+backoffSeconds = {}
+insertedRows = {}
+# task -> (done, total, when it was first reported)
+progress = {}
+
+# Set by StartMetricsFromFlags. Only used to skip work that's only needed for the reports
+metricsEnabled = False
+
+def AddTo(counts, key, amount):
+    counts[key] = counts.get(key, 0) + amount
+
+def RecordRequest(host, status, seconds, byteCount):
+    with metricsLock:
+        key = (host, str(status))
+        if key not in requestLatency:
+            requestLatency[key] = Histogram()
+        requestLatency[key].Observe(seconds)
+        AddTo(receivedBytes, host, byteCount)
+
+def RecordRetry(host):
+    with metricsLock:
+        AddTo(retryCounts, host, 1)
+
+def RecordReconnect(host):
+    with metricsLock:
+        AddTo(reconnectCounts, host, 1)
+
+def RecordBackoff(host, reason, seconds):
+    with metricsLock:
+        AddTo(backoffSeconds, (host, reason), seconds)
+
+# counts is {table: rows}
+def RecordRows(counts):
+    with metricsLock:
+        for table, count in counts.items():
+            AddTo(insertedRows, table, count)
+
+def SetProgress(task, done, total):
+    with metricsLock:
+        firstSeen = progress[task][2] if task in progress else time.time()
+        progress[task] = (min(done, total), total, firstSeen)
+
+def GetSnapshot():
+    with metricsLock:
+        return {
+            'startTime': startTime,
+            'time': time.time(),
+            'requests': [{'host': host, 'status': status, 'count': histogram.count, 'seconds': histogram.sum,
+                          'buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'], histogram.counts))}
+                         for (host, status), histogram in sorted(requestLatency.items())],
+            'receivedBytes': dict(receivedBytes),
+            'retries': dict(retryCounts),
+            'reconnects': dict(reconnectCounts),
+            'backoffSeconds': [{'host': host, 'reason': reason, 'seconds': seconds} for (host, reason), seconds in sorted(backoffSeconds.items())],
+            'insertedRows': dict(insertedRows),
+            'progress': {task: {'done': done, 'total': total} for task, (done, total, firstSeen) in progress.items()},
+        }
+
+def EscapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def FormatPrometheus(snapshot):
+    lines = ['# HELP anarchivist_request_duration_seconds How long requests took, from sending to having read the whole response',
+             '# TYPE anarchivist_request_duration_seconds histogram']
+    for entry in snapshot['requests']:
+        labels = 'host="%s",status="%s"' % (EscapeLabel(entry['host']), EscapeLabel(entry['status']))
+        cumulative = 0
+        for bound, count in entry['buckets'].items():
+            cumulative += count
+            lines.append('anarchivist_request_duration_seconds_bucket{%s,le="%s"} %d' % (labels, bound, cumulative))
+        lines.append('anarchivist_request_duration_seconds_sum{%s} %f' % (labels, entry['seconds']))
+        lines.append('anarchivist_request_duration_seconds_count{%s} %d' % (labels, entry['count']))
+
+    def AddCounter(name, help, values, labelName):
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s counter' % name)
+        for key, value in sorted(values.items()):
+            lines.append('%s{%s="%s"} %s' % (name, labelName, EscapeLabel(key), value))
+
+    AddCounter('anarchivist_received_bytes_total', 'Response bytes received', snapshot['receivedBytes'], 'host')
+    AddCounter('anarchivist_retries_total', 'Requests that were sent again', snapshot['retries'], 'host')
+    AddCounter('anarchivist_reconnects_total', 'Keep-alive connections that were dropped and replaced', snapshot['reconnects'], 'host')
+
+    lines.append('# HELP anarchivist_backoff_seconds_total Time spent waiting before sending requests')
+    lines.append('# TYPE anarchivist_backoff_seconds_total counter')
+    for entry in snapshot['backoffSeconds']:
+        lines.append('anarchivist_backoff_seconds_total{host="%s",reason="%s"} %f' % (EscapeLabel(entry['host']), entry['reason'], entry['seconds']))
+
+    AddCounter('anarchivist_inserted_rows_total', 'Rows inserted into the database', snapshot['insertedRows'], 'table')
+
+    lines.append('# HELP anarchivist_progress_ratio How far through each task the script is')
+    lines.append('# TYPE anarchivist_progress_ratio gauge')
+    for task, entry in sorted(snapshot['progress'].items()):
+        lines.append('anarchivist_progress_ratio{task="%s"} %f' % (EscapeLabel(task), entry['done'] / entry['total'] if entry['total'] > 0 else 1.0))
+    return '\n'.join(lines) + '\n'
+
+def FormatDuration(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+# Only counts the tasks that have reported progress so far, so it's optimistic while more are still starting up
+def GetETA():
+    with metricsLock:
+        if len(progress) == 0:
+            return None
+        done = sum(entry[0] for entry in progress.values())
+        total = sum(entry[1] for entry in progress.values())
+        since = min(entry[2] for entry in progress.values())
+    elapsed = time.time() - since
+    if done <= 0 or total <= 0 or elapsed <= 0:
+        return None
+    return done / total, (total - done) / (done / elapsed)
+
+def FormatProgressLine(snapshot):
+    elapsed = max(1e-6, snapshot['time'] - snapshot['startTime'])
+    requestCount = sum(entry['count'] for entry in snapshot['requests'])
+    errorCount = sum(entry['count'] for entry in snapshot['requests'] if not entry['status'].startswith('2') and entry['status'] != '304')
+    megabytes = sum(snapshot['receivedBytes'].values()) / (1024 * 1024)
+    # Summed over every thread that was waiting, so these can add up to more than the elapsed time
+    backoff = sum(entry['seconds'] for entry in snapshot['backoffSeconds'] if entry['reason'] != 'rate-limit')
+    rateLimited = sum(entry['seconds'] for entry in snapshot['backoffSeconds'] if entry['reason'] == 'rate-limit')
+    line = '[%s] %d requests (%.1f/s, %d failed), %.1f MB (%.2f MB/s), %d retries, %d reconnects, %.0fs backing off, %.0fs rate limited, %d rows' % (
+        FormatDuration(elapsed), requestCount, requestCount / elapsed, errorCount, megabytes, megabytes / elapsed,
+        sum(snapshot['retries'].values()), sum(snapshot['reconnects'].values()), backoff, rateLimited,
+        sum(snapshot['insertedRows'].values()))
+    eta = GetETA()
+    if eta is not None:
+        line += ', %.0f%% done, ETA %s' % (eta[0] * 100, FormatDuration(eta[1]))
+    return line
+
+def WriteFileAtomically(filename, text):
+    tempFilename = filename + '.tmp'
+    with open(tempFilename, 'w') as f:
+        f.write(text)
+    os.replace(tempFilename, filename)
+
+def WriteMetrics(filename, printProgress=True):
+    snapshot = GetSnapshot()
+    try:
+        WriteFileAtomically(filename, json.dumps(snapshot, indent=1))
+        WriteFileAtomically(os.path.splitext(filename)[0] + '.prom', FormatPrometheus(snapshot))
+    except OSError as e:
+        print('Could not write metrics to "%s": %s' % (filename, str(e)), file=sys.stderr)
+    if printProgress:
+        print(FormatProgressLine(snapshot), file=sys.stderr)
+
+# For the scripts: starts writing the metrics out if --metrics was passed
+def StartMetricsFromFlags(flags):
+    global metricsEnabled
+    if 'metrics' not in flags:
+        return
+    metricsEnabled = True
+    filename = flags['metrics'] if isinstance(flags['metrics'], str) else DEFAULT_METRICS_FILE
+    interval = max(1, GetIntFlag(flags, 'metrics-interval', METRICS_INTERVAL))
+
+    def ReportLoop():
+        while True:
+            time.sleep(interval)
+            WriteMetrics(filename)
+
+    threading.Thread(target=ReportLoop, name='Metrics', daemon=True).start()
+    atexit.register(WriteMetrics, filename)
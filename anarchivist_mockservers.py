@@ -0,0 +1,386 @@
+# Local stand-ins for Steam Community, Twitter and Twitch, for benchmarking the scripts without touching the real sites
+#
+# Each one serves synthetic pages shaped like the real ones, as far as the scripts' regexes and JSON lookups care:
+#  - SteamSite: screenshot listings (apphub_Card), guide/workshop listings and filedetails pages, discussion listings
+#    (forum_topic_overlay) and paged discussions, images under /ugc/. Detail pages carry an ETag and answer
+#    If-None-Match with a 304
+#  - TwitterSite: the /search page (with a guest_id cookie), adaptive.json timelines with cursors and since_id:, and
+#    photos/videos under /media/ and /v/. Like the real thing, /search hands back the guest_id the request already had
+#    (so a client sending a fixed cookie keeps getting the same token), and adaptive.json answers a token it never
+#    handed out with a 403 and error code 239
+#  - TwitchSite: /v5/videos/{id} (for the length) and /v5/videos/{id}/comments, by offset or _next cursor
+# Everything is generated from a seed, so every run serves the same thing.
+#
+# A MockServer runs a site on a local port (use anarchivist_http.OverrideHost to point a script at it), and makes it
+# misbehave the way real sites do, as set in a MockBehavior:
+#  - latency: seconds before every response (plus up to jitter more)
+#  - throttleRate: fraction of page requests answered with 429 (or 403 for Steam, like the real thing)
+#  - failureRate: fraction of requests answered with a 503, or with the connection dropped
+# It counts what it served (pages, media and their bytes, and what it injected) in MockServer.stats.
+#
+# Dependencies:
+#  - Python 3
+
+import re
+import json
+import time
+import base64
+import bisect
+import random
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+class MockBehavior:
+    def __init__(self, latency=0.02, jitter=0.0, throttleRate=0.0, failureRate=0.0, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttleRate = throttleRate
+        self.failureRate = failureRate
+        self.seed = seed
+
+# Returned by a site's Handle() for requests it doesn't know
+NOT_FOUND = (404, b'Not found', [])
+
+# Random (but repeatable) bytes standing in for image/video files
+def MakeMediaData(size, seed):
+    rng = random.Random(seed)
+    block = bytes(rng.getrandbits(8) for i in range(min(size, 64 * 1024)))
+    return (block * (size // len(block) + 1))[:size]
+
+# Markup that real pages are full of, so the pages are about the size of the real ones
+def MakeBoilerplate(size, seed):
+    rng = random.Random(seed)
+    words = ['responsive_page_frame', 'global_header', 'menuitem', 'supernav', 'data-tooltip-content', 'apphub_HeaderTop',
+             'responsive_local_menu', 'popup_block_new', 'ellipsis', 'rightcol', 'leftcol', 'maincontent', 'btn_medium']
+    parts = []
+    length = 0
+    while length < size:
+        part = '<div class="%s %s"><a href="https://store.steampowered.com/%s/">%s</a></div>\n' % (rng.choice(words), rng.choice(words), rng.choice(words), rng.choice(words))
+        parts.append(part)
+        length += len(part)
+    return ''.join(parts)
+
+def GetPageRange(itemCount, perPage, pageIdx):
+    return range(max(0, (pageIdx - 1) * perPage), min(itemCount, pageIdx * perPage))
+
+def GetQueryInt(query, name, default):
+    try:
+        return int(query[name][0])
+    except (KeyError, ValueError):
+        return default
+
+#--------------------------------------
+
+class SteamSite:
+    name = 'steam'
+    origins = ['steamcommunity.com', 'steamuserimages-a.akamaihd.net']
+    throttleStatus = 403
+
+    def __init__(self, scale=1, seed=1):
+        self.screenshotCount = 50 * scale
+        self.guideCount = 20 * scale
+        self.discussionCount = 16 * scale
+        self.workshopCount = 24 * scale
+        self.seed = seed
+        self.boilerplate = MakeBoilerplate(40 * 1024, seed)
+        self.imageData = MakeMediaData(150 * 1024, seed)
+
+    def IsMedia(self, path):
+        return path.startswith('/ugc/')
+
+    def GetReplyCount(self, discussionID):
+        return (discussionID * 7 + self.seed) % 60 + 1
+
+    def MakeScreenshotCard(self, i):
+        return ('<div class="apphub_Card modalContentLink interactable" style="" id="apphub_Card_%d">'
+                '<div class="apphub_CardContentMain"><img class="apphub_CardContentPreviewImage" src="x" '
+                'srcset="https://steamuserimages-a.akamaihd.net/ugc/S%d/LOW/ 480w, https://steamuserimages-a.akamaihd.net/ugc/S%d/HIGH/ 1920w">'
+                '<div class="apphub_CardContentTitle">Screenshot %d</div></div>'
+                '<div class="apphub_CardRating">%d</div>'
+                '<div class="apphub_CardContentAuthorName offline ellipsis"><a href="https://steamcommunity.com/id/user%d/">User %d</a></div></div>\n'
+                % (i, i, i, i, i % 97, i % 50, i % 50))
+
+    def MakeFileDetailsPage(self, itemID, images):
+        return ('<html>%s<div class="workshopItemTitle">Item %s</div>'
+                '<div class="friendBlockContent">Author %s<br><span class="friendSmallText">Offline</span></div>'
+                '<div class="detailsStatLeft">Posted</div><div class="detailsStatRight">3 Jan, 2019 @ 4:23pm</div>'
+                '<div class="fileRatingDetails"><img src="https://x/images/sharedfiles/4-star_large.png"></div>'
+                '<div class="numRatings">1,234 ratings</div>'
+                '<table class="stats_table"><tr><td>12,345</td><td>Unique Visitors</td></tr><tr><td>678</td><td>Current Subscribers</td></tr></table>'
+                '<div class="workshopItemDescription" id="highlightContent">Description of %s</div>%s</html>'
+                % (self.boilerplate, itemID, itemID, itemID, images))
+
+    def Handle(self, path, query, headers):
+        if path.startswith('/ugc/'):
+            return (200, self.imageData, [('Content-Type', 'image/jpeg')])
+
+        if path.endswith('/homecontent/'):
+            cards = ''.join(self.MakeScreenshotCard(i) for i in GetPageRange(self.screenshotCount, 10, GetQueryInt(query, 'p', 1)))
+            return (200, (self.boilerplate + cards).encode(), [])
+
+        if re.match(r'/app/\d+/guides/$', path):
+            links = ''.join('<div class="workshopItem"><a href="https://steamcommunity.com/sharedfiles/filedetails/?id=%d">Guide</a></div>\n' % (100000 + i)
+                            for i in GetPageRange(self.guideCount, 30, GetQueryInt(query, 'p', 1)))
+            return (200, (self.boilerplate + links).encode(), [])
+
+        if path == '/sharedfiles/filedetails/':
+            guideID = query.get('id', ['0'])[0]
+            images = ''.join('<a href="https://steamuserimages-a.akamaihd.net/ugc/G%s/X%d/" class="modalContentLink">' % (guideID, k) for k in range(2))
+            return self.Conditional(self.MakeFileDetailsPage(guideID, images), headers)
+
+        match = re.match(r'/sharedfiles/filedetails/(\d+)$', path)
+        if match:
+            itemID = match.group(1)
+            images = "<a onclick=\"ShowEnlargedImagePreview( 'https://steamuserimages-a.akamaihd.net/ugc/W%s/Y/' );\">" % itemID
+            return self.Conditional(self.MakeFileDetailsPage(itemID, images), headers)
+
+        if path == '/workshop/browse/':
+            links = ''.join('<a href="https://steamcommunity.com/sharedfiles/filedetails/?id=%d&searchtext="><div class="workshopItemTitle ellipsis">Item</div></a>\n' % (900000 + i)
+                            for i in GetPageRange(self.workshopCount, 30, GetQueryInt(query, 'p', 1)))
+            return (200, (self.boilerplate + links).encode(), [])
+
+        if re.match(r'/app/\d+/discussions/$', path):
+            links = ''.join('<a class="forum_topic_overlay" href="https://steamcommunity.com/app/1/discussions/0/%d/">\n' % (500000 + i)
+                            for i in GetPageRange(self.discussionCount, 15, GetQueryInt(query, 'fp', 1)))
+            return (200, (self.boilerplate + links).encode(), [])
+
+        match = re.match(r'/app/\d+/discussions/0/(\d+)/$', path)
+        if match:
+            discussionID = int(match.group(1))
+            replyCount = self.GetReplyCount(discussionID)
+            page = ('<div class="forum_op "><a class="hoverunderline forum_op_author" href="x">Poster</a>'
+                    '<span class="date" data-timestamp="1581234567">date</span><div class="topic">Topic %d</div><div class="content">Post</div></div>'
+                    '<span>1</span> of <span id="commentthread_ForumTopic_1_%d_pagetotal">%d</span> comments' % (discussionID, discussionID, replyCount))
+            for c in GetPageRange(replyCount, 15, GetQueryInt(query, 'ctp', 1)):
+                page += ('<div class="commentthread_comment responsive_body_text   " id="comment_%d%04d">'
+                         '<a class="hoverunderline commentthread_author_link" href="x"><bdi>Replier %d</bdi></a>'
+                         '<span class="commentthread_comment_timestamp" title="t" data-timestamp="%d">t</span>'
+                         '<div class="commentthread_comment_text" id="comment_content_%d">Reply number %d</div></div>\n'
+                         % (discussionID, c, c % 20, 1581234567 + c, c, c))
+            return (200, (self.boilerplate + page).encode(), [])
+
+        if re.match(r'/app/\d+$', path):
+            return (200, self.boilerplate.encode(), [])
+
+        return NOT_FOUND
+
+    def Conditional(self, page, headers):
+        data = page.encode()
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        if headers.get('If-None-Match') == etag:
+            return (304, b'', [('ETag', etag)])
+        return (200, data, [('ETag', etag)])
+
+#--------------------------------------
+
+class TwitterSite:
+    name = 'twitter'
+    origins = ['twitter.com', 'api.twitter.com', 'pbs.twimg.com', 'video.twimg.com']
+    throttleStatus = 429
+
+    def __init__(self, scale=1, seed=1):
+        self.tweetCount = 300 * scale
+        self.seed = seed
+        self.imageData = MakeMediaData(120 * 1024, seed)
+        self.videoData = MakeMediaData(1024 * 1024, seed + 1)
+        self.tokenCounter = 0
+        self.tokens = set()
+        self.lock = threading.Lock()
+
+    def IsMedia(self, path):
+        return path.startswith('/media/') or path.startswith('/v/')
+
+    def GetTweetID(self, i):
+        # Newest first, like the search
+        return 1300000000000000000 + (self.tweetCount - i) * 1000
+
+    def MakeTweet(self, username, i):
+        tweetID = str(self.GetTweetID(i))
+        tweet = {'id_str': tweetID, 'full_text': 'Tweet %d from @%s about something or other #%d' % (i, username, i % 13),
+                 'created_at': 'Mon Jan 01 00:00:00 +0000 2020', 'in_reply_to_status_id_str': None,
+                 'user_id_str': '12345', 'retweet_count': i % 7, 'favorite_count': i % 31, 'lang': 'en'}
+        if i % 4 == 0:
+            tweet['extended_entities'] = {'media': [{'type': 'photo', 'ext_alt_text': None, 'media_url_https': 'https://pbs.twimg.com/media/%s_%d.jpg' % (tweetID, k)} for k in range(2)]}
+        elif i % 25 == 1:
+            tweet['extended_entities'] = {'media': [{'type': 'video', 'ext_alt_text': None, 'video_info': {'variants': [
+                {'content_type': 'video/mp4', 'bitrate': 832000, 'url': 'https://video.twimg.com/v/%s.mp4' % tweetID},
+                {'content_type': 'video/mp4', 'bitrate': 256000, 'url': 'https://video.twimg.com/v/%s_low.mp4' % tweetID}]}}]}
+        return tweet
+
+    def Handle(self, path, query, headers):
+        if path == '/search':
+            match = re.search(r'guest_id=v1%3A([^;\s]+)', headers.get('Cookie') or '')
+            with self.lock:
+                if match:
+                    token = match.group(1)
+                else:
+                    self.tokenCounter += 1
+                    token = '%d%06d' % (self.seed, self.tokenCounter)
+                self.tokens.add(token)
+            return (200, b'<html></html>', [('Set-Cookie', 'guest_id=v1%%3A%s; Path=/' % token)])
+
+        if path == '/2/search/adaptive.json':
+            with self.lock:
+                if (headers.get('X-Guest-Token') or '').replace('v1:', '') not in self.tokens:
+                    return (403, json.dumps({'errors': [{'code': 239, 'message': 'Bad guest token.'}]}).encode(), [('Content-Type', 'application/json')])
+            searchQuery = query.get('q', [''])[0]
+            username = re.search(r'from:(\S+)', searchQuery).group(1) if 'from:' in searchQuery else 'someone'
+            sinceMatch = re.search(r'since_id:(\d+)', searchQuery)
+            cursor = query.get('cursor', ['0'])[0]
+            start = int(cursor) if cursor.isdigit() else 0
+            count = GetQueryInt(query, 'count', 20)
+
+            indices = [i for i in range(start, min(self.tweetCount, start + count))
+                       if sinceMatch is None or self.GetTweetID(i) > int(sinceMatch.group(1))]
+            tweets = [self.MakeTweet(username, i) for i in indices]
+            entries = [{'entryId': 'sq-I-t-%s' % tweet['id_str'], 'content': {'item': {'content': {'tweet': {'id': tweet['id_str']}}}}} for tweet in tweets]
+            entries.append({'entryId': 'sq-cursor-bottom', 'content': {'operation': {'cursor': {'value': str(start + len(tweets))}}}})
+            body = {'globalObjects': {'tweets': {tweet['id_str']: tweet for tweet in tweets}, 'users': {}},
+                    'timeline': {'instructions': [{'addEntries': {'entries': entries}}]}}
+            return (200, json.dumps(body).encode(), [('Content-Type', 'application/json')])
+
+        if path.startswith('/media/'):
+            return (200, self.imageData, [('Content-Type', 'image/jpeg')])
+        if path.startswith('/v/'):
+            return (200, self.videoData, [('Content-Type', 'video/mp4')])
+
+        return NOT_FOUND
+
+#--------------------------------------
+
+class TwitchSite:
+    name = 'twitch'
+    origins = ['api.twitch.tv']
+    throttleStatus = 429
+    commentsPerPage = 60
+
+    def __init__(self, scale=1, seed=1):
+        self.length = 3600 * scale
+        rng = random.Random(seed)
+        self.offsets = []
+        t = 0.0
+        while t < self.length:
+            # Every now and then, a burst of comments in the same second
+            burst = 60 if rng.random() < 0.01 else 1
+            for k in range(burst):
+                self.offsets.append(round(t + k * 0.001, 3))
+            t += rng.uniform(0.3, 3.0)
+
+    def IsMedia(self, path):
+        return False
+
+    def MakeComment(self, i):
+        commenter = i % 300
+        return {'_id': 'c%08d-mock' % i, 'content_offset_seconds': self.offsets[i], 'created_at': '2020-01-01T00:00:00Z',
+                'commenter': {'_id': str(10000 + commenter), 'name': 'user%d' % commenter, 'display_name': 'User%d' % commenter},
+                'message': {'body': 'message %d Kappa' % i, 'user_color': '#1E90FF',
+                            'fragments': [{'text': 'message %d ' % i}, {'text': 'Kappa', 'emoticon': {'emoticon_id': '25'}}],
+                            'user_badges': [{'_id': 'subscriber', 'version': '12'}]}}
+
+    def Handle(self, path, query, headers):
+        match = re.match(r'/v5/videos/(\d+)$', path)
+        if match:
+            return (200, json.dumps({'_id': 'v' + match.group(1), 'length': self.length}).encode(), [])
+
+        match = re.match(r'/v5/videos/(\d+)/comments$', path)
+        if match:
+            if 'cursor' in query:
+                start = int(base64.b64decode(query['cursor'][0]))
+            else:
+                start = bisect.bisect_left(self.offsets, float(query.get('content_offset_seconds', ['0'])[0]))
+            end = min(len(self.offsets), start + self.commentsPerPage)
+            body = {'comments': [self.MakeComment(i) for i in range(start, end)]}
+            if end < len(self.offsets):
+                body['_next'] = base64.b64encode(str(end).encode()).decode()
+            return (200, json.dumps(body).encode(), [('Content-Type', 'application/json')])
+
+        return NOT_FOUND
+
+SITES = {'steam': SteamSite, 'twitter': TwitterSite, 'twitch': TwitchSite}
+
+#--------------------------------------
+
+class MockServer:
+    def __init__(self, site, behavior=None):
+        self.site = site
+        self.behavior = behavior or MockBehavior()
+        self.rng = random.Random(self.behavior.seed)
+        self.lock = threading.Lock()
+        self.stats = {'pages': 0, 'pageBytes': 0, 'media': 0, 'mediaBytes': 0, 'notModified': 0,
+                      'throttled': 0, 'failed': 0, 'dropped': 0}
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.HandleRequest(self)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.address = '127.0.0.1:%d' % self.httpd.server_port
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='MockServer', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def Count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
+
+    def Roll(self):
+        with self.lock:
+            return self.rng.random()
+
+    def Send(self, handler, status, body, headers=()):
+        handler.send_response(status)
+        for name, value in headers:
+            handler.send_header(name, value)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def HandleRequest(self, handler):
+        behavior = self.behavior
+        delay = behavior.latency
+        if behavior.jitter > 0:
+            delay += self.Roll() * behavior.jitter
+        if delay > 0:
+            time.sleep(delay)
+
+        url = urlparse(handler.path)
+        isMedia = self.site.IsMedia(url.path)
+
+        if behavior.failureRate > 0 and self.Roll() < behavior.failureRate:
+            if self.Roll() < 0.5:
+                self.Count('dropped')
+                handler.close_connection = True
+                return
+            self.Count('failed')
+            return self.Send(handler, 503, b'Service Unavailable')
+
+        if not isMedia and behavior.throttleRate > 0 and self.Roll() < behavior.throttleRate:
+            self.Count('throttled')
+            return self.Send(handler, self.site.throttleStatus, b'Slow down', [('Retry-After', '1')])
+
+        status, body, headers = self.site.Handle(url.path, parse_qs(url.query), handler.headers)
+        if status == 304:
+            self.Count('notModified')
+        elif isMedia:
+            self.Count('media')
+            self.Count('mediaBytes', len(body))
+        else:
+            self.Count('pages')
+            self.Count('pageBytes', len(body))
+        self.Send(handler, status, body, headers)
@@ -0,0 +1,82 @@
+# Conditional requests for pages we've fetched before
+#
+# For every page that gets stored, the PageValidators table remembers the ETag and Last-Modified the server sent with it,
+# along with a hash of the body. The next time the page is crawled, the request carries If-None-Match/If-Modified-Since,
+# and if the server answers 304 (or sends back exactly the same bytes) the caller gets PAGE_UNCHANGED and can skip
+# parsing and storing it. Pages that did change come back as usual, and should replace what was stored before.
+#
+# Fetching is split from the database work so that the fetch can happen on another thread:
+#   validators = GetPageValidators(db, url)
+#   data, validators = FetchPageIfChanged(pool, url, validators)
+#   ...store data, unless it's None or PAGE_UNCHANGED...
+#   SavePageValidators(db, url, validators)
+# SavePageValidators doesn't commit, so it should go in the same transaction as the page, otherwise a crash
+# in between could leave us thinking we have a page we never stored.
+#
+# Only save the validators once everything that hangs off the page has been stored too (the rest of a discussion's
+# pages, a guide's images): the next crawl skips the whole thing if the page hasn't changed. If some of it couldn't be
+# fetched, call ClearPageValidators instead, so the next crawl does it all again.
+#
+# Dependencies:
+#  - Python 3
+#  - anarchivist_http.py from this repo (shared HTTP client)
+
+import time
+import hashlib
+
+from anarchivist_http import GetMessageWithRetries, NOT_MODIFIED
+
+class PageUnchanged:
+    pass
+
+PAGE_UNCHANGED = PageUnchanged()
+
+def CreatePageValidatorTable(db):
+    db.execute('CREATE TABLE IF NOT EXISTS PageValidators(url VARCHAR(255) PRIMARY KEY, etag TEXT, lastModified TEXT, contentHash VARCHAR(255), fetchedAt INTEGER);')
+    db.commit()
+
+def GetPageValidators(db, url):
+    row = db.execute('SELECT etag, lastModified, contentHash FROM PageValidators WHERE url = ?;', (url,)).fetchone()
+    if row is None:
+        return None
+    return {'etag': row[0], 'lastModified': row[1], 'contentHash': row[2]}
+
+def SavePageValidators(db, url, validators):
+    if validators is not None:
+        db.execute('INSERT OR REPLACE INTO PageValidators VALUES(?,?,?,?,?);', (url, validators['etag'], validators['lastModified'], validators['contentHash'], int(time.time())))
+
+def ClearPageValidators(db, url):
+    db.execute('DELETE FROM PageValidators WHERE url = ?;', (url,))
+
+def GetHeader(headers, name):
+    for headerName, headerVal in headers:
+        if headerName.lower() == name.lower():
+            return headerVal
+    return None
+
+# Returns (data, validators). data is None if the page couldn't be downloaded, PAGE_UNCHANGED if it's the same as last time
+def FetchPageIfChanged(pool, url, oldValidators, headersData={}):
+    headers = dict(headersData)
+    if oldValidators is not None:
+        if oldValidators['etag']:
+            headers['If-None-Match'] = oldValidators['etag']
+        if oldValidators['lastModified']:
+            headers['If-Modified-Since'] = oldValidators['lastModified']
+
+    outHeaders = []
+    data = GetMessageWithRetries(pool, url, headers, outHeaders=outHeaders)
+    if data is NOT_MODIFIED:
+        return (PAGE_UNCHANGED, oldValidators)
+    elif not isinstance(data, bytes):
+        return (None, None)
+
+    validators = {
+        'etag': GetHeader(outHeaders, 'ETag'),
+        'lastModified': GetHeader(outHeaders, 'Last-Modified'),
+        'contentHash': hashlib.sha256(data).hexdigest(),
+    }
+
+    if oldValidators is not None and oldValidators['contentHash'] == validators['contentHash']:
+        return (PAGE_UNCHANGED, validators)
+
+    return (data, validators)
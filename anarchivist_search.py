@@ -0,0 +1,169 @@
+# Full-text search over the archives, with sqlite's FTS5
+#
+# Each database gets an index for the text in it:
+#  - tweets.db: TweetSearch over TweetData.data (the tweet's text)
+#  - meta.db: ReplySearch over the text of DiscussionReplies (the HTML with the markup taken out)
+#  - vod_chat.db: ChatSearch over ChatMessages.body
+#
+# TweetSearch and ChatSearch are external content tables (they don't keep their own copy of the text) and are kept up
+# to date by triggers on the table they index, so nothing has to remember to update them, whatever writes the rows.
+# ReplySearch can't be done in SQL, since the text has to be pulled out of the HTML first, so it keeps its own copy and
+# dl_steam.py adds to it (IndexReplies) in the same transaction as the replies. Its rowid is the comment id.
+# An external content table is keyed on an INTEGER PRIMARY KEY of the table it indexes (TweetData.tweetID,
+# ChatMessages.messageRowID), never on an implicit rowid, which VACUUM is free to renumber. ChatSearch indexes from
+# before messageRowID existed are dropped and rebuilt by CreateChatSearchIndex (call it after CreateChatMessageTable).
+#
+# Search(db, query, limit) looks through whichever indexes the database has and returns the best matches first, as
+# SearchHit(source, key, context, snippet, score). The query is FTS5 syntax: words, "exact phrases", AND/OR/NOT, prefix*.
+#
+# Databases from before the indexes existed can be brought up to date with build_search_index.py.
+#
+# If the sqlite Python was built with doesn't have FTS5, the scripts carry on without the indexes.
+#
+# Dependencies:
+#  - Python 3 (with FTS5 in its sqlite, which it has had for a long time on most platforms)
+#  - anarchivist_html.py from this repo
+
+import sys
+import sqlite3
+from collections import namedtuple
+
+from anarchivist_html import GetSteamReplyText
+
+SearchHit = namedtuple('SearchHit', ['source', 'key', 'context', 'snippet', 'score'])
+
+SEARCH_TOKENIZER = 'unicode61 remove_diacritics 2'
+
+# How many words of context snippets show around the match
+SNIPPET_WORDS = 16
+
+REINDEX_BATCH_SIZE = 1000
+
+def GetTables(db):
+    return set(row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view');"))
+
+# The databases that have a ReplySearch index, so IndexReplies knows whether there's anything to do
+replyIndexDBs = set()
+
+# Runs the statements that set up an index, or says why it can't and returns False
+def CreateIndex(db, name, sourceTable, statements, warnIfBehind=True):
+    existed = name in GetTables(db)
+    try:
+        for statement in statements:
+            db.execute(statement)
+        db.commit()
+    except sqlite3.OperationalError as e:
+        print('Could not set up the "%s" search index (%s), carrying on without it' % (name, str(e)), file=sys.stderr)
+        return False
+
+    if warnIfBehind and not existed and db.execute('SELECT 1 FROM %s LIMIT 1;' % sourceTable).fetchone() is not None:
+        print('New search index "%s" only covers rows added from now on, run build_search_index.py to add the rest' % name)
+    return True
+
+def CreateTweetSearchIndex(db, warnIfBehind=True):
+    return CreateIndex(db, 'TweetSearch', 'TweetData', [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS TweetSearch USING fts5(data, content='TweetData', content_rowid='tweetID', tokenize='%s');" % SEARCH_TOKENIZER,
+        'CREATE TRIGGER IF NOT EXISTS TweetSearchInsert AFTER INSERT ON TweetData BEGIN INSERT INTO TweetSearch(rowid, data) VALUES(new.tweetID, new.data); END;',
+        "CREATE TRIGGER IF NOT EXISTS TweetSearchDelete AFTER DELETE ON TweetData BEGIN INSERT INTO TweetSearch(TweetSearch, rowid, data) VALUES('delete', old.tweetID, old.data); END;",
+        "CREATE TRIGGER IF NOT EXISTS TweetSearchUpdate AFTER UPDATE OF data ON TweetData BEGIN INSERT INTO TweetSearch(TweetSearch, rowid, data) VALUES('delete', old.tweetID, old.data); INSERT INTO TweetSearch(rowid, data) VALUES(new.tweetID, new.data); END;",
+    ], warnIfBehind)
+
+def CreateChatSearchIndex(db, warnIfBehind=True):
+    row = db.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'ChatSearch';").fetchone()
+    if row is not None and "content_rowid='messageRowID'" not in row[0]:
+        print('Rebuilding the ChatSearch index on ChatMessages.messageRowID...')
+        for trigger in ('ChatSearchInsert', 'ChatSearchDelete', 'ChatSearchUpdate'):
+            db.execute('DROP TRIGGER IF EXISTS %s;' % trigger)
+        db.execute('DROP TABLE ChatSearch;')
+        if not CreateChatSearchIndex(db, False):
+            return False
+        db.execute("INSERT INTO ChatSearch(ChatSearch) VALUES('rebuild');")
+        db.commit()
+        return True
+
+    return CreateIndex(db, 'ChatSearch', 'ChatMessages', [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS ChatSearch USING fts5(body, content='ChatMessages', content_rowid='messageRowID', tokenize='%s');" % SEARCH_TOKENIZER,
+        'CREATE TRIGGER IF NOT EXISTS ChatSearchInsert AFTER INSERT ON ChatMessages BEGIN INSERT INTO ChatSearch(rowid, body) VALUES(new.messageRowID, new.body); END;',
+        "CREATE TRIGGER IF NOT EXISTS ChatSearchDelete AFTER DELETE ON ChatMessages BEGIN INSERT INTO ChatSearch(ChatSearch, rowid, body) VALUES('delete', old.messageRowID, old.body); END;",
+        "CREATE TRIGGER IF NOT EXISTS ChatSearchUpdate AFTER UPDATE OF body ON ChatMessages BEGIN INSERT INTO ChatSearch(ChatSearch, rowid, body) VALUES('delete', old.messageRowID, old.body); INSERT INTO ChatSearch(rowid, body) VALUES(new.messageRowID, new.body); END;",
+    ], warnIfBehind)
+
+def CreateReplySearchIndex(db, warnIfBehind=True):
+    if not CreateIndex(db, 'ReplySearch', 'DiscussionReplies', [
+            "CREATE VIRTUAL TABLE IF NOT EXISTS ReplySearch USING fts5(body, discussionID UNINDEXED, tokenize='%s');" % SEARCH_TOKENIZER], warnIfBehind):
+        return False
+    replyIndexDBs.add(db)
+    return True
+
+# replies are (commentID, discussionID, contents) rows, as they go into DiscussionReplies. Doesn't commit
+def IndexReplies(db, replies):
+    if db not in replyIndexDBs:
+        return
+    rows = []
+    for commentID, discussionID, contents in replies:
+        # Steam's comment ids are numbers, which is what lets them be the rowid
+        if not commentID.isdigit():
+            continue
+        body = GetSteamReplyText(contents)
+        if body:
+            rows.append((int(commentID), body, discussionID))
+    db.executemany('INSERT OR REPLACE INTO ReplySearch(rowid, body, discussionID) VALUES(?,?,?);', rows)
+
+# Fills the indexes in for everything already in the database. Returns {index name: rows indexed}
+def RebuildSearchIndexes(db):
+    tables = GetTables(db)
+    counts = {}
+
+    if 'TweetData' in tables and CreateTweetSearchIndex(db, False):
+        db.execute("INSERT INTO TweetSearch(TweetSearch) VALUES('rebuild');")
+        db.commit()
+        counts['TweetSearch'] = db.execute('SELECT COUNT(*) FROM TweetData;').fetchone()[0]
+
+    if 'ChatMessages' in tables and CreateChatSearchIndex(db, False):
+        db.execute("INSERT INTO ChatSearch(ChatSearch) VALUES('rebuild');")
+        db.commit()
+        counts['ChatSearch'] = db.execute('SELECT COUNT(*) FROM ChatMessages;').fetchone()[0]
+
+    if 'DiscussionReplies' in tables and CreateReplySearchIndex(db, False):
+        db.execute('DELETE FROM ReplySearch;')
+        indexedCount = 0
+        lastRowID = 0
+        while True:
+            rows = db.execute('SELECT rowid, commentID, discussionID, contents FROM DiscussionReplies WHERE rowid > ? ORDER BY rowid LIMIT ?;', (lastRowID, REINDEX_BATCH_SIZE)).fetchall()
+            if len(rows) == 0:
+                break
+            lastRowID = rows[-1][0]
+            IndexReplies(db, [row[1:] for row in rows])
+            db.commit()
+            indexedCount += len(rows)
+        counts['ReplySearch'] = indexedCount
+
+    return counts
+
+def FormatOffset(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+def SearchTweets(db, query, limit):
+    cursor = db.execute("SELECT t.tweetID, t.username, t.timestamp, snippet(TweetSearch, 0, '[', ']', '...', ?), bm25(TweetSearch) FROM TweetSearch JOIN TweetData t ON t.tweetID = TweetSearch.rowid WHERE TweetSearch MATCH ? ORDER BY bm25(TweetSearch) LIMIT ?;", (SNIPPET_WORDS, query, limit))
+    return [SearchHit('tweet', str(tweetID), '@%s, %s' % (username, timestamp), snippet, score) for tweetID, username, timestamp, snippet, score in cursor]
+
+def SearchChat(db, query, limit):
+    cursor = db.execute("SELECT m.id, m.vodID, m.offsetSec, COALESCE(m.commenterDisplayName, m.commenterName), snippet(ChatSearch, 0, '[', ']', '...', ?), bm25(ChatSearch) FROM ChatSearch JOIN ChatMessages m ON m.messageRowID = ChatSearch.rowid WHERE ChatSearch MATCH ? ORDER BY bm25(ChatSearch) LIMIT ?;", (SNIPPET_WORDS, query, limit))
+    return [SearchHit('chat', id, 'vod %s at %s, %s' % (vodID, FormatOffset(offsetSec), commenter), snippet, score) for id, vodID, offsetSec, commenter, snippet, score in cursor]
+
+def SearchReplies(db, query, limit):
+    cursor = db.execute("SELECT rowid, discussionID, snippet(ReplySearch, 0, '[', ']', '...', ?), bm25(ReplySearch) FROM ReplySearch WHERE ReplySearch MATCH ? ORDER BY bm25(ReplySearch) LIMIT ?;", (SNIPPET_WORDS, query, limit))
+    return [SearchHit('reply', str(commentID), 'discussion %s' % discussionID, snippet, score) for commentID, discussionID, snippet, score in cursor]
+
+SEARCHERS = [('TweetSearch', SearchTweets), ('ChatSearch', SearchChat), ('ReplySearch', SearchReplies)]
+
+# The best limit hits from all of the database's indexes, best first. bm25 scores are lower for better matches
+def Search(db, query, limit=20):
+    tables = GetTables(db)
+    hits = []
+    for indexName, searcher in SEARCHERS:
+        if indexName in tables:
+            hits.extend(searcher(db, query, limit))
+    hits.sort(key=lambda hit: hit.score)
+    return hits[:limit]
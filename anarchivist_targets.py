@@ -0,0 +1,67 @@
+# Running a script's targets (app ids, usernames, VOD ids) in parallel
+#
+# With --parallel=N, up to N targets are crawled at once on their own threads, so one slow target doesn't hold up the
+# rest of the batch. They share the process's connection pools and rate limiters from anarchivist_http.py, so the
+# number of connections to (and the request rate against) each host stays the same however many targets are running:
+# that's the budget they all draw from. Without --parallel, targets are crawled one after another like before.
+#
+# A target that raises is reported and the others carry on; the ones that failed are listed at the end.
+# Each target is a span in the --trace output, and is profiled on its own with --profile (see anarchivist_trace.py).
+# Profiles can't overlap, so --profile runs the targets one after another, whatever --parallel says.
+#
+# Dependencies:
+#  - Python 3
+#  - anarchivist_args.py and anarchivist_trace.py from this repo
+
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from anarchivist_args import GetIntFlag
+from anarchivist_trace import RunTargetTraced, IsProfiling
+
+def GetParallelTargetCount(flags):
+    return max(1, GetIntFlag(flags, 'parallel', 1))
+
+# Calls runTarget(target) for every target, parallelCount at a time. Returns the targets that raised
+def RunTargets(targets, runTarget, parallelCount=1):
+    failed = []
+    failedLock = threading.Lock()
+
+    def RunOne(target):
+        try:
+            RunTargetTraced(target, runTarget)
+        except Exception as e:
+            traceback.print_exc()
+            print('Error crawling "%s": "%s"' % (target, str(e)), file=sys.stderr)
+            with failedLock:
+                failed.append(target)
+
+    if parallelCount > 1 and IsProfiling():
+        print('--profile can only profile one target at a time, so they are run one after another instead of %d at once' % parallelCount, file=sys.stderr)
+        parallelCount = 1
+
+    if parallelCount <= 1 or len(targets) <= 1:
+        for target in targets:
+            RunOne(target)
+    else:
+        executor = ThreadPoolExecutor(min(parallelCount, len(targets)), thread_name_prefix='Target')
+        futures = [executor.submit(RunOne, target) for target in targets]
+        try:
+            for future in futures:
+                future.result()
+        except KeyboardInterrupt:
+            # Threads can't be interrupted, so the targets that are running get to finish, but no new ones are started
+            # (cancelling by hand, shutdown(cancel_futures=True) needs Python 3.9)
+            print('Interrupted, waiting for the targets that are running to finish...', file=sys.stderr)
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+            raise
+        executor.shutdown()
+
+    if len(failed) > 0:
+        print('%d of %d targets failed: %s' % (len(failed), len(targets), ', '.join(failed)), file=sys.stderr)
+
+    return failed
@@ -0,0 +1,159 @@
+# Opt-in tracing and profiling, for finding out where a slow run is actually spending its time
+#
+# With --trace[=FILE] (StartTracingFromFlags), the stages of a crawl are timed as spans and written to FILE (default
+# trace.json) in Chrome's trace event format, which chrome://tracing, https://ui.perfetto.dev and speedscope can open.
+# Each thread gets its own row, so the media workers, the discussion page pool, --parallel targets and the DBWriter's
+# writer thread can all be seen side by side. Spans are grouped into categories:
+#  - target: one whole app/user/VOD (anarchivist_targets.py)
+#  - fetch: GetMessageWithRetries and DownloadToFile, waiting on the rate limiter included
+#  - decode: gzip/deflate, and turning the bytes into text
+#  - parse: the regex/split/JSON passes over a page
+#  - db: the DBWriter's batch writes, and commits (which only block if the writer has fallen behind)
+#  - fs: mkdir, exists checks and file writes
+#
+# Spans are added with
+#   with Span('name', 'category', url=url):   # keyword arguments show up in the trace viewer
+# or by decorating a function with @Traced('name', 'category'). Neither does anything beyond checking a flag unless
+# tracing is on. Spans have to open and close on the same thread, so don't hold one across an await.
+#
+# The events are streamed to the file as they pile up, so a long run doesn't keep them all in memory, and the file
+# can be opened even if the run was killed (the viewers don't need the closing bracket).
+#
+# With --profile[=DIR], each target is also run under cProfile, and its stats are saved to "DIR/{target}.prof"
+# (default directory: profiles), for pstats, snakeviz or similar. Only the target's own thread is profiled, so the
+# work that happens on pools (media downloads, discussion pages) shows up in the trace but not the profile.
+# Only one cProfile profiler can be running at a time (Python 3.12 raises otherwise), so with --profile the targets are
+# run one after another, even with --parallel (see anarchivist_targets.py).
+#
+# Dependencies:
+#  - Python 3
+
+import os
+import sys
+import json
+import time
+import atexit
+import cProfile
+import threading
+import functools
+
+DEFAULT_TRACE_FILE = 'trace.json'
+DEFAULT_PROFILE_DIRECTORY = 'profiles'
+
+# Events are written out once this many have piled up (and when the script exits)
+TRACE_FLUSH_EVENTS = 10000
+
+tracingEnabled = False
+profileDirectory = None
+
+traceLock = threading.Lock()
+traceFile = None
+traceEvents = []
+traceStart = time.perf_counter()
+# Thread ids we've written a name for
+namedThreads = set()
+
+def GetTimestamp():
+    return (time.perf_counter() - traceStart) * 1e6
+
+# Call with traceLock held
+def FlushEvents():
+    global traceEvents
+    if traceFile is None or len(traceEvents) == 0:
+        return
+    traceFile.write(''.join(json.dumps(event) + ',\n' for event in traceEvents))
+    traceFile.flush()
+    traceEvents = []
+
+def AddEvent(event):
+    with traceLock:
+        tid = event['tid']
+        if tid not in namedThreads:
+            namedThreads.add(tid)
+            traceEvents.append({'name': 'thread_name', 'ph': 'M', 'pid': event['pid'], 'tid': tid, 'args': {'name': threading.current_thread().name}})
+        traceEvents.append(event)
+        if len(traceEvents) >= TRACE_FLUSH_EVENTS:
+            FlushEvents()
+
+class Span:
+    def __init__(self, name, category, **args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        if tracingEnabled:
+            self.start = GetTimestamp()
+        return self
+
+    # For adding arguments that are only known once the span is underway (a status, a row count)
+    def Set(self, name, value):
+        self.args[name] = value
+
+    def __exit__(self, excType, excValue, traceback):
+        if tracingEnabled and hasattr(self, 'start'):
+            event = {'name': self.name, 'cat': self.category, 'ph': 'X', 'ts': self.start, 'dur': GetTimestamp() - self.start,
+                     'pid': os.getpid(), 'tid': threading.get_ident()}
+            if excType is not None:
+                self.args['exception'] = excType.__name__
+            if len(self.args) > 0:
+                event['args'] = {name: str(value) for name, value in self.args.items()}
+            AddEvent(event)
+        return False
+
+def Traced(name, category):
+    def Decorate(func):
+        @functools.wraps(func)
+        def Wrapper(*args, **kwargs):
+            if not tracingEnabled:
+                return func(*args, **kwargs)
+            with Span(name, category):
+                return func(*args, **kwargs)
+        return Wrapper
+    return Decorate
+
+def FinishTrace():
+    global tracingEnabled, traceFile
+    with traceLock:
+        if traceFile is None:
+            return
+        FlushEvents()
+        # Something for the last comma to come before
+        traceFile.write(json.dumps({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': os.path.basename(sys.argv[0])}}) + '\n]\n')
+        traceFile.close()
+        traceFile = None
+        tracingEnabled = False
+
+def IsProfiling():
+    return profileDirectory is not None
+
+# Runs runTarget(target) as a span, and under cProfile if --profile is on
+def RunTargetTraced(target, runTarget):
+    with Span('target %s' % target, 'target'):
+        if profileDirectory is None:
+            return runTarget(target)
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return runTarget(target)
+        finally:
+            profile.disable()
+            filename = os.path.join(profileDirectory, '%s.prof' % str(target).replace('/', '_'))
+            profile.dump_stats(filename)
+            print('Saved the profile for "%s" to "%s"' % (target, filename))
+
+# For the scripts: turns tracing and profiling on if --trace/--profile were passed
+def StartTracingFromFlags(flags):
+    global tracingEnabled, profileDirectory, traceFile
+    if 'trace' in flags:
+        filename = flags['trace'] if isinstance(flags['trace'], str) else DEFAULT_TRACE_FILE
+        traceFile = open(filename, 'w')
+        traceFile.write('[\n')
+        tracingEnabled = True
+        atexit.register(FinishTrace)
+        print('Writing a trace to "%s"' % filename)
+
+    if 'profile' in flags:
+        profileDirectory = flags['profile'] if isinstance(flags['profile'], str) else DEFAULT_PROFILE_DIRECTORY
+        os.makedirs(profileDirectory, exist_ok=True)
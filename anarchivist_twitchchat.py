@@ -0,0 +1,132 @@
+# Twitch chat in plain columns, for replaying a stretch of a VOD
+#
+# ChatData keeps every comment exactly as the API sent it (the JSON, inline in the row), which is what we want for
+# archiving, but means reading any part of a VOD's chat has to decode the JSON of all of it. So ChatMessages is an extra
+# index on top of ChatData, not a replacement for it: the fields people actually look at are copied into it, one row per
+# comment, indexed by (vodID, offsetSec). ChatData stays the record of what was archived (it has everything the API sent,
+# and ChatMessages can always be rebuilt from it), so those fields are stored twice, on purpose:
+#  - messageRowID: an INTEGER PRIMARY KEY, which is what the ChatSearch full-text index points at (see
+#    anarchivist_search.py). It has to be a real column: an implicit rowid can be renumbered by VACUUM
+#  - id (the comment's UUID, unique), vodID, offsetSec (content_offset_seconds, as a float)
+#  - commenterID, commenterName, commenterDisplayName
+#  - body, userColor
+#  - emotes: where the emotes are in the body, in the same format as Twitch's IRC tags: "25:0-4,12-16/1902:6-10"
+#
+# ReplayChat(db, vodID, startSec, endSec) goes through the messages in a window in order, without loading the rest.
+# BackfillChatMessages fills the table in from ChatData, for VODs downloaded before it existed.
+# Tables from before messageRowID existed are copied into the new layout by CreateChatMessageTable, keeping their rowids.
+#
+# Dependencies:
+#  - Python 3
+#  - anarchivist_blobstore.py from this repo
+
+import json
+
+from anarchivist_blobstore import ReadStoredText
+
+# The order of the columns in what ReplayChat yields
+CHAT_MESSAGE_COLUMNS = ('id', 'offsetSec', 'commenterID', 'commenterName', 'commenterDisplayName', 'body', 'userColor', 'emotes')
+
+BACKFILL_BATCH_SIZE = 1000
+
+CHAT_MESSAGE_TABLE_COLUMNS = 'messageRowID INTEGER PRIMARY KEY, id VARCHAR(255) UNIQUE NOT NULL, vodID VARCHAR(255), offsetSec REAL, commenterID VARCHAR(255), commenterName VARCHAR(255), commenterDisplayName VARCHAR(255), body TEXT, userColor VARCHAR(16), emotes TEXT'
+
+# What GetChatMessageRow fills in (messageRowID is picked by sqlite)
+INSERT_CHAT_MESSAGE = 'INSERT OR IGNORE INTO ChatMessages(id, vodID, offsetSec, commenterID, commenterName, commenterDisplayName, body, userColor, emotes) VALUES(?,?,?,?,?,?,?,?,?);'
+
+def GetTableNames(db):
+    return set(row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table';"))
+
+def GetColumnNames(db, table):
+    return [row[1] for row in db.execute('PRAGMA table_info(%s);' % table)]
+
+# Moves a ChatMessages table from before messageRowID into the new layout. The old rowids become the messageRowIDs, so
+# a ChatSearch index built on them still lines up (it gets rebuilt anyway, see CreateChatSearchIndex)
+def MigrateChatMessageTable(db):
+    tables = GetTableNames(db)
+    if 'ChatMessagesNew' in tables:
+        if 'ChatMessages' not in tables:
+            # Killed after dropping the old table: the copy is complete
+            db.execute('ALTER TABLE ChatMessagesNew RENAME TO ChatMessages;')
+            return
+        # Killed partway through the copy
+        db.execute('DROP TABLE ChatMessagesNew;')
+    if 'ChatMessages' not in tables or 'messageRowID' in GetColumnNames(db, 'ChatMessages'):
+        return
+
+    print('Moving ChatMessages to the new layout...')
+    db.execute('CREATE TABLE ChatMessagesNew(%s);' % CHAT_MESSAGE_TABLE_COLUMNS)
+    db.execute('INSERT INTO ChatMessagesNew SELECT rowid, id, vodID, offsetSec, commenterID, commenterName, commenterDisplayName, body, userColor, emotes FROM ChatMessages;')
+    db.commit()
+    db.execute('DROP TABLE ChatMessages;')
+    db.execute('ALTER TABLE ChatMessagesNew RENAME TO ChatMessages;')
+
+def CreateChatMessageTable(db):
+    MigrateChatMessageTable(db)
+    db.execute('CREATE TABLE IF NOT EXISTS ChatMessages(%s);' % CHAT_MESSAGE_TABLE_COLUMNS)
+    db.execute('CREATE INDEX IF NOT EXISTS ChatMessagesVodOffset ON ChatMessages(vodID, offsetSec);')
+    db.commit()
+
+# Builds the IRC-style emote tag from the message's fragments, with positions counted in characters of the body
+def GetEmoteTag(fragments):
+    positions = {}
+    order = []
+    position = 0
+    for fragment in fragments:
+        text = fragment.get('text') or ''
+        emoticon = fragment.get('emoticon')
+        if emoticon is not None and len(text) > 0:
+            emoteID = str(emoticon.get('emoticon_id'))
+            if emoteID not in positions:
+                positions[emoteID] = []
+                order.append(emoteID)
+            positions[emoteID].append('%d-%d' % (position, position + len(text) - 1))
+        position += len(text)
+
+    if len(order) == 0:
+        return None
+    return '/'.join('%s:%s' % (emoteID, ','.join(positions[emoteID])) for emoteID in order)
+
+def GetChatMessageRow(vodID, comment):
+    commenter = comment.get('commenter') or {}
+    message = comment.get('message') or {}
+    return (comment['_id'], vodID, float(comment['content_offset_seconds']),
+            commenter.get('_id'), commenter.get('name'), commenter.get('display_name'),
+            message.get('body'), message.get('user_color'), GetEmoteTag(message.get('fragments') or []))
+
+# Doesn't commit: call it in the same transaction as the ChatData row
+def StoreChatMessage(db, vodID, comment):
+    db.execute(INSERT_CHAT_MESSAGE, GetChatMessageRow(vodID, comment))
+
+# Yields (id, offsetSec, commenterID, commenterName, commenterDisplayName, body, userColor, emotes) for every message
+# from startSec up to (not including) endSec, in order. endSec=None goes to the end of the VOD
+def ReplayChat(db, vodID, startSec=0, endSec=None):
+    if endSec is None:
+        endSec = float('inf')
+    cursor = db.execute('SELECT id, offsetSec, commenterID, commenterName, commenterDisplayName, body, userColor, emotes FROM ChatMessages WHERE vodID = ? AND offsetSec >= ? AND offsetSec < ? ORDER BY offsetSec;', (vodID, startSec, endSec))
+    for row in cursor:
+        yield row
+
+def HasChatMessages(db, vodID):
+    return db.execute('SELECT 1 FROM ChatMessages WHERE vodID = ? LIMIT 1;', (vodID,)).fetchone() is not None
+
+# Fills ChatMessages in from ChatData for the comments that aren't in it yet (just for vodID, if it's given).
+# Commits as it goes. Returns how many messages were added
+def BackfillChatMessages(db, vodID=None):
+    query = 'SELECT c.id FROM ChatData c LEFT JOIN ChatMessages m ON m.id = c.id WHERE m.id IS NULL'
+    params = ()
+    if vodID is not None:
+        query += ' AND c.vodID = ?'
+        params = (vodID,)
+
+    # Just the ids up front, so we're not writing to tables we're in the middle of reading
+    missingIDs = [row[0] for row in db.execute(query + ';', params)]
+    for i in range(0, len(missingIDs), BACKFILL_BATCH_SIZE):
+        batchIDs = missingIDs[i:i + BACKFILL_BATCH_SIZE]
+        rows = []
+        for commentVodID, data, dataBlob in db.execute('SELECT vodID, data, dataBlob FROM ChatData WHERE id IN (%s);' % ','.join('?' * len(batchIDs)), batchIDs).fetchall():
+            rows.append(GetChatMessageRow(commentVodID, json.loads(ReadStoredText(db, data, dataBlob))))
+        db.executemany(INSERT_CHAT_MESSAGE, rows)
+        db.commit()
+
+    return len(missingIDs)
@@ -0,0 +1,329 @@
+# WARC output: every response the scripts get, exactly as the server sent it, in standard web archive files
+#
+# The databases and the media folders only keep what the scripts picked out of each response, with no record of the
+# headers or of when it was fetched. With --warc, every request and response that goes through anarchivist_http.py
+# (pages, API JSON, images, videos, and the errors and throttles in between) is also appended to WARC files:
+#  - Each record is its own gzip member, so a record can be read on its own by seeking to its offset
+#  - Files are only ever appended to, and a new one is started once the current one passes WARC_MAX_FILE_SIZE
+#    ("{prefix}-{time}-{serial}.warc.gz", each starting with a warcinfo record)
+#  - Each response record is preceded by the request that got it (WARC-Concurrent-To links the two)
+#
+# Every WARC file gets a CDX index next to it ("{same name}.cdx", the usual 11 column " CDX N b a m s k r M S V g"
+# format, sorted by SURT key then timestamp), which is what replay tools (pywb, OpenWayback) look records up by.
+# FindCaptures(directory, url) does the same lookup here, with a binary search through each index, and ReadCapture()
+# pulls the record back out; warc_lookup.py does both from the command line. While a file is being written its index
+# lines go (unsorted) into "{name}.cdx.open", and are sorted into the .cdx when the file is finished. Lookups only read:
+# they scan the .cdx.open files as they are (so the captures of a crawl that's still running show up too), and never
+# finish them, since there's no telling from here whether a run is still writing one. If a run dies before finishing
+# its files, FinishOpenIndexes() sorts the leftovers (warc_lookup.py --repair), once nothing is writing to the directory.
+#
+# Caveats:
+#  - http.client takes chunked transfer encoding off before we see the body, so the Transfer-Encoding header is left
+#    out of recorded responses (the body is recorded as it came, still gzipped if it was)
+#  - A download resumed with a Range request is recorded as the 206 responses it actually took
+#
+# Dependencies:
+#  - Python 3
+#  - anarchivist_http.py and anarchivist_args.py from this repo
+
+import os
+import sys
+import time
+import zlib
+import uuid
+import base64
+import atexit
+import hashlib
+import threading
+from collections import namedtuple
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+import anarchivist_http
+from anarchivist_args import GetIntFlag
+
+WARC_VERSION = 'WARC/1.0'
+
+WARC_MAX_FILE_SIZE = 1024 * 1024 * 1024
+
+WARC_COMPRESSION_LEVEL = 6
+
+DEFAULT_WARC_DIRECTORY = 'warc'
+
+# Bodies bigger than this (media) are compressed straight from their file into the WARC, instead of in memory
+WARC_READ_CHUNK_SIZE = 1024 * 1024
+
+CDX_HEADER = b' CDX N b a m s k r M S V g\n'
+
+CDXEntry = namedtuple('CDXEntry', ['key', 'timestamp', 'url', 'mimeType', 'status', 'digest', 'length', 'offset', 'filename'])
+
+# Responses come with these taken off already (see the caveats above)
+STRIPPED_RESPONSE_HEADERS = ('transfer-encoding',)
+
+def GetWARCDate(when):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(when))
+
+def GetCDXTimestamp(when):
+    return time.strftime('%Y%m%d%H%M%S', time.gmtime(when))
+
+def GetDigest(hasher):
+    return 'sha1:' + base64.b32encode(hasher.digest()).decode('ascii')
+
+# The sort-friendly form of a URL that CDX indexes are keyed on: "https://www.Example.com/a?b=2&a=1" -> "com,example)/a?a=1&b=2"
+def GetSURT(url):
+    parts = urlsplit(url)
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    key = ','.join(reversed(host.split('.'))) + ')' + (parts.path or '/').lower()
+    if parts.query:
+        key += '?' + urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True))).lower()
+    return key
+
+def GetRecordHeader(fields, blockLength):
+    lines = [WARC_VERSION] + ['%s: %s' % (name, value) for name, value in fields] + ['Content-Length: %d' % blockLength]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8')
+
+def GetRequestBlock(method, url, headers, postData):
+    parts = urlsplit(url)
+    target = parts.path or '/'
+    if parts.query:
+        target += '?' + parts.query
+    lines = ['%s %s HTTP/1.1' % (method, target), 'Host: %s' % parts.netloc]
+    lines += ['%s: %s' % (name, value) for name, value in headers.items()]
+    block = ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8')
+    if postData is not None:
+        block += postData if isinstance(postData, bytes) else postData.encode('utf-8')
+    return block
+
+def GetResponseHeaderBlock(res):
+    lines = ['HTTP/%s %d %s' % ('1.0' if res.version == 10 else '1.1', res.status, res.reason)]
+    lines += ['%s: %s' % (name, value) for name, value in res.getheaders() if name.lower() not in STRIPPED_RESPONSE_HEADERS]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1', 'replace')
+
+def ReadFileRange(filename, offset, length):
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            chunk = f.read(min(WARC_READ_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+class WARCWriter:
+    def __init__(self, directory, prefix, maxFileSize=WARC_MAX_FILE_SIZE):
+        self.directory = directory
+        self.prefix = prefix
+        self.maxFileSize = maxFileSize
+        self.lock = threading.Lock()
+        self.file = None
+        self.filename = None
+        self.indexFile = None
+        self.serial = 0
+        self.recordCount = 0
+        os.makedirs(directory, exist_ok=True)
+        atexit.register(self.close)
+
+    # Call with self.lock held
+    def OpenFile(self):
+        while True:
+            self.filename = '%s-%s-%05d.warc.gz' % (self.prefix, GetCDXTimestamp(time.time()), self.serial)
+            self.serial += 1
+            if not os.path.exists(os.path.join(self.directory, self.filename)):
+                break
+        path = os.path.join(self.directory, self.filename)
+        self.file = open(path, 'ab')
+        self.indexFile = open(path[:-len('.warc.gz')] + '.cdx.open', 'ab')
+
+        info = ('software: anarchivist\r\nformat: WARC File Format 1.0\r\ncommand: %s\r\n' % ' '.join(sys.argv)).encode('utf-8')
+        header = GetRecordHeader([('WARC-Type', 'warcinfo'), ('WARC-Record-ID', '<urn:uuid:%s>' % uuid.uuid4()),
+                                  ('WARC-Date', GetWARCDate(time.time())), ('WARC-Filename', self.filename),
+                                  ('Content-Type', 'application/warc-fields')], len(info))
+        self.file.write(CompressMember([header, info, b'\r\n\r\n']))
+
+    # Call with self.lock held
+    def CloseFile(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.indexFile.close()
+        SortIndex(os.path.join(self.directory, self.filename[:-len('.warc.gz')] + '.cdx.open'))
+        self.file = None
+        self.indexFile = None
+
+    def close(self):
+        with self.lock:
+            self.CloseFile()
+
+    # Appends the request/response pair. body is either bytes, or (filename, offset, length) of where it's been saved
+    def RecordResponse(self, siteURL, method, url, requestHeaders, postData, res, body):
+        when = time.time()
+        targetURL = url if '://' in url else siteURL + url
+        requestID = '<urn:uuid:%s>' % uuid.uuid4()
+        responseID = '<urn:uuid:%s>' % uuid.uuid4()
+
+        requestBlock = GetRequestBlock(method, targetURL, requestHeaders, postData)
+        request = CompressMember([GetRecordHeader([
+            ('WARC-Type', 'request'), ('WARC-Record-ID', requestID), ('WARC-Date', GetWARCDate(when)),
+            ('WARC-Target-URI', targetURL), ('WARC-Concurrent-To', responseID),
+            ('Content-Type', 'application/http;msgtype=request')], len(requestBlock)), requestBlock, b'\r\n\r\n'])
+
+        if isinstance(body, bytes):
+            GetChunks = lambda: [body]
+            bodyLength = len(body)
+        else:
+            GetChunks = lambda: ReadFileRange(*body)
+            bodyLength = body[2]
+
+        # The digests have to go in the header, so big bodies get read twice
+        payloadHasher = hashlib.sha1()
+        for chunk in GetChunks():
+            payloadHasher.update(chunk)
+        headerBlock = GetResponseHeaderBlock(res)
+        blockHasher = hashlib.sha1(headerBlock)
+        for chunk in GetChunks():
+            blockHasher.update(chunk)
+
+        payloadDigest = GetDigest(payloadHasher)
+        responseHeader = GetRecordHeader([
+            ('WARC-Type', 'response'), ('WARC-Record-ID', responseID), ('WARC-Date', GetWARCDate(when)),
+            ('WARC-Target-URI', targetURL), ('WARC-Payload-Digest', payloadDigest), ('WARC-Block-Digest', GetDigest(blockHasher)),
+            ('Content-Type', 'application/http;msgtype=response')], len(headerBlock) + bodyLength)
+
+        # Page-sized bodies are compressed before taking the lock, media is compressed straight into the file
+        response = None
+        if bodyLength <= WARC_READ_CHUNK_SIZE:
+            response = CompressMember([responseHeader, headerBlock] + list(GetChunks()) + [b'\r\n\r\n'])
+
+        mimeType = (res.getheader('Content-Type') or 'unk').split(';')[0].strip() or 'unk'
+        redirect = res.getheader('Location') or '-'
+        with self.lock:
+            if self.file is None or self.file.tell() >= self.maxFileSize:
+                self.CloseFile()
+                self.OpenFile()
+
+            self.file.write(request)
+            offset = self.file.tell()
+            if response is not None:
+                self.file.write(response)
+            else:
+                WriteCompressedMember(self.file, [responseHeader, headerBlock], GetChunks(), [b'\r\n\r\n'])
+            length = self.file.tell() - offset
+            self.file.flush()
+
+            fields = [GetSURT(targetURL), GetCDXTimestamp(when), targetURL, mimeType, str(res.status), payloadDigest[len('sha1:'):],
+                      redirect, '-', str(length), str(offset), self.filename]
+            self.indexFile.write((' '.join(field.replace(' ', '%20') for field in fields) + '\n').encode('utf-8'))
+            self.indexFile.flush()
+            self.recordCount += 1
+
+def CompressMember(pieces):
+    compressor = zlib.compressobj(WARC_COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return b''.join([compressor.compress(piece) for piece in pieces] + [compressor.flush()])
+
+def WriteCompressedMember(f, head, chunks, tail):
+    compressor = zlib.compressobj(WARC_COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for piece in head:
+        f.write(compressor.compress(piece))
+    for chunk in chunks:
+        f.write(compressor.compress(chunk))
+    for piece in tail:
+        f.write(compressor.compress(piece))
+    f.write(compressor.flush())
+
+# Turns a finished "{name}.cdx.open" into a sorted "{name}.cdx"
+def SortIndex(openFilename):
+    with open(openFilename, 'rb') as f:
+        lines = [line for line in f if line.endswith(b'\n')]
+    lines.sort()
+    filename = openFilename[:-len('.open')]
+    tempFilename = filename + '.tmp'
+    with open(tempFilename, 'wb') as f:
+        f.write(CDX_HEADER)
+        f.writelines(lines)
+    os.replace(tempFilename, filename)
+    os.remove(openFilename)
+
+# Sorts the indexes of WARC files that were never finished (the run was killed). Not for while a run is writing them
+def FinishOpenIndexes(directory):
+    for name in os.listdir(directory):
+        if name.endswith('.cdx.open'):
+            SortIndex(os.path.join(directory, name))
+
+# Positions f at the first line that is >= key (the file being sorted)
+def SeekSorted(f, key):
+    f.seek(0, os.SEEK_END)
+    lo, hi = 0, f.tell()
+    while lo < hi:
+        mid = (lo + hi) // 2
+        # The first line starting at or after mid
+        if mid > 0:
+            f.seek(mid - 1)
+            f.readline()
+        else:
+            f.seek(0)
+        line = f.readline()
+        if line and line < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo > 0:
+        f.seek(lo - 1)
+        f.readline()
+    else:
+        f.seek(0)
+
+def ParseCDXLine(line):
+    fields = line.decode('utf-8').rstrip('\n').split(' ')
+    return CDXEntry(fields[0], fields[1], fields[2], fields[3], fields[4], fields[5], int(fields[8]), int(fields[9]), fields[10])
+
+# Every capture of url in the directory's WARC files, oldest first
+def FindCaptures(directory, url):
+    key = (GetSURT(url) + ' ').encode('utf-8')
+    captures = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.cdx'):
+            with open(os.path.join(directory, name), 'rb') as f:
+                SeekSorted(f, key)
+                for line in f:
+                    if not line.startswith(key):
+                        break
+                    captures.append(ParseCDXLine(line))
+        elif name.endswith('.cdx.open'):
+            # Not sorted yet, and maybe still being written: skip the last line if it's only partly there
+            with open(os.path.join(directory, name), 'rb') as f:
+                for line in f:
+                    if line.startswith(key) and line.endswith(b'\n'):
+                        captures.append(ParseCDXLine(line))
+    captures.sort(key=lambda entry: entry.timestamp)
+    return captures
+
+# The capture closest to timestamp (14 digits, or a prefix of them), or None if there aren't any
+def FindClosestCapture(directory, url, timestamp):
+    captures = FindCaptures(directory, url)
+    if len(captures) == 0:
+        return None
+    target = int(timestamp.ljust(14, '0')[:14])
+    return min(captures, key=lambda entry: abs(int(entry.timestamp) - target))
+
+# Returns (WARC header bytes, HTTP header bytes, payload bytes) of a capture from FindCaptures
+def ReadCapture(directory, entry):
+    with open(os.path.join(directory, entry.filename), 'rb') as f:
+        f.seek(entry.offset)
+        record = zlib.decompress(f.read(entry.length), 16 + zlib.MAX_WBITS)
+    warcHeader, sep, block = record.partition(b'\r\n\r\n')
+    httpHeader, sep, payload = block.partition(b'\r\n\r\n')
+    if payload.endswith(b'\r\n\r\n'):
+        payload = payload[:-4]
+    return warcHeader, httpHeader, payload
+
+# For the scripts: starts recording responses if --warc was passed. Returns the writer, or None
+def StartWARCFromFlags(flags, prefix):
+    if 'warc' not in flags:
+        return None
+    directory = flags['warc'] if isinstance(flags['warc'], str) else DEFAULT_WARC_DIRECTORY
+    maxFileSize = GetIntFlag(flags, 'warc-max-mb', WARC_MAX_FILE_SIZE // (1024 * 1024)) * 1024 * 1024
+    writer = WARCWriter(directory, prefix, maxFileSize)
+    anarchivist_http.SetResponseRecorder(writer)
+    print('Recording responses to WARC files in "%s"' % directory)
+    return writer
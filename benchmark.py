@@ -0,0 +1,283 @@
+# Benchmarks for the download scripts, run against local stand-ins for the sites (see anarchivist_mockservers.py)
+# Usage: python benchmark.py {steam|twitter|twitch} ...
+#
+# Options:
+#  --latency=MS    How long the stand-in takes to answer each request (default 20)
+#  --jitter=MS     Up to this much more on top of --latency, at random (default 0)
+#  --throttle=F    Fraction of page requests that get throttled (429, or 403 for Steam) (default 0)
+#  --failures=F    Fraction of requests that fail, half with a 503 and half with the connection dropped (default 0)
+#  --scale=N       Make the sites N times bigger: more screenshots, tweets, a longer VOD... (default 1)
+#  --seed=N        What the pages and the failures are generated from (default 1)
+#  --args="..."    Options to pass on to the script, e.g. --args="--async --concurrency=16"
+#  --json=FILE     Also add the results to FILE (a JSON list), for comparing runs
+#  --keep          Keep the directory the script ran in, instead of deleting it
+#
+# Each benchmark runs the whole script, in a fresh temporary directory, in a child process that has its hosts pointed
+# at the stand-in (anarchivist_http.OverrideHost). So what gets measured is the real thing:
+#  - steam: dl_steam.py (ScrapeAppCommunity, or ScrapeAppCommunityAsync with --args="--async") on one app
+#  - twitter: dl_twitter.py (DownloadUserTweets_V2) on one user
+#  - twitch: dl_twitch_vod_chat.py (DownloadChatForVOD) on one VOD
+#
+# And it reports:
+#  - pages/sec: pages (HTML and JSON) the stand-in served, over the script's run time
+#  - media MB/sec: the same, for images and videos
+#  - DB insert latency: time spent in sqlite on INSERT/UPDATE/DELETE/REPLACE and the commits after them, per row and per
+#    transaction (median and 95th percentile). Every sqlite connection the script opens is timed, so this covers the
+#    DBWriter's batches as well as scripts that write on a plain connection. Plus how long the script was held up in
+#    DBWriter.commit() waiting for room in the writer's queue, which is what actually slows a crawl down
+#  - peak RSS of the child process
+#  - what the stand-in injected (throttles, failures), so runs with different settings can be told apart
+#
+# The script's own output goes to script.log in its directory (use --keep to look at it).
+#
+# Dependencies:
+#  - Python 3 (on Linux or macOS, for the peak RSS)
+#  - anarchivist_mockservers.py, anarchivist_http.py, anarchivist_dbwriter.py and anarchivist_args.py from this repo,
+#    and the scripts being benchmarked
+
+import os
+import sys
+import json
+import time
+import shlex
+import sqlite3
+import runpy
+import atexit
+import shutil
+import tempfile
+import resource
+import threading
+import subprocess
+
+from anarchivist_args import ParseArgs, GetIntFlag
+from anarchivist_mockservers import SITES, MockServer, MockBehavior
+from anarchivist_dbwriter import GetStatementType, MetricsConnection, WRITE_STATEMENTS
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# site -> (script, the target it's run on)
+BENCHMARKS = {
+    'steam': ('dl_steam.py', '440'),
+    'twitter': ('dl_twitter.py', 'benchmarkuser'),
+    'twitch': ('dl_twitch_vod_chat.py', '123456789'),
+}
+
+def GetPercentile(values, fraction):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+#--------------------------------------
+# In the child process
+
+class DBTimings:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (seconds, rows) for each transaction that wrote something
+        self.transactions = []
+        self.commitWaits = []
+
+    def AddTransaction(self, seconds, rows):
+        with self.lock:
+            self.transactions.append((seconds, rows))
+
+    def AddCommitWait(self, seconds):
+        with self.lock:
+            self.commitWaits.append(seconds)
+
+    def GetResult(self):
+        with self.lock:
+            seconds = [seconds for seconds, rows in self.transactions]
+            rowCount = sum(rows for seconds, rows in self.transactions)
+            return {
+                'dbRows': rowCount,
+                'dbTransactions': len(self.transactions),
+                'dbSecondsPerRow': sum(seconds) / rowCount if rowCount > 0 else 0,
+                'dbTransactionMedian': GetPercentile(seconds, 0.5),
+                'dbTransactionP95': GetPercentile(seconds, 0.95),
+                'commitCount': len(self.commitWaits),
+                'commitWaitP95': GetPercentile(self.commitWaits, 0.95),
+                'commitWaitMax': max(self.commitWaits, default=0),
+            }
+
+# A sqlite3 connection that adds up the time its writes take, until they're committed
+class TimedConnection(MetricsConnection):
+    timings = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writeSeconds = 0.0
+        self.writeRows = 0
+
+    def execute(self, sql, params=()):
+        statementType = GetStatementType(sql)
+        if statementType not in WRITE_STATEMENTS and statementType not in ('COMMIT', 'END'):
+            return super().execute(sql, params)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self.writeSeconds += time.perf_counter() - start
+            if statementType in WRITE_STATEMENTS:
+                self.writeRows += 1
+            else:
+                self.EndTransaction()
+
+    def executemany(self, sql, paramsList):
+        if GetStatementType(sql) not in WRITE_STATEMENTS:
+            return super().executemany(sql, paramsList)
+        paramsList = list(paramsList)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, paramsList)
+        finally:
+            self.writeSeconds += time.perf_counter() - start
+            self.writeRows += len(paramsList)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            self.writeSeconds += time.perf_counter() - start
+            self.EndTransaction()
+
+    def EndTransaction(self):
+        if self.writeRows > 0:
+            self.timings.AddTransaction(self.writeSeconds, self.writeRows)
+        self.writeSeconds = 0.0
+        self.writeRows = 0
+
+def RunChild(jobFilename):
+    with open(jobFilename, 'r') as f:
+        job = json.load(f)
+
+    # Has to happen before the script asks for its host pools
+    import anarchivist_http
+    for origin in SITES[job['site']].origins:
+        anarchivist_http.OverrideHost(origin, job['address'])
+
+    import anarchivist_dbwriter
+    timings = DBTimings()
+    TimedConnection.timings = timings
+    connect = sqlite3.connect
+    sqlite3.connect = lambda *args, **kwargs: connect(*args, **dict(kwargs, factory=TimedConnection))
+
+    commit = anarchivist_dbwriter.DBWriter.commit
+    def TimedCommit(self):
+        start = time.perf_counter()
+        commit(self)
+        timings.AddCommitWait(time.perf_counter() - start)
+    anarchivist_dbwriter.DBWriter.commit = TimedCommit
+
+    script, target = BENCHMARKS[job['site']]
+    elapsed = [None]
+
+    # Registered before the script's own DBWriters, so it runs after they've written out the last of their rows
+    def WriteResult():
+        result = timings.GetResult()
+        result.update({'elapsed': elapsed[0], 'peakRSS': GetPeakRSS()})
+        with open(job['result'], 'w') as f:
+            json.dump(result, f)
+    atexit.register(WriteResult)
+
+    sys.argv = [script, target] + job['args']
+    sys.path.insert(0, SCRIPT_DIR)
+    with open('script.log', 'w') as log:
+        sys.stdout = log
+        start = time.perf_counter()
+        try:
+            runpy.run_path(os.path.join(SCRIPT_DIR, script), run_name='__main__')
+        except SystemExit:
+            pass
+        finally:
+            elapsed[0] = time.perf_counter() - start
+            sys.stdout = sys.__stdout__
+
+def GetPeakRSS():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+#--------------------------------------
+# In the parent
+
+def RunBenchmark(siteName, behavior, scale, scriptArgs, keep):
+    site = SITES[siteName](scale, behavior.seed)
+    server = MockServer(site, behavior).start()
+    workDir = tempfile.mkdtemp(prefix='anarchivist_bench_')
+    try:
+        jobFilename = os.path.join(workDir, 'job.json')
+        resultFilename = os.path.join(workDir, 'result.json')
+        with open(jobFilename, 'w') as f:
+            json.dump({'site': siteName, 'address': server.address, 'args': scriptArgs, 'result': resultFilename}, f)
+
+        print('Running %s against the %s stand-in at %s...' % (' '.join([BENCHMARKS[siteName][0]] + scriptArgs), siteName, server.address))
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--child=%s' % jobFilename], cwd=workDir, check=False)
+
+        if not os.path.exists(resultFilename):
+            print('The benchmark did not finish, see %s' % os.path.join(workDir, 'script.log'), file=sys.stderr)
+            keep = True
+            return None
+        with open(resultFilename, 'r') as f:
+            result = json.load(f)
+    finally:
+        server.stop()
+        if keep:
+            print('Kept %s' % workDir)
+        else:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    result.update(server.stats)
+    result.update({'site': siteName, 'args': scriptArgs, 'scale': scale, 'latency': behavior.latency,
+                   'jitter': behavior.jitter, 'throttleRate': behavior.throttleRate, 'failureRate': behavior.failureRate,
+                   'seed': behavior.seed, 'time': time.time()})
+    elapsed = max(result['elapsed'], 1e-6)
+    result['pagesPerSec'] = result['pages'] / elapsed
+    result['mediaMBPerSec'] = result['mediaBytes'] / elapsed / (1024 * 1024)
+    return result
+
+def PrintResult(result):
+    print('')
+    print('%s (%s)' % (BENCHMARKS[result['site']][0], ' '.join(result['args']) or 'default options'))
+    print('  elapsed          %.2f s' % result['elapsed'])
+    print('  pages            %d (%.1f pages/sec, %d not modified)' % (result['pages'], result['pagesPerSec'], result['notModified']))
+    print('  media            %d files, %.1f MB (%.2f MB/sec)' % (result['media'], result['mediaBytes'] / (1024 * 1024), result['mediaMBPerSec']))
+    print('  DB inserts       %d rows in %d transactions, %.1f us/row, transaction median %.1f ms, p95 %.1f ms' % (
+        result['dbRows'], result['dbTransactions'], result['dbSecondsPerRow'] * 1e6, result['dbTransactionMedian'] * 1e3, result['dbTransactionP95'] * 1e3))
+    print('  commit() wait    %d commits, p95 %.2f ms, max %.1f ms' % (result['commitCount'], result['commitWaitP95'] * 1e3, result['commitWaitMax'] * 1e3))
+    print('  peak RSS         %.1f MB' % (result['peakRSS'] / (1024 * 1024)))
+    print('  injected         %d throttled, %d failed, %d dropped' % (result['throttled'], result['failed'], result['dropped']))
+
+def SaveResult(filename, result):
+    results = []
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            results = json.load(f)
+    results.append(result)
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    siteNames, flags = ParseArgs(sys.argv[1:])
+
+    if 'child' in flags:
+        RunChild(flags['child'])
+    elif len(siteNames) < 1 or any(siteName not in BENCHMARKS for siteName in siteNames):
+        print('Please specify which benchmarks to run: %s' % ', '.join(BENCHMARKS))
+    else:
+        behavior = MockBehavior(latency=GetIntFlag(flags, 'latency', 20) / 1000.0,
+                                jitter=GetIntFlag(flags, 'jitter', 0) / 1000.0,
+                                throttleRate=float(flags.get('throttle', 0)),
+                                failureRate=float(flags.get('failures', 0)),
+                                seed=GetIntFlag(flags, 'seed', 1))
+        scriptArgs = shlex.split(flags['args']) if isinstance(flags.get('args'), str) else []
+        for siteName in siteNames:
+            result = RunBenchmark(siteName, behavior, GetIntFlag(flags, 'scale', 1), scriptArgs, 'keep' in flags)
+            if result is None:
+                continue
+            PrintResult(result)
+            if 'json' in flags:
+                SaveResult(flags['json'], result)
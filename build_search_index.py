@@ -0,0 +1,51 @@
+# Builds the full-text search indexes for databases the scripts wrote before they kept them up to date themselves
+# Usage: python build_search_index.py {DB_FILE1} {DB_FILE2} ...
+#
+# Works on any of data/{APP_ID}/meta.db, {USERNAME}/tweets.db and vod_chat.db: each index the database should have
+# (see anarchivist_search.py) is created if it isn't there, and filled in from scratch with everything in the database.
+# VODs whose chat was downloaded before the ChatMessages table existed get it filled in first.
+#
+# Once this has been run, the scripts keep the indexes up to date as they add rows, so it only needs running once.
+# Don't run it on a database a script is still writing to.
+#
+# Dependencies:
+#  - Python 3
+#  - anarchivist_search.py, anarchivist_html.py, anarchivist_twitchchat.py, anarchivist_blobstore.py, anarchivist_dbwriter.py
+#    and anarchivist_args.py from this repo
+
+import os
+import sys
+import time
+
+from anarchivist_args import ParseArgs
+from anarchivist_dbwriter import OpenDatabase
+from anarchivist_twitchchat import CreateChatMessageTable, BackfillChatMessages
+from anarchivist_search import GetTables, RebuildSearchIndexes
+
+def BuildSearchIndex(filename):
+    if not os.path.exists(filename):
+        print('No database at "%s"' % filename)
+        return
+
+    print('Indexing "%s"' % filename)
+    db = OpenDatabase(filename)
+
+    if 'ChatData' in GetTables(db):
+        CreateChatMessageTable(db)
+        print('  filled in %d chat messages' % BackfillChatMessages(db))
+
+    startTime = time.monotonic()
+    for indexName, count in RebuildSearchIndexes(db).items():
+        print('  %s: indexed %d rows' % (indexName, count))
+    print('  done in %.1f seconds' % (time.monotonic() - startTime))
+
+    db.close()
+
+
+filenames, flags = ParseArgs(sys.argv[1:])
+
+if len(filenames) < 1:
+    print('Please provide database files as cmd line args')
+else:
+    for filename in filenames:
+        BuildSearchIndex(filename)
@@ -0,0 +1,113 @@
+# Moves the raw payloads in databases written by older versions of the scripts into the compressed blob store
+# Usage: python compact_blobs.py {DB_FILE1} {DB_FILE2} ...
+#
+# Options:
+#  --vacuum   VACUUM each database afterwards, so the file actually shrinks (needs about as much free disk space as the database)
+#
+# Works on any of data/{APP_ID}/meta.db, {USERNAME}/tweets.db and vod_chat.db: for each table it knows about,
+# a dictionary is trained from the rows that are there (if there isn't one for that kind yet), and then the text
+# column of every row is moved into a blob and set to NULL. It's done in batches that each get committed,
+# so it can be interrupted and run again. Blobs no longer referenced by any row are deleted at the end.
+# Blobs are compressed at the archival level here (zstd 19, zlib 9), which is slower than the scripts can afford while crawling.
+# Chat comments (ChatData) are left inline, they're too small to gain anything.
+#
+# Don't run it on a database a script is still writing to.
+#
+# Dependencies:
+#  - Python 3
+#  - anarchivist_blobstore.py and anarchivist_args.py from this repo
+
+import sys
+import os
+import sqlite3
+
+from anarchivist_args import ParseArgs
+from anarchivist_blobstore import CreateBlobTables, AddBlobColumn, GetBlobStore, PutBlobText, BLOB_DICT_TRAIN_SAMPLES
+
+# (table, key column, text column, blob column, blob kind)
+BLOB_COLUMNS = [
+    ('Guides', 'id', 'pageHTML', 'pageBlob', 'steam/guide'),
+    ('Discussions', 'discussionID', 'pageHTML', 'pageBlob', 'steam/discussion'),
+    ('WorkshopItems', 'itemID', 'pageHTML', 'pageBlob', 'steam/workshop'),
+    ('TweetData', 'tweetID', 'fullTweetJSON', 'fullTweetBlob', 'twitter/tweet'),
+    ('ChatData', 'id', 'data', 'dataBlob', 'twitch/comment'),
+]
+
+# Tables whose payloads are too small for blobs to be worth it (chat comments). They stay inline, but are still listed
+# above, since rows from older versions of the scripts can refer to blobs
+INLINE_TABLES = ('ChatData',)
+
+COMPACT_BATCH_SIZE = 1000
+
+def GetTables(db):
+    return set(row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table';"))
+
+def CompactColumn(db, table, keyColumn, textColumn, blobColumn, kind):
+    AddBlobColumn(db, table, blobColumn)
+
+    store = GetBlobStore(db, archival=True)
+    if store.GetCurrentDictID(kind) is None:
+        samples = [row[0].encode('utf-8', 'surrogatepass') for row in db.execute('SELECT %s FROM %s WHERE %s IS NOT NULL ORDER BY RANDOM() LIMIT ?;' % (textColumn, table, textColumn), (BLOB_DICT_TRAIN_SAMPLES,))]
+        if len(samples) > 1:
+            store.TrainKind(kind, samples)
+            db.commit()
+
+    movedCount = 0
+    while True:
+        rows = db.execute('SELECT %s, %s FROM %s WHERE %s IS NOT NULL LIMIT ?;' % (keyColumn, textColumn, table, textColumn), (COMPACT_BATCH_SIZE,)).fetchall()
+        if len(rows) == 0:
+            break
+
+        db.execute('BEGIN TRANSACTION;')
+        for key, text in rows:
+            blobHash = PutBlobText(db, kind, text)
+            db.execute('UPDATE %s SET %s = NULL, %s = ? WHERE %s = ?;' % (table, textColumn, blobColumn, keyColumn), (blobHash, key))
+        db.execute('COMMIT;')
+
+        movedCount += len(rows)
+        print('  %s: moved %d rows' % (table, movedCount))
+
+    return movedCount
+
+def DeleteUnreferencedBlobs(db, tables):
+    references = ['SELECT %s FROM %s WHERE %s IS NOT NULL' % (blobColumn, table, blobColumn) for table, keyColumn, textColumn, blobColumn, kind in BLOB_COLUMNS if table in tables]
+    if len(references) == 0:
+        return 0
+
+    deletedCount = db.execute('DELETE FROM Blobs WHERE hash NOT IN (%s);' % ' UNION '.join(references)).rowcount
+    db.commit()
+    return deletedCount
+
+def CompactDatabase(filename, doVacuum):
+    if not os.path.exists(filename):
+        print('No database at "%s"' % filename)
+        return
+
+    print('Compacting "%s"' % filename)
+    db = sqlite3.connect(filename, timeout=60.0, isolation_level=None)
+    CreateBlobTables(db)
+
+    tables = GetTables(db)
+    for table, keyColumn, textColumn, blobColumn, kind in BLOB_COLUMNS:
+        if table in tables and table not in INLINE_TABLES:
+            CompactColumn(db, table, keyColumn, textColumn, blobColumn, kind)
+
+    print('  deleted %d unreferenced blobs' % DeleteUnreferencedBlobs(db, tables))
+
+    rawSize, storedSize = db.execute('SELECT COALESCE(SUM(rawSize), 0), COALESCE(SUM(LENGTH(data)), 0) FROM Blobs;').fetchone()
+    print('  blobs: %d bytes of payloads stored in %d bytes' % (rawSize, storedSize))
+
+    if doVacuum:
+        print('  vacuuming...')
+        db.execute('VACUUM;')
+
+    db.close()
+
+
+filenames, flags = ParseArgs(sys.argv[1:])
+
+if len(filenames) < 1:
+    print('Please provide database files as cmd line args')
+else:
+    for filename in filenames:
+        CompactDatabase(filename, 'vacuum' in flags)
@@ -1,6 +1,26 @@
 # Steam Community Archiving Tool
 # Usage: python dl_steam.py {APP_ID1} {APP_ID2} ...
 #
+# Options:
+#  --media-workers=N   Download images on N threads in the background while pages are crawled (default 8)
+#  --async             Crawl with the asyncio engine: listing pages, detail pages and images are fetched concurrently
+#  --concurrency=N     With --async, how many requests can be in flight to steamcommunity.com at once (default 8)
+#  --discussion-workers=N   Without --async, how many pages of a long discussion are fetched at once (default 8)
+#  --incremental       Stop paginating each section once a page only has things we already have.
+#                      Sections that have never been crawled all the way through still get a full crawl
+#  --resume            Pick each section up where the last run left off, instead of starting at page 1
+#  --parallel=N        Crawl N apps at once. They share the connection limits above (and the media workers), see anarchivist_targets.py
+#  --warc[=DIR]        Also record every request and response, headers and all, in WARC files (with CDX indexes) in DIR
+#                      (default: warc). See anarchivist_warc.py
+#  --warc-max-mb=N     Start a new WARC file once the current one is N MB (default 1024)
+#  --metrics[=FILE]    Keep FILE (default metrics.json, plus a .prom copy) up to date with request latencies, retries, bytes,
+#                      backoff time and rows inserted, and print a progress line every so often. See anarchivist_metrics.py
+#  --metrics-interval=N   How many seconds between metrics updates (default 10)
+#  --trace[=FILE]      Time the stages of the crawl (fetch, decode, parse, db, fs) and write them to FILE (default trace.json)
+#                      for chrome://tracing or Perfetto. See anarchivist_trace.py
+#  --profile[=DIR]     Also run each app under cProfile, saving the stats to "DIR/{APP_ID}.prof" (default: profiles)
+#                      (apps are run one at a time then, even with --parallel)
+#
 # Archives various aspects of Steam Community for particular games/pages. It gets:
 #  - Screenshots (and snippets of HTML describing them)
 #  - Guides (and any images embedded in them)
@@ -12,11 +32,21 @@
 # But, its intended purpose is to ensure that the information lives on. Retrieval niceties can come later.
 #
 # A sqlite database containing metadata and most text is placed in "data/{APP_ID}/meta.db"
+# It's in WAL mode, and written in batches on a separate thread (see anarchivist_dbwriter.py), so it can be read while a crawl is running
+# The full HTML of guide, discussion and workshop item pages is kept compressed in its Blobs table (see anarchivist_blobstore.py)
+# The text of discussion replies is indexed for full-text search, see search_archive.py
 # A snapshot of the HTML for the community hub homepage for that app is in "data/{APP_ID}/homepage.html"
 # Images are sorted into guideIMG, screenshots, and workshopIMG folders depending on their source.
+# Each downloaded image is recorded (with its size and hash) in the MediaManifest table, which is what decides whether an image
+# still needs downloading. verify_media.py checks the images against it, and can download broken ones again (see anarchivist_manifest.py)
+#
+# Guide, discussion and workshop item pages are fetched with If-None-Match/If-Modified-Since when we've seen them before,
+# and pages that haven't changed are skipped. Pages that have changed replace the copy we had.
+# A page is only remembered as fetched once everything hanging off it is in: all of a discussion's pages, all of a guide's
+# or workshop item's images. If any of that fails, the page is fetched again in full next time.
 #
 # This script tries to be idempotent: if you run it on the same app id multiple times you won't lose data,
-# and hopefully it won't do too much redundant work (but it will re-crawl a lot, so keep that in mind)
+# and hopefully it won't do too much redundant work (but it will re-crawl a lot unless you use --incremental, so keep that in mind)
 #
 # There are other aspects of Steam Community that this script doesn't yet grab. That functionality
 # may be added in the future, but it's missing right now.
@@ -26,6 +56,9 @@
 #
 # Dependencies:
 #  - Python 3
+#  - anarchivist_http.py, anarchivist_media.py, anarchivist_args.py, anarchivist_checkpoint.py, anarchivist_pagecache.py, anarchivist_blobstore.py,
+#    anarchivist_dbwriter.py, anarchivist_targets.py, anarchivist_search.py, anarchivist_html.py, anarchivist_warc.py, anarchivist_metrics.py,
+#    anarchivist_trace.py and anarchivist_manifest.py from this repo
 #
 
 # NOTE: Another version of this script used a 3rd-party website to also download the files for workshop items.
@@ -40,6 +73,18 @@ MAX_GUIDE_PAGE_COUNT = 500
 MAX_DISCUSSION_PAGE_COUNT = 800
 MAX_WORKSHOP_PAGE_COUNT = 8000   
 
+# How many images are downloaded at once (can be overridden with --media-workers=N)
+MEDIA_WORKER_COUNT = 8
+
+# How many pages of one discussion are fetched at once, without --async (can be overridden with --discussion-workers=N)
+DISCUSSION_WORKER_COUNT = 8
+
+# Stop paginating each section once we get to things we already have (turned on with --incremental)
+INCREMENTAL_SYNC = False
+
+# Pick each section up from the checkpoint the last run left behind (turned on with --resume)
+RESUME_CRAWL = False
+
 import json
 
 import os
@@ -66,6 +111,26 @@ import sqlite3
 
 import re
 
+import asyncio
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from anarchivist_http import GetHostPool, GetMessageWithRetries, MAX_CONNS_PER_HOST
+from anarchivist_media import MediaDownloadPool
+from anarchivist_args import ParseArgs, GetIntFlag
+from anarchivist_targets import RunTargets, GetParallelTargetCount
+from anarchivist_checkpoint import CreateCheckpointTable, SaveCheckpoint, LoadCheckpoint, ClearCheckpoint
+from anarchivist_dbwriter import DBWriter
+from anarchivist_blobstore import CreateBlobTables, AddBlobColumn, PutBlobText
+from anarchivist_search import CreateReplySearchIndex, IndexReplies
+from anarchivist_warc import StartWARCFromFlags
+from anarchivist_metrics import StartMetricsFromFlags
+from anarchivist_trace import StartTracingFromFlags, Span, Traced
+from anarchivist_manifest import MediaManifest, DownloadToManifest
+from anarchivist_pagecache import CreatePageValidatorTable, GetPageValidators, FetchPageIfChanged, SavePageValidators, ClearPageValidators, PAGE_UNCHANGED
+
+@Traced('mkdir', 'fs')
 def MaybeMakeDirectory(dirname):
     try:
         os.makedirs(dirname)
@@ -73,89 +138,17 @@ def MaybeMakeDirectory(dirname):
         if e.errno != errno.EEXIST:
             raise    
 
+@Traced('exists', 'fs')
+def FileExists(filename):
+    return os.path.exists(filename)
 
-def GetNewHttpConn(origin, doSSL=True):
-    conn = {}
-    conn['origin'] = origin
-    conn['doSSL'] = doSSL
-    if conn['doSSL']:
-        conn['conn'] = http.client.HTTPSConnection(conn['origin'], timeout=50)
-    else:
-        conn['conn'] = http.client.HTTPConnection(conn['origin'], timeout=50)
-    return conn
-
-offIts404 = {}
-    
-offIts3XX = {}
-    
-def GetMessageWithRetries(conn, url, headersData={}, maxRetries = 13, outResponseHeaders = None, postData = None):
-    timeout = 15
-    for i in range(maxRetries):
-        try:
-            #print('Making request "%s"...' % url)
-            if postData is None:
-                conn['conn'].request("GET", url, headers=headersData)
-            else:
-                conn['conn'].request('POST', url, postData, headersData)
-            res = conn['conn'].getresponse()
-            #print('Got response')
-            
-            #print('Got %d status...' % res.status, file=sys.stderr)
-            #print(res.headers, file=sys.stderr)
-            
-            if res is not None and res.status == 200:
-                data = res.read()
-                #print('READ DATA')
-                
-                if outResponseHeaders is not None:
-                    for header,value in res.getheaders():
-                        outResponseHeaders[header] = value
-                
-                return data
-            elif res.status == 303 or res.status == 302 or res.status == 301:
-                data = res.read()
-                
-                print('Location: ' + res.getheader('Location'))
-                
-                offIts3XX['Location'] = res.getheader('Location')
-                
-                return None#offIts3XX
-            elif res.status == 403:
-                print('Got status 403...waiting...')
-                time.sleep(5.0)
-                return None
-            elif res.status == 404:
-                print('Got status 404')
-                return None
-            else:
-                print('Got status %d...' % res.status)
-                time.sleep(timeout)
-                timeout = timeout + 3
-            
-        except http.client.ResponseNotReady:
-            print('Connection got ResponseNotReady, retrying...', file=sys.stderr)
-            if conn['doSSL']:
-                conn['conn'] = http.client.HTTPSConnection(conn['origin'], timeout=50)
-            else:
-                conn['conn'] = http.client.HTTPConnection(conn['origin'], timeout=50)
-        except http.client.RemoteDisconnected:
-            print('Connection got RemoteDisconnected, retrying...', file=sys.stderr)
-            if conn['doSSL']:
-                conn['conn'] = http.client.HTTPSConnection(conn['origin'], timeout=50)
-            else:
-                conn['conn'] = http.client.HTTPConnection(conn['origin'], timeout=50)
-        except Exception as e:
-            traceback.print_exc()
-            print("Error, got exception: '%s'" % str(e), file=sys.stderr)
-            conn['conn'] = http.client.HTTPSConnection(conn['origin'], timeout=50)
-            time.sleep(timeout)
-            timeout = timeout + 3
+@Traced('decode text', 'decode')
+def DecodePageText(data):
+    return data.decode('utf-8', 'backslashreplace')
 
-    return None
 
-
-commConn = GetNewHttpConn('steamcommunity.com')
-userImgConn = GetNewHttpConn('steamuserimages-a.akamaihd.net')
+commConn = GetHostPool('steamcommunity.com')
+userImgConn = GetHostPool('steamuserimages-a.akamaihd.net')
 
 
 def GetBestImageURLFromScreenshotSrcSet(srcSet):
@@ -171,206 +164,454 @@ def GetBestImageURLFromScreenshotSrcSet(srcSet):
     
     return bestURL
 
+# appID -> MediaManifest, for the apps being crawled
+mediaManifests = {}
+# appID -> ImagePageValidators, for the apps being crawled
+imagePageValidators = {}
+
 def GetAppMetadataDBReady(appID):
     MaybeMakeDirectory('data/%s' % appID)
-    db = sqlite3.connect('data/%s/meta.db' % appID)
+    db = DBWriter('data/%s/meta.db' % appID)
+    # The DBWriter can be written from the media workers, so they add their own rows
+    mediaManifests[appID] = MediaManifest(db, 'data/%s' % appID, writeFromWorkers=True)
+    imagePageValidators[appID] = ImagePageValidators()
     
     db.execute('CREATE TABLE IF NOT EXISTS Screenshots(id VARCHAR(255) PRIMARY KEY, htmlStuff TEXT, imgURL VARCHAR(255));')
-    db.execute('CREATE TABLE IF NOT EXISTS Guides(id VARCHAR(255) PRIMARY KEY, pageHTML TEXT);')
+    db.execute('CREATE TABLE IF NOT EXISTS Guides(id VARCHAR(255) PRIMARY KEY, pageHTML TEXT, pageBlob VARCHAR(64));')
     db.execute('CREATE TABLE IF NOT EXISTS GuideImages(guideID VARCHAR(255), imageURL VARCHAR(255), PRIMARY KEY(guideID, imageURL));')
-    db.execute('CREATE TABLE IF NOT EXISTS Discussions(discussionID VARCHAR(255) PRIMARY KEY, pageHTML TEXT);')
+    db.execute('CREATE TABLE IF NOT EXISTS Discussions(discussionID VARCHAR(255) PRIMARY KEY, pageHTML TEXT, pageBlob VARCHAR(64));')
     db.execute('CREATE TABLE IF NOT EXISTS DiscussionReplies(commentID VARCHAR(255) PRIMARY KEY, discussionID VARCHAR(255), contents TEXT);')
-    db.execute('CREATE TABLE IF NOT EXISTS WorkshopItems(itemID VARCHAR(255) PRIMARY KEY, pageHTML TEXT);')
+    db.execute('CREATE TABLE IF NOT EXISTS WorkshopItems(itemID VARCHAR(255) PRIMARY KEY, pageHTML TEXT, pageBlob VARCHAR(64));')
     db.execute('CREATE TABLE IF NOT EXISTS WorkshopItemImages(itemID VARCHAR(255), imageURL VARCHAR(255), PRIMARY KEY(itemID, imageURL));')
     db.execute('CREATE INDEX IF NOT EXISTS GuideImagesGuideIDIndex ON GuideImages(guideID);')
     db.execute('CREATE INDEX IF NOT EXISTS DiscussionRepliesDiscussionIDIndex ON DiscussionReplies(discussionID);')
     db.execute('CREATE INDEX IF NOT EXISTS WorkshopItemImagesWorkshopItemIndex ON WorkshopItemImages(itemID);')
+    db.execute('CREATE TABLE IF NOT EXISTS SectionSyncState(section VARCHAR(255) PRIMARY KEY, newestIDs TEXT, syncedAt INTEGER);')
     db.commit()
+    CreateCheckpointTable(db)
+    CreatePageValidatorTable(db)
+    CreateBlobTables(db)
+    for table in ['Guides', 'Discussions', 'WorkshopItems']:
+        AddBlobColumn(db, table, 'pageBlob')
+    CreateReplySearchIndex(db)
     
     return db
+
+# Incremental sync (--incremental)
+#
+# Every section's listing is sorted newest first, so once a listing page only has things we already have,
+# everything after it should be stuff we've already crawled too, and we can stop paginating.
+# That's only true if an earlier run actually made it to the end of the section, though (runs get interrupted),
+# so SectionSyncState records the newest ids of each section whenever a crawl of it finishes, and a section
+# without a row there always gets a full crawl.
+SECTION_ID_COLUMNS = {
+    'screenshots': ('Screenshots', 'id'),
+    'guides': ('Guides', 'id'),
+    'discussions': ('Discussions', 'discussionID'),
+    'workshop': ('WorkshopItems', 'itemID'),
+}
+
+def GetSectionNewestIDs(db, section):
+    row = db.execute('SELECT newestIDs FROM SectionSyncState WHERE section = ?;', (section,)).fetchone()
+    if row is None:
+        return None
+    return set(json.loads(row[0]))
+
+def GetKnownSectionIDs(db, section, ids):
+    ids = list(set(ids))
+    if len(ids) == 0:
+        return set()
+    tableName, columnName = SECTION_ID_COLUMNS[section]
+    query = 'SELECT %s FROM %s WHERE %s IN (%s);' % (columnName, tableName, columnName, ','.join('?' * len(ids)))
+    return set(row[0] for row in db.execute(query, ids))
+
+class SectionSync:
+    def __init__(self, db, section):
+        self.db = db
+        self.section = section
+        self.newestIDs = None
+        if INCREMENTAL_SYNC:
+            self.newestIDs = GetSectionNewestIDs(db, section)
+            if self.newestIDs is None:
+                print('No finished crawl of %s on record, doing a full crawl of them' % section)
+        self.firstPageIDs = None
+        self.caughtUp = False
+        
+        # Where to start the listing, and anything else the checkpoint had in it (--resume)
+        self.checkpointName = 'steam/%s' % section
+        self.startPageIdx = 1
+        self.resumeState = {}
+        if RESUME_CRAWL:
+            state = LoadCheckpoint(db, self.checkpointName)
+            if state is not None:
+                print('Resuming %s from checkpoint at page %s' % (section, state['pageIdx']))
+                self.startPageIdx = state['pageIdx']
+                self.firstPageIDs = state.get('firstPageIDs')
+                self.resumeState = state
+
+    # Call inside the transaction for everything we've stored up to pageIdx.
+    # extra is saved with it, and comes back as resumeState
+    def SaveProgress(self, pageIdx, extra={}):
+        state = {'pageIdx': pageIdx, 'firstPageIDs': self.firstPageIDs}
+        state.update(extra)
+        SaveCheckpoint(self.db, self.checkpointName, state)
+
+    # Call with the ids on a listing page before anything from it gets stored.
+    # Returns the ones we already have (always empty unless this is an incremental sync)
+    def StartPage(self, pageIdx, pageIDs):
+        if pageIdx == 1:
+            self.firstPageIDs = list(pageIDs)
+        if not INCREMENTAL_SYNC:
+            return set()
+        
+        knownIDs = GetKnownSectionIDs(self.db, self.section, pageIDs)
+        self.caughtUp = self.newestIDs is not None and len(pageIDs) > 0 and set(pageIDs) <= knownIDs
+        return knownIDs
+
+    # True if the last page only had things we already have, so we can stop paginating
+    def IsCaughtUp(self):
+        if self.caughtUp:
+            print('Page of %s only had ones we already have, stopping here' % self.section)
+        return self.caughtUp
+
+    # Call once we've reached the end of the listing (or caught up with an earlier crawl)
+    def Finish(self):
+        ClearCheckpoint(self.db, self.checkpointName)
+        if self.firstPageIDs is not None:
+            self.db.execute('INSERT OR REPLACE INTO SectionSyncState VALUES(?,?,?);', (self.section, json.dumps(self.firstPageIDs), int(time.time())))
+        self.db.commit()
     
 screenshotSrcSetReg = re.compile(r'srcset="([^"]*)"')
 screenshotIDReg = re.compile(r'id="apphub_Card_([a-zA-Z0-9]*)"')
 
-def DownloadScreenshot(appID, screenshotID, imgURLPath):
-    dirname = 'data/%s/screenshots' % appID
-    MaybeMakeDirectory(dirname)
-    
-    filename = '%s/%s.png' % (dirname, screenshotID)
-    if os.path.exists(filename):
+USER_IMAGES_ORIGIN = 'https://steamuserimages-a.akamaihd.net'
+
+# Returns the (path, filename) to download for the screenshot, or None if we already have it
+def GetScreenshotDownload(appID, screenshotID, imgURLPath):
+    filename = 'data/%s/screenshots/%s.png' % (appID, screenshotID)
+    if mediaManifests[appID].Has(filename):
         print('Skipping "%s", already grabbed' % imgURLPath)
+        return None
     else:
-        data = GetMessageWithRetries(userImgConn, imgURLPath)
-        if data is None:
-            print('Could not download "%s"...' % imgURLPath)
-        else:
-            with open(filename, 'wb') as f:
-                f.write(data)
+        return (imgURLPath, filename)
+
+# Returns (screenshotID, bestImgURL, download) for one apphub_Card element of a screenshot listing page,
+# where download is from GetScreenshotDownload(). Returns None if the element doesn't look like a screenshot
+@Traced('parse screenshot', 'parse')
+def ParseScreenshotElement(appID, element):
+    srcSetMatch = screenshotSrcSetReg.search(element)
+    if not srcSetMatch:
+        print('Possibly missing a screenshot: couldn\'t find srcset tag.')
+        return None
+    
+    srcSet = srcSetMatch.group(1)
+    screenshotID = screenshotIDReg.search(element).group(1)
+    bestImgURL = GetBestImageURLFromScreenshotSrcSet(srcSet)
+    print('Got ID "%s" img src: "%s"' % (screenshotID, bestImgURL))
+    
+    download = None
+    if bestImgURL.startswith(USER_IMAGES_ORIGIN):
+        imgURLPath = bestImgURL[len(USER_IMAGES_ORIGIN):]
+        download = GetScreenshotDownload(appID, screenshotID, imgURLPath)
+    else:
+        print('Cannot download "%s", unexpected domain' % bestImgURL)
+        
+    return (screenshotID, bestImgURL, download)
 
+def GetScreenshotListingURL(appID, pageIdx):
+    return '/app/%s/homecontent/?p=%d&screenshotspage=%d&numperpage=10&&browsefilter=mostrecent&appid=%s&appHubSubSection=2&appHubSubSection=2&searchText=' % (appID, pageIdx, pageIdx, appID)
 
 def ScrapeAppCommunityScreenshots(appID, db):
-    for pageIdx in range(1,MAX_SCREENSHOT_PAGE_COUNT):
-        url = '/app/%s/homecontent/?p=%d&screenshotspage=%d&numperpage=10&&browsefilter=mostrecent&appid=%s&appHubSubSection=2&appHubSubSection=2&searchText=' % (appID, pageIdx, pageIdx, appID)
+    sync = SectionSync(db, 'screenshots')
+    for pageIdx in range(sync.startPageIdx, MAX_SCREENSHOT_PAGE_COUNT):
+        url = GetScreenshotListingURL(appID, pageIdx)
         
         data = GetMessageWithRetries(commConn, url)
         print('Grabbed page %d of screenshots for app "%s"' % (pageIdx, appID))
         if data is None:
             print('Welp, couldn\'t download steam community screenshots page %d for "%s"' % (pageIdx, appID))
         else:
-            text = data.decode('utf-8', 'backslashreplace')
+            text = DecodePageText(data)
             
             elements = text.split('<div class="apphub_Card modalContentLink interactable"')
             
             if len(elements) <= 1:
                 print('Reached final page')
+                sync.Finish()
                 break
             
+            sync.StartPage(pageIdx, screenshotIDReg.findall(text))
+            
             db.execute('BEGIN TRANSACTION;')
             
             print('Got %d elements...' % len(elements))
             for element in elements[1:]:
-                srcSetMatch = screenshotSrcSetReg.search(element)
-                if not srcSetMatch:
-                    print('Possibly missing a screenshot: couldn\'t find srcset tag.')
+                screenshot = ParseScreenshotElement(appID, element)
+                if screenshot is None:
                     continue
                 
-                srcSet = srcSetMatch.group(1)
-                screenshotID = screenshotIDReg.search(element).group(1)
-                bestImgURL = GetBestImageURLFromScreenshotSrcSet(srcSet)
-                print('Got ID "%s" img src: "%s"' % (screenshotID, bestImgURL))
-                
-                expectedStart = 'https://steamuserimages-a.akamaihd.net'
-                if bestImgURL.startswith(expectedStart):
-                    imgURLPath = bestImgURL[len(expectedStart):]
-                    DownloadScreenshot(appID, screenshotID, imgURLPath)
-                else:
-                    print('Cannot download "%s", unexpected domain' % bestImgURL)
+                screenshotID, bestImgURL, download = screenshot
+                if download is not None:
+                    mediaPool.Submit(userImgConn, *download, manifest=mediaManifests[appID], group=appID)
                 
                 db.execute('INSERT OR IGNORE INTO Screenshots VALUES(?,?,?);', (screenshotID, element, bestImgURL))
 
+            sync.SaveProgress(pageIdx + 1)
             db.execute('COMMIT;')
             db.commit()
+            
+            if sync.IsCaughtUp():
+                sync.Finish()
+                break
 
 searchGuideReg = re.compile(r'href="https:\/\/steamcommunity.com\/sharedfiles\/filedetails\/\?id=([0-9]*)"')
     
-guideHHTMLImageLinkReg = re.compile(r'<a href="https:\/\/steamuserimages-a\.akamaihd\.net(\/ugc\/[A-Z0-9]*\/[A-Z0-9]*\/)" class="modalContentLink"')
-def ScrapeGuideTextForImages(appID, db, guideID, guideText):
-    dirname = 'data/%s/guideIMG/%s' % (appID, guideID)
-    
-    for match in guideHHTMLImageLinkReg.finditer(guideText):
+# Records every image link that imageReg finds in the page under parentID in tableName,
+# and returns the (path, filename) pairs for the ones that haven't been downloaded yet
+@Traced('find images', 'parse')
+def FindImagesInPage(db, manifest, imageReg, tableName, parentID, dirname, pageHTML):
+    downloads = []
+    for match in imageReg.finditer(pageHTML):
         imageLink = match.group(1)
         imgParts = imageLink.split('/')
         # Get the last two non-empty parts of the path
         filename = '%s/%s_%s.jpg' % (dirname, imgParts[-3], imgParts[-2])
         
-        db.execute('INSERT OR IGNORE INTO GuideImages VALUES(?,?)', (guideID, imageLink))
+        db.execute('INSERT OR IGNORE INTO %s VALUES(?,?)' % tableName, (parentID, imageLink))
         
-        if os.path.exists(filename):
+        if manifest.Has(filename):
             print('Skipping "%s", already grabbed' % imageLink)
         else:
             print('DL "%s" -> "%s"' % (imageLink, filename))
-            data = GetMessageWithRetries(userImgConn, imageLink)
-            if data is None:
-                print('Could not download "%s"...' % imageLink)
+            downloads.append((imageLink, filename))
+            
+    return downloads
+
+# Guide and workshop item pages are only marked as stored (their validators saved) once all of their images are
+# downloaded. Otherwise a page whose image failed would come back unchanged on the next crawl, and the image would
+# never get another try. The downloads finish on other threads, so the validators wait in here until the crawl's
+# thread writes them (WriteReady) in its next transaction, which is always after the one the page went in.
+class ImagePageValidators:
+    def __init__(self):
+        self.ready = queue.Queue()
+    
+    # Call on the crawl's thread. Returns the onDone to pass with each of the page's downloads
+    def Add(self, db, url, validators, downloadCount):
+        if downloadCount == 0:
+            SavePageValidators(db, url, validators)
+            return None
+        
+        # Whatever we had for an older version of the page shouldn't count either
+        ClearPageValidators(db, url)
+        lock = threading.Lock()
+        state = {'remaining': downloadCount, 'failed': False}
+        def OnDone(success):
+            with lock:
+                state['remaining'] -= 1
+                state['failed'] = state['failed'] or not success
+                if state['remaining'] > 0:
+                    return
+            if state['failed']:
+                print('Not all of the images on "%s" were downloaded, it will be fetched again next time' % url)
             else:
-                MaybeMakeDirectory(dirname)
-                with open(filename, 'wb') as f:
-                    f.write(data)
+                self.ready.put((url, validators))
+        return OnDone
+    
+    # Call on the crawl's thread
+    def WriteReady(self, db):
+        while True:
+            try:
+                url, validators = self.ready.get_nowait()
+            except queue.Empty:
+                break
+            SavePageValidators(db, url, validators)
+
+guideHHTMLImageLinkReg = re.compile(r'<a href="https:\/\/steamuserimages-a\.akamaihd\.net(\/ugc\/[A-Z0-9]*\/[A-Z0-9]*\/)" class="modalContentLink"')
+
+def FindGuideImages(appID, db, guideID, guideText):
+    dirname = 'data/%s/guideIMG/%s' % (appID, guideID)
+    return FindImagesInPage(db, mediaManifests[appID], guideHHTMLImageLinkReg, 'GuideImages', guideID, dirname, guideText)
+
+# Also saves the guide's validators, once the images are in (see ImagePageValidators)
+def ScrapeGuideTextForImages(appID, db, guideID, guideText, guideURL, validators):
+    downloads = FindGuideImages(appID, db, guideID, guideText)
+    onDone = imagePageValidators[appID].Add(db, guideURL, validators, len(downloads))
+    for imageLink, filename in downloads:
+        mediaPool.Submit(userImgConn, imageLink, filename, onDone=onDone, manifest=mediaManifests[appID], group=appID)
+
+def GetGuideListingURL(appID, pageIdx):
+    return '/app/%s/guides/?browsefilter=mostrecent&p=%d' % (appID, pageIdx)
 
 def ScrapeAppCommunityGuides(appID, db):
-    for pageIdx in range(1, MAX_GUIDE_PAGE_COUNT):
-        searchURL = '/app/%s/guides/?browsefilter=mostrecent&p=%d' % (appID, pageIdx)
+    sync = SectionSync(db, 'guides')
+    for pageIdx in range(sync.startPageIdx, MAX_GUIDE_PAGE_COUNT):
+        searchURL = GetGuideListingURL(appID, pageIdx)
         data = GetMessageWithRetries(commConn, searchURL)
         if data is None:
             print('Could not download page %d of "%s"' % (pageIdx, appID))
         else:
-            text = data.decode('utf-8', 'backslashreplace')
+            text = DecodePageText(data)
             
             print('Got page %d of guides for app "%s"' % (pageIdx, appID))
             
+            knownIDs = sync.StartPage(pageIdx, searchGuideReg.findall(text))
+            
             db.execute('BEGIN TRANSACTION;')
             
             counter = 0
             for match in searchGuideReg.finditer(text):
                 guideID = match.group(1)
+                counter += 1
+                if guideID in knownIDs:
+                    continue
+                
                 guideURL = '/sharedfiles/filedetails/?id=%s' % guideID
-                guideData = GetMessageWithRetries(commConn, guideURL)
+                guideData, validators = FetchPageIfChanged(commConn, guideURL, GetPageValidators(db, guideURL))
                 if guideData is None:
                     print('Could not download guide "%s" for app "%s"' % (guideID, appID))
+                elif guideData is PAGE_UNCHANGED:
+                    print('Guide "%s" for app "%s" hasn\'t changed' % (guideID, appID))
+                    SavePageValidators(db, guideURL, validators)
                 else:
                     print('Got guide "%s" for app "%s"' % (guideID, appID))
-                    guideText = guideData.decode('utf-8', 'backslashreplace')
-                    ScrapeGuideTextForImages(appID, db, guideID, guideText)
-                    db.execute('INSERT OR IGNORE INTO Guides VALUES(?,?)', (guideID, guideText))
-                    
-                counter += 1
-                
+                    guideText = DecodePageText(guideData)
+                    db.execute('INSERT OR REPLACE INTO Guides(id, pageHTML, pageBlob) VALUES(?,NULL,?)', (guideID, PutBlobText(db, 'steam/guide', guideText)))
+                    ScrapeGuideTextForImages(appID, db, guideID, guideText, guideURL, validators)
                 
+            imagePageValidators[appID].WriteReady(db)
+            sync.SaveProgress(pageIdx + 1)
             db.execute('COMMIT;')
             db.commit()
                     
             if counter <= 0:
                 print('Reached last page of guides')
+                sync.Finish()
+                break
+            
+            if sync.IsCaughtUp():
+                sync.Finish()
                 break
 
 discussionSearchLinkReg = re.compile(r'<a class="forum_topic_overlay" href="https:\/\/steamcommunity\.com(\/app\/[0-9]*\/discussions\/0\/([0-9]*)\/)">')
 discussionCommentCountReg = re.compile(r'[0-9]*</span> of <span id="commentthread_ForumTopic_[0-9_]*_pagetotal">([0-9,]*)</span> comments')
 discussionCommentIDReg = re.compile(r'id="comment_([0-9]*)"')
 
+@Traced('parse replies', 'parse')
 def ScrapeDiscussionPageForReplies(appID, db, discussionID, pageHTML):
+    replies = []
     replyParts = pageHTML.split('<div class="commentthread_comment responsive_body_text   "')[1:]
     for reply in replyParts:
         match = discussionCommentIDReg.search(reply)
         if match:
             commentID = match.group(1)
-            db.execute('INSERT OR IGNORE INTO DiscussionReplies VALUES(?,?,?);', (commentID, discussionID, reply))
+            replies.append((commentID, discussionID, reply))
         else:
             print('Could not find comment id...')
+    
+    db.executemany('INSERT OR IGNORE INTO DiscussionReplies VALUES(?,?,?);', replies)
+    IndexReplies(db, replies)
+
+# Returns how many pages of replies the discussion has, or None if the comment count isn't on the page
+def GetDiscussionPageCount(appID, discussionID, firstPageText):
+    match = discussionCommentCountReg.search(firstPageText)
+    if match:
+        commentCountText = match.group(1)
+        print('Discussion "%s" for app "%s" has "%s" comments' % (discussionID, appID, commentCountText))
+        
+        commentCount = int(commentCountText.replace(',', ''))
+        commentsPerPage = 15
+        return (commentCount + commentsPerPage - 1) // commentsPerPage
+    else:
+        print('Could not find comment count for discussion "%s" for app "%s"' % (discussionID, appID))
+        return None
                 
-def ScrapeDiscussionURL(appID, db, discussionID, discussionURL):
-    firstPageData = GetMessageWithRetries(commConn, discussionURL)
+# Long discussions are committed (and checkpointed, through onProgress) every this many pages
+DISCUSSION_CHECKPOINT_PAGES = 20
+
+# Fetches the pages on discussionPagePool, and returns their data (or None) in the same order
+def FetchDiscussionPages(discussionURL, pageIdxs):
+    return list(discussionPagePool.map(lambda i: GetMessageWithRetries(commConn, discussionURL + '?ctp=%d' % i), pageIdxs))
+
+# Starts from page startPage of the discussion (the first page is always fetched though, for the comment count).
+# The rest of the pages are fetched DISCUSSION_WORKER_COUNT at a time, a checkpoint's worth at once, and stored in order.
+# This is called inside the discussion listing's transaction, and for long discussions it commits that transaction
+# every DISCUSSION_CHECKPOINT_PAGES pages, calling onProgress(nextPage) first so the checkpoint goes in with it
+#
+# If the first page hasn't changed since the last time the whole discussion was scraped, there are no new replies, so we skip the rest
+def ScrapeDiscussionURL(appID, db, discussionID, discussionURL, startPage=1, onProgress=None):
+    firstPageData, validators = FetchPageIfChanged(commConn, discussionURL, GetPageValidators(db, discussionURL))
     if firstPageData is None:
         print('Could not download first page of discussion "%s" for app "%s"' % (discussionID, appID))
+    elif firstPageData is PAGE_UNCHANGED:
+        print('Discussion "%s" for app "%s" hasn\'t changed' % (discussionID, appID))
+        SavePageValidators(db, discussionURL, validators)
     else:
-        firstPageText = firstPageData.decode('utf-8', 'backslashreplace')
+        firstPageText = DecodePageText(firstPageData)
         
-        db.execute('INSERT OR IGNORE INTO Discussions VALUES(?,?);', (discussionID, firstPageText))
+        db.execute('INSERT OR REPLACE INTO Discussions(discussionID, pageHTML, pageBlob) VALUES(?,NULL,?);', (discussionID, PutBlobText(db, 'steam/discussion', firstPageText)))
         
-        match = discussionCommentCountReg.search(firstPageText)
-        if match:
-            commentCountText = match.group(1)
-            print('Discussion "%s" for app "%s" has "%s" comments' % (discussionID, appID, commentCountText))
-            
-            commentCount = int(commentCountText.replace(',', ''))
-            commentsPerPage = 15
-            pageCount = (commentCount + commentsPerPage - 1) // commentsPerPage
-            
+        pageCount = GetDiscussionPageCount(appID, discussionID, firstPageText)
+        complete = pageCount is not None
+        if pageCount is not None:
             print('Grabbing %d pages...' % pageCount)
             
-            ScrapeDiscussionPageForReplies(appID, db, discussionID, firstPageText)
+            if startPage <= 1:
+                ScrapeDiscussionPageForReplies(appID, db, discussionID, firstPageText)
+            else:
+                print('Resuming at page %d...' % startPage)
             
-            for i in range(2, pageCount+1):
-                pageData = GetMessageWithRetries(commConn, discussionURL + '?ctp=%d' % i)
-                if pageData is None:
-                    print('Could not download page %d of discussion "%s" for app "%s"' % (i, discussionID, appID))
-                else:
-                    print('Scraping page %d...' % i)
-                    ScrapeDiscussionPageForReplies(appID, db, discussionID, pageData.decode('utf-8', 'backslashreplace'))
+            chunkStart = max(2, startPage)
+            while chunkStart <= pageCount:
+                # Up to (and including) the next page we'd checkpoint after
+                chunkEnd = min(pageCount, ((chunkStart - 1) // DISCUSSION_CHECKPOINT_PAGES + 1) * DISCUSSION_CHECKPOINT_PAGES)
+                pageIdxs = list(range(chunkStart, chunkEnd + 1))
+                
+                for i, pageData in zip(pageIdxs, FetchDiscussionPages(discussionURL, pageIdxs)):
+                    if pageData is None:
+                        print('Could not download page %d of discussion "%s" for app "%s"' % (i, discussionID, appID))
+                        complete = False
+                    else:
+                        print('Scraping page %d...' % i)
+                        ScrapeDiscussionPageForReplies(appID, db, discussionID, DecodePageText(pageData))
+                
+                if onProgress is not None and chunkEnd < pageCount:
+                    onProgress(chunkEnd + 1)
+                    db.execute('COMMIT;')
+                    db.execute('BEGIN TRANSACTION;')
+                
+                chunkStart = chunkEnd + 1
+        
+        # Only once all the pages are in, so an interrupted or incomplete discussion doesn't look unchanged next time
+        if complete:
+            SavePageValidators(db, discussionURL, validators)
         else:
-            print('Could not find comment count for discussion "%s" for app "%s"' % (discussionID, appID))
+            ClearPageValidators(db, discussionURL)
                 
 
+def GetDiscussionListingURL(appID, pageIdx):
+    return '/app/%s/discussions/?fp=%d' % (appID, pageIdx)
+
 def ScrapeAppCommunityDiscussion(appID, db):
-    for pageIdx in range(1, MAX_GUIDE_PAGE_COUNT+1):
-        searchURL = '/app/%s/discussions/?fp=%d' % (appID, pageIdx)
+    sync = SectionSync(db, 'discussions')
+    
+    # If we're resuming in the middle of a listing page: the discussions on it that are already stored,
+    # and how far we got into the one after them
+    doneIDs = sync.resumeState.get('doneIDs', [])
+    partial = sync.resumeState.get('partial')
+    
+    for pageIdx in range(sync.startPageIdx, MAX_GUIDE_PAGE_COUNT+1):
+        searchURL = GetDiscussionListingURL(appID, pageIdx)
         data = GetMessageWithRetries(commConn, searchURL)
         if data is None:
             print('Could not download page %d of "%s" discussions' % (pageIdx, appID))
         else:
-            text = data.decode('utf-8', 'backslashreplace')
+            text = DecodePageText(data)
             
             print('Got page %d of discussions for app "%s"' % (pageIdx, appID))
             
+            # Known discussions still get scraped again, since they could have new replies
+            sync.StartPage(pageIdx, [match[1] for match in discussionSearchLinkReg.findall(text)])
+            
             db.execute('BEGIN TRANSACTION;')
             
             counter = 0
@@ -378,70 +619,85 @@ def ScrapeAppCommunityDiscussion(appID, db):
             for match in discussionSearchLinkReg.finditer(text):
                 discussionURL = match.group(1)
                 discussionID = match.group(2)
-                ScrapeDiscussionURL(appID, db, discussionID, discussionURL)
                 counter += 1
+                if discussionID in doneIDs:
+                    continue
+                
+                startPage = 1
+                if partial is not None and partial['id'] == discussionID:
+                    startPage = partial['nextPage']
+                
+                def SaveDiscussionProgress(nextPage):
+                    sync.SaveProgress(pageIdx, {'doneIDs': doneIDs, 'partial': {'id': discussionID, 'nextPage': nextPage}})
+                
+                ScrapeDiscussionURL(appID, db, discussionID, discussionURL, startPage, SaveDiscussionProgress)
+                doneIDs.append(discussionID)
             
+            sync.SaveProgress(pageIdx + 1)
             db.execute('COMMIT;')
             db.commit()
             
+            doneIDs = []
+            partial = None
+            
             if counter <= 0:
                 print('Past last page of discussions')
+                sync.Finish()
+                break
+            
+            if sync.IsCaughtUp():
+                sync.Finish()
                 break
                 
 def ScrapeAppCommunityHomePage(appID):
     path = '/app/%s' % appID
     filename = 'data/%s/homepage.html' % appID
-    if not os.path.exists(filename):
+    if not FileExists(filename):
         data = GetMessageWithRetries(commConn, path)
-        with open(filename, 'wb') as f:
+        with Span('write homepage', 'fs'), open(filename, 'wb') as f:
             f.write(data)
    
 workshopItemImageReg = re.compile(r"<a onclick=\"ShowEnlargedImagePreview\( 'https:\/\/steamuserimages-a.akamaihd.net(\/ugc\/[0-9A-Za-z]*\/[0-9A-Za-z]*\/)' \);\">")
    
-def ScrapeWorkshopItemPageForImages(appID, db, itemID, pageHTML):
+def FindWorkshopItemImages(appID, db, itemID, pageHTML):
     dirname = 'data/%s/workshopIMG/%s' % (appID, itemID)
-    
-    for match in workshopItemImageReg.finditer(pageHTML):
-        imageLink = match.group(1)
-        imgParts = imageLink.split('/')
-        # Get the last two non-empty parts of the path
-        filename = '%s/%s_%s.jpg' % (dirname, imgParts[-3], imgParts[-2])
-        
-        db.execute('INSERT OR IGNORE INTO WorkshopItemImages VALUES(?,?)', (itemID, imageLink))
-        
-        if os.path.exists(filename):
-            print('Skipping "%s", already grabbed' % imageLink)
-        else:
-            print('DL "%s" -> "%s"' % (imageLink, filename))
-            data = GetMessageWithRetries(userImgConn, imageLink)
-            if data is None:
-                print('Could not download "%s"...' % imageLink)
-            else:
-                MaybeMakeDirectory(dirname)
-                with open(filename, 'wb') as f:
-                    f.write(data)
+    return FindImagesInPage(db, mediaManifests[appID], workshopItemImageReg, 'WorkshopItemImages', itemID, dirname, pageHTML)
+
+# Also saves the item's validators, once the images are in (see ImagePageValidators)
+def ScrapeWorkshopItemPageForImages(appID, db, itemID, pageHTML, itemURL, validators):
+    downloads = FindWorkshopItemImages(appID, db, itemID, pageHTML)
+    onDone = imagePageValidators[appID].Add(db, itemURL, validators, len(downloads))
+    for imageLink, filename in downloads:
+        mediaPool.Submit(userImgConn, imageLink, filename, onDone=onDone, manifest=mediaManifests[appID], group=appID)
         
    
 # TODO: Grab description, discussions, comments (<div class="commentthread_comment_content">), change notes
 def ScrapeAppCommunityWorkshopItemMetadata(appID, db, itemID):
     print('Scraping item "%s" for app "%s"' % (itemID, appID))
     itemURL = '/sharedfiles/filedetails/%s' % itemID
-    data = GetMessageWithRetries(commConn, itemURL)
+    data, validators = FetchPageIfChanged(commConn, itemURL, GetPageValidators(db, itemURL))
     if data is None:
         print('Could not get main page for item "%s" on app "%s"' % (itemID, appID))
+    elif data is PAGE_UNCHANGED:
+        print('Item "%s" on app "%s" hasn\'t changed' % (itemID, appID))
+        SavePageValidators(db, itemURL, validators)
     else:
-        text = data.decode('utf-8', 'backslashreplace')
-        db.execute('INSERT OR IGNORE INTO WorkshopItems VALUES(?,?);', (itemID, text))
+        text = DecodePageText(data)
+        db.execute('INSERT OR REPLACE INTO WorkshopItems(itemID, pageHTML, pageBlob) VALUES(?,NULL,?);', (itemID, PutBlobText(db, 'steam/workshop', text)))
         
-        ScrapeWorkshopItemPageForImages(appID, db, itemID, text)
+        ScrapeWorkshopItemPageForImages(appID, db, itemID, text, itemURL, validators)
         
                 
 workshopSearchItemsReg = re.compile(r'<a href="https:\/\/steamcommunity.com\/sharedfiles\/filedetails\/\?id=([0-9]*)&searchtext="><div class="workshopItemTitle ellipsis">')
             
         
+def GetWorkshopListingURL(appID, pageIdx):
+    return '/workshop/browse/?appid=%s&browsesort=mostrecent&section=readytouseitems&actualsort=mostrecent&p=%d' % (appID, pageIdx)
+
 def ScrapeAppCommunityWorkshopMetadata(appID, db):
-    for pageIdx in range(1, MAX_WORKSHOP_PAGE_COUNT + 1):
-        searchURL = '/workshop/browse/?appid=%s&browsesort=mostrecent&section=readytouseitems&actualsort=mostrecent&p=%d' % (appID, pageIdx)
+    sync = SectionSync(db, 'workshop')
+    for pageIdx in range(sync.startPageIdx, MAX_WORKSHOP_PAGE_COUNT + 1):
+        searchURL = GetWorkshopListingURL(appID, pageIdx)
         data = GetMessageWithRetries(commConn, searchURL)
         if data is None:
             print('Could not get search page %d for workshop items for app %s' % (pageIdx, appID))
@@ -451,21 +707,31 @@ def ScrapeAppCommunityWorkshopMetadata(appID, db):
             
             counter = 0
         
-            text = data.decode('utf-8', 'backslashreplace')
+            text = DecodePageText(data)
+            knownIDs = sync.StartPage(pageIdx, workshopSearchItemsReg.findall(text))
             for match in workshopSearchItemsReg.finditer(text):
                 workshopItemID = match.group(1)
+                counter += 1
+                if workshopItemID in knownIDs:
+                    continue
+                
                 ScrapeAppCommunityWorkshopItemMetadata(appID, db, workshopItemID)
                 
                 # MARK: Downloads the actual files from workshop
                 #GrabWorkshopFilesForItem(appID, workshopItemID)
                 
-                counter += 1
-                
+            imagePageValidators[appID].WriteReady(db)
+            sync.SaveProgress(pageIdx + 1)
             db.execute('COMMIT;')
             db.commit()
             
             if counter == 0:
                 print('Reached last page of workshop')
+                sync.Finish()
+                break
+            
+            if sync.IsCaughtUp():
+                sync.Finish()
                 break
     
                 
@@ -485,8 +751,405 @@ def ScrapeAppCommunity(appID):
     ScrapeAppCommunityGuides(appID, db)
     ScrapeAppCommunityDiscussion(appID, db)
     
-if len(sys.argv) < 2:
-    print('Please specify at least one app id')
+    # Don't move on to the next app until all of this one's images are on disk (only this one's: with --parallel,
+    # the other apps' images are in the same pool)
+    mediaPool.Wait(appID)
+    imagePageValidators.pop(appID).WriteReady(db)
+    db.commit()
+    del mediaManifests[appID]
+    db.close()
+    
+#---------------------------------
+# asyncio crawl engine (--async)
+#
+# Listing pages, detail pages (guides, discussions, workshop items) and images are three separate pipeline stages,
+# joined by bounded queues. Each section walks its listing pages a few at a time and queues up the detail pages it finds,
+# a set of detail workers fetch and store those and queue up any images, and a set of media workers download the images.
+# Every fetch is limited by a semaphore for its host, so the number of requests in flight to steamcommunity.com
+# is --concurrency and to steamuserimages is --media-workers.
+#
+# The fetches themselves still go through GetMessageWithRetries on a thread pool, and all the database work happens on the event loop
+# thread, so the DBWriter is only ever used from one thread (the writes themselves happen on its own thread).
+#
+# The checkpoints saved with every commit have the next listing page of each section, along with the detail items that were
+# queued up but not stored yet, and --resume queues those up again before carrying on with the listings.
+# (The sync engine only uses the page index from these, so resume with the engine that made the checkpoint.)
+
+# How many requests are in flight to steamcommunity.com at once in --async mode (can be overridden with --concurrency=N)
+ASYNC_PAGE_CONCURRENCY = 8
+
+# How many listing pages of one section are fetched at once
+ASYNC_LISTING_WINDOW = 4
+
+# How many items can be waiting in each stage's queue before the stage before it waits
+ASYNC_DETAIL_QUEUE_SIZE = 64
+ASYNC_MEDIA_QUEUE_SIZE = 256
+
+# Commit after this many detail items have been stored
+ASYNC_COMMIT_INTERVAL = 50
+
+# Which section each kind of detail item belongs to
+ASYNC_ITEM_SECTIONS = {'guide': 'guides', 'discussion': 'discussions', 'workshop': 'workshop'}
+
+@Traced('write homepage', 'fs')
+def WriteHomePageFile(filename, data):
+    MaybeMakeDirectory(os.path.dirname(filename))
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+class AsyncAppCrawl:
+    def __init__(self, appID, db, concurrency, mediaConcurrency):
+        self.appID = appID
+        self.db = db
+        self.concurrency = concurrency
+        self.mediaConcurrency = mediaConcurrency
+        self.loop = asyncio.get_running_loop()
+        # A couple of extra threads so file writes don't have to wait behind fetches
+        self.executor = ThreadPoolExecutor(max_workers=concurrency + mediaConcurrency + 2)
+        self.hostLimits = {commConn: asyncio.Semaphore(concurrency), userImgConn: asyncio.Semaphore(mediaConcurrency)}
+        self.detailQueue = asyncio.Queue(maxsize=ASYNC_DETAIL_QUEUE_SIZE)
+        self.mediaQueue = asyncio.Queue(maxsize=ASYNC_MEDIA_QUEUE_SIZE)
+        self.uncommittedCount = 0
+        self.syncs = dict((section, SectionSync(db, section)) for section in SECTION_ID_COLUMNS)
+        
+        # For the checkpoints: the next listing page for each section, whether its listing is done,
+        # and the detail items that have been queued up but not stored yet
+        self.nextPageIdx = dict((section, sync.startPageIdx) for section, sync in self.syncs.items())
+        self.listingDone = dict((section, sync.resumeState.get('listingDone', False)) for section, sync in self.syncs.items())
+        self.outstanding = dict((section, {}) for section in self.syncs)
+    
+    async def Fetch(self, pool, url):
+        async with self.hostLimits[pool]:
+            return await self.loop.run_in_executor(self.executor, GetMessageWithRetries, pool, url)
+    
+    async def FetchText(self, url):
+        data = await self.Fetch(commConn, url)
+        if data is None:
+            return None
+        return DecodePageText(data)
+    
+    # Returns (text, validators), where text is None or PAGE_UNCHANGED like FetchPageIfChanged
+    async def FetchTextIfChanged(self, url):
+        oldValidators = GetPageValidators(self.db, url)
+        async with self.hostLimits[commConn]:
+            data, validators = await self.loop.run_in_executor(self.executor, FetchPageIfChanged, commConn, url, oldValidators)
+        if data is None or data is PAGE_UNCHANGED:
+            return (data, validators)
+        return (DecodePageText(data), validators)
     
-for arg in sys.argv[1:]:
-    ScrapeAppCommunity(arg)
+    def MaybeCommit(self, force=False):
+        self.uncommittedCount += 1
+        if force or self.uncommittedCount >= ASYNC_COMMIT_INTERVAL:
+            self.SaveCheckpoints()
+            self.db.commit()
+            self.uncommittedCount = 0
+    
+    def SaveCheckpoints(self):
+        imagePageValidators[self.appID].WriteReady(self.db)
+        for section, sync in self.syncs.items():
+            outstanding = list(self.outstanding[section].values())
+            if self.listingDone[section] and len(outstanding) == 0:
+                ClearCheckpoint(self.db, sync.checkpointName)
+            else:
+                sync.SaveProgress(self.nextPageIdx[section], {'listingDone': self.listingDone[section], 'outstanding': outstanding})
+    
+    async def QueueDetail(self, item):
+        self.outstanding[ASYNC_ITEM_SECTIONS[item[0]]][item[1]] = list(item)
+        await self.detailQueue.put(item)
+    
+    # onDone (if given) is called with True/False as each of them finishes
+    async def QueueImages(self, downloads, onDone=None):
+        for imgURLPath, filename in downloads:
+            await self.mediaQueue.put((imgURLPath, filename, onDone))
+    
+    # Fetches listing pages ASYNC_LISTING_WINDOW at a time, and hands them to handlePage in order.
+    # handlePage gets None for pages that couldn't be downloaded, and returns False once we're past the last page
+    async def CrawlListing(self, section, getURL, maxPageIdx, handlePage):
+        if self.listingDone[section]:
+            return
+        
+        pageIdx = self.nextPageIdx[section]
+        while pageIdx <= maxPageIdx:
+            pageIdxs = range(pageIdx, min(pageIdx + ASYNC_LISTING_WINDOW, maxPageIdx + 1))
+            texts = await asyncio.gather(*[self.FetchText(getURL(self.appID, idx)) for idx in pageIdxs])
+            for idx, text in zip(pageIdxs, texts):
+                if not await handlePage(idx, text):
+                    self.listingDone[section] = True
+                    self.MaybeCommit(force=True)
+                    return
+                self.nextPageIdx[section] = idx + 1
+                self.MaybeCommit(force=True)
+            pageIdx += ASYNC_LISTING_WINDOW
+    
+    async def HandleScreenshotListingPage(self, pageIdx, text):
+        print('Grabbed page %d of screenshots for app "%s"' % (pageIdx, self.appID))
+        if text is None:
+            print('Welp, couldn\'t download steam community screenshots page %d for "%s"' % (pageIdx, self.appID))
+            return True
+        
+        sync = self.syncs['screenshots']
+        elements = text.split('<div class="apphub_Card modalContentLink interactable"')
+        if len(elements) <= 1:
+            print('Reached final page')
+            sync.Finish()
+            return False
+        
+        sync.StartPage(pageIdx, screenshotIDReg.findall(text))
+        for element in elements[1:]:
+            screenshot = ParseScreenshotElement(self.appID, element)
+            if screenshot is None:
+                continue
+            
+            screenshotID, bestImgURL, download = screenshot
+            self.db.execute('INSERT OR IGNORE INTO Screenshots VALUES(?,?,?);', (screenshotID, element, bestImgURL))
+            if download is not None:
+                await self.QueueImages([download])
+        
+        if sync.IsCaughtUp():
+            sync.Finish()
+            return False
+        return True
+    
+    async def HandleGuideListingPage(self, pageIdx, text):
+        if text is None:
+            print('Could not download page %d of "%s"' % (pageIdx, self.appID))
+            return True
+        
+        print('Got page %d of guides for app "%s"' % (pageIdx, self.appID))
+        sync = self.syncs['guides']
+        knownIDs = sync.StartPage(pageIdx, searchGuideReg.findall(text))
+        counter = 0
+        for match in searchGuideReg.finditer(text):
+            counter += 1
+            if match.group(1) not in knownIDs:
+                await self.QueueDetail(('guide', match.group(1)))
+        
+        if counter <= 0:
+            print('Reached last page of guides')
+            sync.Finish()
+            return False
+        if sync.IsCaughtUp():
+            sync.Finish()
+            return False
+        return True
+    
+    async def HandleDiscussionListingPage(self, pageIdx, text):
+        if text is None:
+            print('Could not download page %d of "%s" discussions' % (pageIdx, self.appID))
+            return True
+        
+        print('Got page %d of discussions for app "%s"' % (pageIdx, self.appID))
+        sync = self.syncs['discussions']
+        # Known discussions still get scraped again, since they could have new replies
+        sync.StartPage(pageIdx, [match[1] for match in discussionSearchLinkReg.findall(text)])
+        counter = 0
+        for match in discussionSearchLinkReg.finditer(text):
+            await self.QueueDetail(('discussion', match.group(2), match.group(1)))
+            counter += 1
+        
+        if counter <= 0:
+            print('Past last page of discussions')
+            sync.Finish()
+            return False
+        if sync.IsCaughtUp():
+            sync.Finish()
+            return False
+        return True
+    
+    async def HandleWorkshopListingPage(self, pageIdx, text):
+        if text is None:
+            print('Could not get search page %d for workshop items for app %s' % (pageIdx, self.appID))
+            return False
+        
+        sync = self.syncs['workshop']
+        knownIDs = sync.StartPage(pageIdx, workshopSearchItemsReg.findall(text))
+        counter = 0
+        for match in workshopSearchItemsReg.finditer(text):
+            counter += 1
+            if match.group(1) not in knownIDs:
+                await self.QueueDetail(('workshop', match.group(1)))
+        
+        if counter == 0:
+            print('Reached last page of workshop')
+            sync.Finish()
+            return False
+        if sync.IsCaughtUp():
+            sync.Finish()
+            return False
+        return True
+    
+    async def ScrapeGuide(self, guideID):
+        guideURL = '/sharedfiles/filedetails/?id=%s' % guideID
+        guideText, validators = await self.FetchTextIfChanged(guideURL)
+        if guideText is None:
+            print('Could not download guide "%s" for app "%s"' % (guideID, self.appID))
+            return
+        elif guideText is PAGE_UNCHANGED:
+            print('Guide "%s" for app "%s" hasn\'t changed' % (guideID, self.appID))
+            SavePageValidators(self.db, guideURL, validators)
+            return
+        
+        print('Got guide "%s" for app "%s"' % (guideID, self.appID))
+        downloads = FindGuideImages(self.appID, self.db, guideID, guideText)
+        self.db.execute('INSERT OR REPLACE INTO Guides(id, pageHTML, pageBlob) VALUES(?,NULL,?)', (guideID, PutBlobText(self.db, 'steam/guide', guideText)))
+        await self.QueueImages(downloads, imagePageValidators[self.appID].Add(self.db, guideURL, validators, len(downloads)))
+    
+    async def ScrapeDiscussion(self, discussionID, discussionURL):
+        firstPageText, validators = await self.FetchTextIfChanged(discussionURL)
+        if firstPageText is None:
+            print('Could not download first page of discussion "%s" for app "%s"' % (discussionID, self.appID))
+            return
+        elif firstPageText is PAGE_UNCHANGED:
+            print('Discussion "%s" for app "%s" hasn\'t changed' % (discussionID, self.appID))
+            SavePageValidators(self.db, discussionURL, validators)
+            return
+        
+        self.db.execute('INSERT OR REPLACE INTO Discussions(discussionID, pageHTML, pageBlob) VALUES(?,NULL,?);', (discussionID, PutBlobText(self.db, 'steam/discussion', firstPageText)))
+        
+        pageCount = GetDiscussionPageCount(self.appID, discussionID, firstPageText)
+        complete = pageCount is not None
+        if pageCount is not None:
+            print('Grabbing %d pages...' % pageCount)
+            ScrapeDiscussionPageForReplies(self.appID, self.db, discussionID, firstPageText)
+            
+            # The page urls are all known up front, so fetch the rest of them at once (the host semaphore keeps this in check)
+            pageIdxs = range(2, pageCount + 1)
+            pageTexts = await asyncio.gather(*[self.FetchText(discussionURL + '?ctp=%d' % i) for i in pageIdxs])
+            for i, pageText in zip(pageIdxs, pageTexts):
+                if pageText is None:
+                    print('Could not download page %d of discussion "%s" for app "%s"' % (i, discussionID, self.appID))
+                    complete = False
+                else:
+                    ScrapeDiscussionPageForReplies(self.appID, self.db, discussionID, pageText)
+        
+        if complete:
+            SavePageValidators(self.db, discussionURL, validators)
+        else:
+            ClearPageValidators(self.db, discussionURL)
+    
+    async def ScrapeWorkshopItem(self, itemID):
+        print('Scraping item "%s" for app "%s"' % (itemID, self.appID))
+        itemURL = '/sharedfiles/filedetails/%s' % itemID
+        text, validators = await self.FetchTextIfChanged(itemURL)
+        if text is None:
+            print('Could not get main page for item "%s" on app "%s"' % (itemID, self.appID))
+            return
+        elif text is PAGE_UNCHANGED:
+            print('Item "%s" on app "%s" hasn\'t changed' % (itemID, self.appID))
+            SavePageValidators(self.db, itemURL, validators)
+            return
+        
+        self.db.execute('INSERT OR REPLACE INTO WorkshopItems(itemID, pageHTML, pageBlob) VALUES(?,NULL,?);', (itemID, PutBlobText(self.db, 'steam/workshop', text)))
+        downloads = FindWorkshopItemImages(self.appID, self.db, itemID, text)
+        await self.QueueImages(downloads, imagePageValidators[self.appID].Add(self.db, itemURL, validators, len(downloads)))
+    
+    async def ScrapeHomePage(self):
+        filename = 'data/%s/homepage.html' % self.appID
+        if not FileExists(filename):
+            data = await self.Fetch(commConn, '/app/%s' % self.appID)
+            if data is not None:
+                await self.loop.run_in_executor(self.executor, WriteHomePageFile, filename, data)
+    
+    async def DetailWorker(self):
+        while True:
+            item = await self.detailQueue.get()
+            try:
+                if item[0] == 'guide':
+                    await self.ScrapeGuide(item[1])
+                elif item[0] == 'discussion':
+                    await self.ScrapeDiscussion(item[1], item[2])
+                elif item[0] == 'workshop':
+                    await self.ScrapeWorkshopItem(item[1])
+            except Exception:
+                print('Got exception on %s "%s" for app "%s"' % (item[0], item[1], self.appID))
+                traceback.print_exc()
+            else:
+                # Items that hit an exception stay in the checkpoint, so --resume tries them again
+                self.outstanding[ASYNC_ITEM_SECTIONS[item[0]]].pop(item[1], None)
+                self.MaybeCommit()
+            finally:
+                self.detailQueue.task_done()
+    
+    async def MediaWorker(self):
+        while True:
+            imgURLPath, filename, onDone = await self.mediaQueue.get()
+            success = False
+            try:
+                async with self.hostLimits[userImgConn]:
+                    success = await self.loop.run_in_executor(self.executor, DownloadToManifest, mediaManifests[self.appID], userImgConn, imgURLPath, filename)
+                if not success:
+                    print('Could not download "%s"...' % imgURLPath)
+            except Exception:
+                print('Got exception downloading "%s"' % imgURLPath)
+                traceback.print_exc()
+            finally:
+                if onDone is not None:
+                    onDone(success)
+                self.mediaQueue.task_done()
+    
+    async def ResumeOutstanding(self):
+        for section, sync in self.syncs.items():
+            for item in sync.resumeState.get('outstanding', []):
+                await self.QueueDetail(tuple(item))
+    
+    async def Run(self):
+        workers = [asyncio.create_task(self.DetailWorker()) for i in range(self.concurrency)]
+        workers += [asyncio.create_task(self.MediaWorker()) for i in range(self.mediaConcurrency)]
+        
+        try:
+            await self.ResumeOutstanding()
+            await asyncio.gather(
+                self.ScrapeHomePage(),
+                self.CrawlListing('workshop', GetWorkshopListingURL, MAX_WORKSHOP_PAGE_COUNT, self.HandleWorkshopListingPage),
+                self.CrawlListing('screenshots', GetScreenshotListingURL, MAX_SCREENSHOT_PAGE_COUNT - 1, self.HandleScreenshotListingPage),
+                self.CrawlListing('guides', GetGuideListingURL, MAX_GUIDE_PAGE_COUNT - 1, self.HandleGuideListingPage),
+                self.CrawlListing('discussions', GetDiscussionListingURL, MAX_GUIDE_PAGE_COUNT, self.HandleDiscussionListingPage))
+            
+            # The listings are done, now wait for the stages after them to drain
+            await self.detailQueue.join()
+            await self.mediaQueue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self.SaveCheckpoints()
+            self.db.commit()
+            self.executor.shutdown(wait=False)
+
+def ScrapeAppCommunityAsync(appID, concurrency, mediaConcurrency):
+    if str(int(appID)) != appID:
+        print('Incorrect app id: "%s"' % appID)
+        return
+
+    db = GetAppMetadataDBReady(appID)
+    
+    async def Run():
+        await AsyncAppCrawl(appID, db, concurrency, mediaConcurrency).Run()
+    
+    asyncio.run(Run())
+    del imagePageValidators[appID]
+    del mediaManifests[appID]
+    db.close()
+    
+appIDs, flags = ParseArgs(sys.argv[1:])
+
+if len(appIDs) < 1:
+    print('Please specify at least one app id')
+
+MEDIA_WORKER_COUNT = GetIntFlag(flags, 'media-workers', MEDIA_WORKER_COUNT)
+DISCUSSION_WORKER_COUNT = GetIntFlag(flags, 'discussion-workers', DISCUSSION_WORKER_COUNT)
+INCREMENTAL_SYNC = 'incremental' in flags
+RESUME_CRAWL = 'resume' in flags
+userImgConn.SetMaxConns(MEDIA_WORKER_COUNT)
+StartWARCFromFlags(flags, 'steam')
+StartMetricsFromFlags(flags)
+StartTracingFromFlags(flags)
+
+if 'async' in flags:
+    ASYNC_PAGE_CONCURRENCY = GetIntFlag(flags, 'concurrency', ASYNC_PAGE_CONCURRENCY)
+    commConn.SetMaxConns(ASYNC_PAGE_CONCURRENCY)
+    RunTargets(appIDs, lambda appID: ScrapeAppCommunityAsync(appID, ASYNC_PAGE_CONCURRENCY, MEDIA_WORKER_COUNT), GetParallelTargetCount(flags))
+else:
+    mediaPool = MediaDownloadPool(MEDIA_WORKER_COUNT)
+    discussionPagePool = ThreadPoolExecutor(max(1, DISCUSSION_WORKER_COUNT))
+    commConn.SetMaxConns(max(DISCUSSION_WORKER_COUNT, MAX_CONNS_PER_HOST))
+    RunTargets(appIDs, ScrapeAppCommunity, GetParallelTargetCount(flags))
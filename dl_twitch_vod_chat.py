@@ -1,15 +1,39 @@
 # Twitch VOD chat archiving tool
 # Usage: python dl_twitch_vod_chat.py {VOD_ID1} {VOD_ID2} ...
 #
+# Options:
+#  --resume       Carry on each VOD from the offset where the last run stopped
+#  --segments=N   Split each VOD into N stretches of time and download them at once (needs the VOD's length from the API)
+#  --parallel=N   Download the chat of N VODs at once, sharing the same connections to the API (see anarchivist_targets.py)
+#  --warc[=DIR]   Also record every request and response, headers and all, in WARC files (with CDX indexes) in DIR
+#                 (default: warc). See anarchivist_warc.py
+#  --warc-max-mb=N   Start a new WARC file once the current one is N MB (default 1024)
+#  --metrics[=FILE]  Keep FILE (default metrics.json, plus a .prom copy) up to date with request latencies, retries, bytes,
+#                    backoff time and rows inserted, and print a progress line with an ETA every so often (this needs the
+#                    VOD's length, which is looked up for it). See anarchivist_metrics.py
+#  --metrics-interval=N   How many seconds between metrics updates (default 10)
+#  --trace[=FILE]    Time the stages of the download (fetch, decode, parse, db) and write them to FILE (default trace.json)
+#                    for chrome://tracing or Perfetto. See anarchivist_trace.py
+#  --profile[=DIR]   Also run each VOD under cProfile, saving the stats to "DIR/{VOD_ID}.prof" (default: profiles)
+#                    (VODs are run one at a time then, even with --parallel)
+#
 # Pretty straightforward: archives chat from Twitch VODs (includes commenter, text, and timestamp information)
 #
 # Stores JSON from each comment in a sqlite database, along with the UUID for the comment, and the video it was from.
-# All other information will be in the JSON.
+# All other information will be in the JSON. Comments are too small for the compressed blob store to be worth it, so the
+# JSON stays inline (rows from versions that did put it in the Blobs table still have it there, see anarchivist_blobstore.py).
+# The commenter, offset, body and emotes of each comment are also copied into the ChatMessages table, an extra index on
+# top of ChatData, so a stretch of a VOD's chat can be replayed without decoding all of it (see anarchivist_twitchchat.py
+# and replay_twitch_chat.py), and searched (see search_archive.py). The JSON in ChatData is still the full record.
 #
-# Reasonably fast, cause it can get comments in bulk (and also...it's text).
+# Reasonably fast, cause it can get comments in bulk (and also...it's text). The comments are written to the database
+# in batches on a separate thread (see anarchivist_dbwriter.py), so that doesn't hold up the requests.
 #
 # Dependencies:
 #  - Python 3, but honestly there's not much to it could probably get it working on anything
+#  - anarchivist_http.py, anarchivist_args.py, anarchivist_checkpoint.py, anarchivist_blobstore.py, anarchivist_dbwriter.py,
+#    anarchivist_targets.py, anarchivist_twitchchat.py, anarchivist_search.py, anarchivist_html.py, anarchivist_warc.py,
+#    anarchivist_metrics.py and anarchivist_trace.py from this repo
 
 import encodings.idna
 
@@ -21,115 +45,277 @@ import json
 
 import http.client
 
-from urllib.parse import urlencode
+from urllib.parse import urlencode, quote
 
 import sqlite3
 
 import os
 import sys
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from anarchivist_http import GetHostPool, GetMessageWithRetries
+from anarchivist_args import ParseArgs, GetIntFlag
+from anarchivist_targets import RunTargets, GetParallelTargetCount
+from anarchivist_checkpoint import CreateCheckpointTable, SaveCheckpoint, LoadCheckpoint, ClearCheckpoint
+from anarchivist_dbwriter import DBWriter
+from anarchivist_blobstore import CreateBlobTables, AddBlobColumn
+from anarchivist_twitchchat import CreateChatMessageTable, StoreChatMessage
+from anarchivist_search import CreateChatSearchIndex
+from anarchivist_warc import StartWARCFromFlags
+import anarchivist_metrics
+from anarchivist_metrics import StartMetricsFromFlags, SetProgress
+from anarchivist_trace import StartTracingFromFlags, Span
 
 # This seems to be public, or at the very least not tied to an individual
 # but rather shared by all desktop users
 # May be subject to change in the future
 TWITCH_CLIENT_ID = "kimne78kx3ncx6brgo4mv6wki5h1ko"
 
-def GetConn():
-    return http.client.HTTPSConnection("api.twitch.tv")
-
-TWconn = GetConn()
+TWconn = GetHostPool("api.twitch.tv")
 def DownloadURL(url, headers={}, postData=None):   
-    global TWconn
-    res = None
-    retry = True
-    ## If we get a ResponseNotReady error, it means our keepalive ran out
-    ## In that case, we re-establish our connection and try again
-    ## If we get a different error, it probably failed for real, so we just give up
-    
-    maxRetries = 15
-    
-    for i in range(maxRetries):
-        try:
-            ## TODO: Any headers that need to be set would go here
-            if postData is None:
-                TWconn.request("GET", url, headers=headers)
-            else:
-                TWconn.request('POST', url, urlencode(postData), headers=headers)
-            res = TWconn.getresponse()
-            break
-        except http.client.ResponseNotReady:
-            print("Re-establishing connection...")
-            TWconn = GetConn()
-        except Exception as e:
-            print("Encountered other error...")
-            ## For debugging, this is useful
-            ## Otherwise, immortality has its perks
-            #raise e
-            TWconn = GetConn()
-            #retry = False
-            
-        time.sleep(0.5)
+    if postData is not None:
+        postData = urlencode(postData)
+    return GetMessageWithRetries(TWconn, url, headers, postData=postData, maxRetries=15)
 
-    if res is not None and res.status == 200:   
-        return res.read()
-    elif res is not None and res.status == 301:
-        print ('Location: ' + res.getheader('Location'))
+        
+db = DBWriter('vod_chat.db')
+
+db.execute('CREATE TABLE IF NOT EXISTS ChatData(id VARCHAR(255) PRIMARY KEY, vodID VARCHAR(255), data TEXT, dataBlob VARCHAR(64));')
+db.execute('CREATE INDEX IF NOT EXISTS ChatDataVodID ON ChatData(vodID);')
+CreateCheckpointTable(db)
+CreateBlobTables(db)
+AddBlobColumn(db, 'ChatData', 'dataBlob')
+CreateChatMessageTable(db)
+CreateChatSearchIndex(db)
+        
+# Splits the VOD into this many offset ranges and downloads them at once (can be overridden with --segments=N)
+# 1 means walk the whole VOD from the start, like before
+VOD_SEGMENT_COUNT = 1
+
+# Segments shorter than this aren't worth the extra requests at their boundaries
+MIN_VOD_SEGMENT_SEC = 5 * 60
+
+def GetVODHeaders():
+    return {'Client-ID': TWITCH_CLIENT_ID}
+
+# Returns the length of the VOD in seconds, or None if we couldn't get it
+def GetVODDuration(vodID):
+    data = DownloadURL('/v5/videos/%s' % vodID, headers=GetVODHeaders())
+    if data is None:
         return None
-    elif res is not None:
-        print('Got status %d...' % res.status)
+    try:
+        return int(json.loads(data.decode('utf-8'))['length'])
+    except (ValueError, KeyError, TypeError):
         return None
+
+# Set on Ctrl-C, so the segments (which are on other threads) stop after the page they're on
+stopRequested = threading.Event()
+
+# Comment ids already stored for a VOD during this run, shared by its segments so the ones that
+# show up on both sides of a boundary only get stored once. Also counts what each VOD cost us
+class SeenComments:
+    def __init__(self):
+        self.ids = set()
+        self.lock = threading.Lock()
+        self.duplicateCount = 0
+        self.overlapCount = 0
+        self.requestCount = 0
+        # The VOD's length, if we looked it up, for progress reports
+        self.duration = None
+
+    # Returns True the first time it sees the id
+    def Add(self, id):
+        with self.lock:
+            if id in self.ids:
+                self.duplicateCount += 1
+                return False
+            self.ids.add(id)
+            return True
+
+    # Comments that came back outside the range we asked for (they're some other segment's)
+    def AddOverlap(self, count=1):
+        with self.lock:
+            self.overlapCount += count
+
+    def AddRequest(self):
+        with self.lock:
+            self.requestCount += 1
+
+def GetChatPage(vodID, headers, offsetSec=None, cursor=None):
+    if cursor is not None:
+        url = '/v5/videos/%s/comments?cursor=%s' % (vodID, quote(cursor))
     else:
+        url = '/v5/videos/%s/comments?content_offset_seconds=%d' % (vodID, offsetSec)
+    data = DownloadURL(url, headers=headers)
+    if data is None:
         return None
+    with Span('parse chat page', 'parse'):
+        return json.loads(data.decode('utf-8'))
 
-        
-db = sqlite3.connect('vod_chat.db', timeout=60.0)
+# For progress reports. The VOD's reported length can be a little short of its last comment
+def GetRangeLength(startSec, endSec, offsetSec, seen):
+    return (endSec or max(seen.duration, offsetSec)) - startSec
 
-db.execute('CREATE TABLE IF NOT EXISTS ChatData(id VARCHAR(255) PRIMARY KEY, vodID VARCHAR(255), data TEXT);')
-db.execute('CREATE INDEX IF NOT EXISTS ChatDataVodID ON ChatData(vodID);')
-        
-def DownloadChatForVOD(vodID):
-    if vodID != str(int(vodID)):
-        print('Invalid vod ID: "%s"' % vodID)
-        return
+# Downloads the comments with offsets from startSec up to (not including) endSec, or to the end of the VOD if endSec is None.
+# The first page is looked up by offset, after that we follow the _next cursor each page comes with, so no page
+# overlaps the one before it, and a burst of comments in one second can't be skipped over.
+# The checkpoint has the cursor (and the offset, in case the cursor has expired by the time we resume),
+# and is cleared once the range is done. Returns True if it got to the end
+def DownloadChatRange(vodID, startSec, endSec, checkpointName, seen, resumeState=None):
+    headers = GetVODHeaders()
+    
+    offsetSec = startSec
+    cursor = None
+    if resumeState is not None:
+        offsetSec = resumeState.get('offsetSec', startSec)
+        cursor = resumeState.get('cursor')
     
-    headers = {}
-    headers["Client-ID"] = TWITCH_CLIENT_ID
-
-    offsetSec = 0
     while True:
+        if stopRequested.is_set():
+            return False
+        
         print('Downloading comments from vod "%s" at offset %d' % (vodID, offsetSec))
-        url = '/v5/videos/%s/comments?content_offset_seconds=%d' % (vodID, offsetSec)
-        data = DownloadURL(url, headers=headers)
+        seen.AddRequest()
+        info = GetChatPage(vodID, headers, offsetSec, cursor)
+        if info is None and cursor is not None:
+            print('Could not follow the cursor for vod "%s", going by offset instead' % vodID)
+            cursor = None
+            seen.AddRequest()
+            info = GetChatPage(vodID, headers, offsetSec)
+        
+        if info is None:
+            # Leave the checkpoint, so --resume can try this range again
+            return False
         
-        if data is None:
+        comments = info.get('comments') or []
+        if len(comments) <= 0:
             break
-        else:
-            info = json.loads(data.decode('utf-8'))
             
-            if 'comments' not in info or len(info['comments']) <= 0:
-                break
+        print('   got %d comments' % len(comments))
+        
+        reachedEnd = False
+        db.execute('BEGIN TRANSACTION;')
+        for comment in comments:
+            offset = comment['content_offset_seconds']
+            id = comment['_id']
+            if offset < startSec or (endSec is not None and offset >= endSec):
+                # The segment next to this one gets it
+                seen.AddOverlap()
+                if endSec is not None and offset >= endSec:
+                    reachedEnd = True
+                continue
+            if seen.Add(id):
+                db.execute('INSERT OR IGNORE INTO ChatData(id, vodID, data, dataBlob) VALUES(?,?,?,NULL)', (id, vodID, json.dumps(comment)))
+                StoreChatMessage(db, vodID, comment)
+            offsetSec = max(offsetSec, int(offset))
                 
-            print('   got %d comments' % len(info['comments']))
-            
-            db.execute('BEGIN TRANSACTION;')
-            highestOffset = offsetSec + 1
-            for comment in info['comments']:
-                offset = int(comment['content_offset_seconds'])
-                id = comment['_id']
-                db.execute('INSERT OR IGNORE INTO ChatData VALUES(?,?,?)', (id, vodID, json.dumps(comment)))
-                if offset > highestOffset:
-                    highestOffset = offset
-                    
-                    
-            offsetSec = highestOffset
+        cursor = info.get('_next')
+        SaveCheckpoint(db, checkpointName, {'offsetSec': offsetSec, 'cursor': cursor})
+        if seen.duration is not None:
+            SetProgress(checkpointName, offsetSec - startSec, GetRangeLength(startSec, endSec, offsetSec, seen))
+    
+        db.execute('COMMIT;')
+        db.commit()
         
-            db.execute('COMMIT;')
+        if reachedEnd or cursor is None:
+            break
+    
+    ClearCheckpoint(db, checkpointName)
+    db.commit()
+    if seen.duration is not None:
+        rangeLength = GetRangeLength(startSec, endSec, offsetSec, seen)
+        SetProgress(checkpointName, rangeLength, rangeLength)
+    return True
+
+# Returns a list of [startSec, endSec] for each segment (the last one's endSec is None, so nothing past the reported length gets missed)
+def SplitVOD(duration, segmentCount):
+    segmentCount = max(1, min(segmentCount, duration // MIN_VOD_SEGMENT_SEC))
+    segmentLength = (duration + segmentCount - 1) // segmentCount
+    segments = [[i * segmentLength, (i + 1) * segmentLength] for i in range(segmentCount)]
+    segments[-1][1] = None
+    return segments
+
+# The VOD's own checkpoint records how it was split, and each segment has a checkpoint of its own under it,
+# saved in the same transaction, and cleared when the segment is done.
+# (a VOD that was started without --segments just has an offsetSec in its checkpoint, and is carried on that way)
+def DownloadChatForVOD(vodID):
+    if vodID != str(int(vodID)):
+        print('Invalid vod ID: "%s"' % vodID)
+        return
+    
+    checkpointName = 'twitch/%s' % vodID
+    state = None
+    if RESUME_CRAWL:
+        state = LoadCheckpoint(db, checkpointName)
+    
+    seen = SeenComments()
+    
+    segments = None
+    if state is not None and 'segments' in state:
+        segments = state['segments']
+        print('Resuming vod "%s" in %d segments' % (vodID, len(segments)))
+    elif state is None and VOD_SEGMENT_COUNT > 1:
+        duration = GetVODDuration(vodID)
+        seen.duration = duration
+        if duration is None:
+            print('Could not get the length of vod "%s", downloading it from the start' % vodID)
+        elif duration >= 2 * MIN_VOD_SEGMENT_SEC:
+            segments = SplitVOD(duration, VOD_SEGMENT_COUNT)
+            print('Vod "%s" is %d seconds long, downloading it in %d segments' % (vodID, duration, len(segments)))
+            SaveCheckpoint(db, checkpointName, {'segments': segments})
+            for i, (startSec, endSec) in enumerate(segments):
+                SaveCheckpoint(db, '%s/%d' % (checkpointName, i), {'offsetSec': startSec})
+            db.commit()
+    
+    if segments is not None:
+        # So the segments can read their checkpoints back
+        db.Flush()
+    
+    if seen.duration is None and anarchivist_metrics.metricsEnabled:
+        seen.duration = GetVODDuration(vodID)
+    
+    if segments is None or len(segments) <= 1:
+        DownloadChatRange(vodID, 0, None, checkpointName, seen, state)
+    else:
+        def DownloadSegment(i):
+            startSec, endSec = segments[i]
+            segmentCheckpointName = '%s/%d' % (checkpointName, i)
+            segmentState = LoadCheckpoint(db, segmentCheckpointName)
+            if segmentState is None:
+                # Finished in an earlier run
+                return True
+            return DownloadChatRange(vodID, startSec, endSec, segmentCheckpointName, seen, segmentState)
+        
+        with ThreadPoolExecutor(len(segments), thread_name_prefix='Segment') as executor:
+            try:
+                segmentsDone = list(executor.map(DownloadSegment, range(len(segments))))
+            except KeyboardInterrupt:
+                stopRequested.set()
+                raise
+        
+        if all(segmentsDone):
+            ClearCheckpoint(db, checkpointName)
             db.commit()
+    
+    print('Done with vod "%s": %d requests, got %d comments, skipped %d duplicates and %d overlapping a neighbouring segment' % (vodID, seen.requestCount, len(seen.ids), seen.duplicateCount, seen.overlapCount))
         
-if len(sys.argv) < 2:
+vodIDs, flags = ParseArgs(sys.argv[1:])
+
+# Pick each VOD up from the offset the last run left behind
+RESUME_CRAWL = 'resume' in flags
+VOD_SEGMENT_COUNT = GetIntFlag(flags, 'segments', VOD_SEGMENT_COUNT)
+StartWARCFromFlags(flags, 'twitch')
+StartMetricsFromFlags(flags)
+StartTracingFromFlags(flags)
+
+if len(vodIDs) < 1:
     print('Please specify at least one VOD id')
 
-for arg in sys.argv[1:]:
-    DownloadChatForVOD(arg)
+# The VODs all go in the same database, but the DBWriter keeps each thread's transactions separate
+RunTargets(vodIDs, DownloadChatForVOD, GetParallelTargetCount(flags))
+
+db.close()
  
 
@@ -0,0 +1,254 @@
+# Parses the raw HTML dl_steam.py archived into plain tables, without going back to the network
+# Usage: python extract_steam.py {APP_ID1} {APP_ID2} ...
+#
+# Options:
+#  --workers=N      How many processes to parse on (default: one per CPU)
+#  --chunk-size=N   How many rows each process is handed at a time (default 500)
+#  --all            Re-extract everything, not just the rows that are new or changed
+#
+# dl_steam.py keeps the pages (and screenshot cards, and discussion replies) as HTML and leaves the parsing for later.
+# This is later: it goes through data/{APP_ID}/meta.db and fills in
+#  - ExtractedScreenshots(id, author, authorURL, rating, title)
+#  - ExtractedGuides(id, title, author, postedAt, updatedAt, rating, ratingCount, visitors, subscribers, favorites, body)
+#  - ExtractedWorkshopItems(itemID, ...same columns as guides)
+#  - ExtractedDiscussions(discussionID, title, author, timestamp, body)
+#  - ExtractedReplies(commentID, discussionID, author, timestamp, body)
+# Bodies are plain text, timestamps on discussions/replies are unix times, and the "Posted"/"Updated" dates on guides
+# and workshop items are kept as Steam shows them. rating is a number of stars (0-5) for guides and workshop items,
+# and the number of votes for screenshots. Anything the page doesn't have is NULL.
+#
+# The keys of the rows to extract are read up front, then handed out in chunks to a pool of processes, which each read
+# their rows from the database (decompressing blobs there too) and send back the parsed columns. The main process
+# writes them and commits after every chunk, so it can be interrupted and run again.
+#
+# Every extracted row remembers the EXTRACTOR_VERSION that parsed it (and for pages, which blob it was parsed from),
+# so a re-run only parses rows that are new, whose page has been re-crawled since, or that were parsed by an older
+# version of this script. Bump EXTRACTOR_VERSION when the parsing changes.
+#
+# It's fine to run this while dl_steam.py is crawling the same app: the database is in WAL mode.
+#
+# Dependencies:
+#  - Python 3
+#  - anarchivist_html.py, anarchivist_blobstore.py, anarchivist_dbwriter.py and anarchivist_args.py from this repo
+
+import re
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+
+from anarchivist_args import ParseArgs, GetIntFlag
+from anarchivist_dbwriter import OpenDatabase
+from anarchivist_blobstore import ReadStoredText
+from anarchivist_html import GetDivContents, GetDivContentsAt, HTMLToText, ParseCount, GetGroup, GetSteamReplyText
+
+EXTRACTOR_VERSION = 1
+
+EXTRACT_CHUNK_SIZE = 500
+
+def CreateExtractedTables(db):
+    db.execute('CREATE TABLE IF NOT EXISTS ExtractedScreenshots(id VARCHAR(255) PRIMARY KEY, author VARCHAR(255), authorURL VARCHAR(255), rating INTEGER, title TEXT, extractorVersion INTEGER);')
+    db.execute('CREATE TABLE IF NOT EXISTS ExtractedGuides(id VARCHAR(255) PRIMARY KEY, title TEXT, author VARCHAR(255), postedAt VARCHAR(255), updatedAt VARCHAR(255), rating INTEGER, ratingCount INTEGER, visitors INTEGER, subscribers INTEGER, favorites INTEGER, body TEXT, sourceBlob VARCHAR(64), extractorVersion INTEGER);')
+    db.execute('CREATE TABLE IF NOT EXISTS ExtractedWorkshopItems(itemID VARCHAR(255) PRIMARY KEY, title TEXT, author VARCHAR(255), postedAt VARCHAR(255), updatedAt VARCHAR(255), rating INTEGER, ratingCount INTEGER, visitors INTEGER, subscribers INTEGER, favorites INTEGER, body TEXT, sourceBlob VARCHAR(64), extractorVersion INTEGER);')
+    db.execute('CREATE TABLE IF NOT EXISTS ExtractedDiscussions(discussionID VARCHAR(255) PRIMARY KEY, title TEXT, author VARCHAR(255), timestamp INTEGER, body TEXT, sourceBlob VARCHAR(64), extractorVersion INTEGER);')
+    db.execute('CREATE TABLE IF NOT EXISTS ExtractedReplies(commentID VARCHAR(255) PRIMARY KEY, discussionID VARCHAR(255), author VARCHAR(255), timestamp INTEGER, body TEXT, extractorVersion INTEGER);')
+    db.execute('CREATE INDEX IF NOT EXISTS ExtractedRepliesDiscussionIDIndex ON ExtractedReplies(discussionID);')
+    db.commit()
+
+#--------------------------------------
+# Screenshots (the apphub_Card snippet from the listing page)
+
+cardAuthorReg = re.compile(r'<div class="apphub_CardContentAuthorName[^"]*">\s*<a href="([^"]*)"[^>]*>(.*?)</a>', re.DOTALL)
+cardRatingReg = re.compile(r'<div class="apphub_CardRating[^"]*">\s*([0-9,]+)\s*</div>')
+cardTitleReg = re.compile(r'<div class="apphub_CardContentTitle[^"]*">')
+
+def ParseScreenshot(element):
+    authorURL = GetGroup(cardAuthorReg, element, 1)
+    return (HTMLToText(GetGroup(cardAuthorReg, element, 2)), authorURL,
+            ParseCount(GetGroup(cardRatingReg, element)), HTMLToText(GetDivContents(element, cardTitleReg)))
+
+#--------------------------------------
+# Guides and workshop items (both are sharedfiles/filedetails pages)
+
+itemTitleReg = re.compile(r'<div class="workshopItemTitle">')
+itemAuthorReg = re.compile(r'<div class="friendBlockContent">')
+itemStatLabelReg = re.compile(r'<div class="detailsStatLeft">([^<]*)</div>')
+itemStatValueReg = re.compile(r'<div class="detailsStatRight">([^<]*)</div>')
+itemStarsReg = re.compile(r'/([0-5])-star_large\.png')
+itemRatingCountReg = re.compile(r'<div class="numRatings">\s*([0-9,]+)')
+itemStatsTableReg = re.compile(r'<td>\s*([0-9,]+)\s*</td>\s*<td>([^<]*)</td>')
+itemDescriptionReg = re.compile(r'<div class="workshopItemDescription"[^>]*>')
+guideDescriptionReg = re.compile(r'<div class="guideTopDescription"[^>]*>')
+guideSectionReg = re.compile(r'<div class="subSectionDesc"[^>]*>')
+
+def GetGuideBody(pageHTML):
+    parts = [GetDivContents(pageHTML, guideDescriptionReg)]
+    for match in guideSectionReg.finditer(pageHTML):
+        parts.append(GetDivContentsAt(pageHTML, match))
+    parts = [HTMLToText(part) for part in parts if part is not None]
+    if len(parts) == 0:
+        return None
+    return '\n\n'.join(parts)
+
+def ParseFileDetailsPage(pageHTML):
+    # The "Posted"/"Updated" labels and their values are in two separate columns
+    labels = [label.strip().rstrip(':') for label in itemStatLabelReg.findall(pageHTML)]
+    values = [value.strip() for value in itemStatValueReg.findall(pageHTML)]
+    details = dict(zip(labels, values))
+
+    stats = {}
+    for count, label in itemStatsTableReg.findall(pageHTML):
+        stats[label.strip()] = ParseCount(count)
+
+    author = HTMLToText(GetDivContents(pageHTML, itemAuthorReg))
+    if author is not None:
+        # The status ("Offline", "In-Game"...) is on the line under the name
+        author = author.split('\n')[0]
+
+    body = HTMLToText(GetDivContents(pageHTML, itemDescriptionReg))
+    if body is None:
+        body = GetGuideBody(pageHTML)
+
+    stars = GetGroup(itemStarsReg, pageHTML)
+    return (HTMLToText(GetDivContents(pageHTML, itemTitleReg)), author, details.get('Posted'), details.get('Updated'),
+            int(stars) if stars is not None else None, ParseCount(GetGroup(itemRatingCountReg, pageHTML)),
+            stats.get('Unique Visitors'), stats.get('Current Subscribers'), stats.get('Current Favorites'), body)
+
+#--------------------------------------
+# Discussions (the first page of the topic) and their replies
+
+discussionOPReg = re.compile(r'<div class="forum_op[ "][^>]*>')
+discussionTitleReg = re.compile(r'<div class="topic">')
+discussionAuthorReg = re.compile(r'class="[^"]*forum_op_author[^"]*"[^>]*>(.*?)</a>', re.DOTALL)
+discussionTimestampReg = re.compile(r'<span class="date" data-timestamp="([0-9]+)"')
+discussionContentReg = re.compile(r'<div class="content">')
+replyAuthorReg = re.compile(r'class="[^"]*commentthread_author_link[^"]*"[^>]*>(.*?)</a>', re.DOTALL)
+replyTimestampReg = re.compile(r'class="commentthread_comment_timestamp"[^>]*data-timestamp="([0-9]+)"')
+
+def ParseDiscussionPage(pageHTML):
+    opHTML = GetDivContents(pageHTML, discussionOPReg) or pageHTML
+    return (HTMLToText(GetDivContents(opHTML, discussionTitleReg)), HTMLToText(GetGroup(discussionAuthorReg, opHTML)),
+            ParseCount(GetGroup(discussionTimestampReg, opHTML)), HTMLToText(GetDivContents(opHTML, discussionContentReg)))
+
+def ParseReply(contents):
+    return (HTMLToText(GetGroup(replyAuthorReg, contents)), ParseCount(GetGroup(replyTimestampReg, contents)),
+            GetSteamReplyText(contents))
+
+#--------------------------------------
+
+# name: (source table, key column, HTML column, blob column (or None), columns passed through, extracted table, parser)
+# The extracted table's columns are the key, the passed through columns, what the parser returns, then sourceBlob
+# (if the source has a blob column) and extractorVersion
+EXTRACT_SOURCES = {
+    'screenshots': ('Screenshots', 'id', 'htmlStuff', None, [], 'ExtractedScreenshots', ParseScreenshot),
+    'guides': ('Guides', 'id', 'pageHTML', 'pageBlob', [], 'ExtractedGuides', ParseFileDetailsPage),
+    'workshop': ('WorkshopItems', 'itemID', 'pageHTML', 'pageBlob', [], 'ExtractedWorkshopItems', ParseFileDetailsPage),
+    'discussions': ('Discussions', 'discussionID', 'pageHTML', 'pageBlob', [], 'ExtractedDiscussions', ParseDiscussionPage),
+    'replies': ('DiscussionReplies', 'commentID', 'contents', None, ['discussionID'], 'ExtractedReplies', ParseReply),
+}
+
+# Keys of the rows that haven't been extracted by this version (or whose page has changed since)
+def GetKeysToExtract(db, source, extractAll):
+    sourceTable, keyColumn, textColumn, blobColumn, passColumns, extractedTable, parser = source
+    query = 'SELECT s.%s FROM %s s' % (keyColumn, sourceTable)
+    params = ()
+    if not extractAll:
+        query += ' LEFT JOIN %s e ON e.%s = s.%s WHERE e.%s IS NULL OR e.extractorVersion < ?' % (extractedTable, keyColumn, keyColumn, keyColumn)
+        params = (EXTRACTOR_VERSION,)
+        if blobColumn is not None:
+            query += ' OR e.sourceBlob IS NOT s.%s' % blobColumn
+    return [row[0] for row in db.execute(query + ';', params)]
+
+# Each worker process keeps its own connection to each database
+workerDBs = {}
+
+def GetWorkerDB(filename):
+    if filename not in workerDBs:
+        workerDBs[filename] = OpenDatabase(filename)
+    return workerDBs[filename]
+
+# Runs in the worker processes. Returns (sourceName, rows to insert, how many rows couldn't be parsed)
+def ExtractChunk(job):
+    filename, sourceName, keys = job
+    sourceTable, keyColumn, textColumn, blobColumn, passColumns, extractedTable, parser = EXTRACT_SOURCES[sourceName]
+    db = GetWorkerDB(filename)
+
+    columns = [keyColumn, textColumn, blobColumn or 'NULL'] + passColumns
+    query = 'SELECT %s FROM %s WHERE %s IN (%s);' % (', '.join(columns), sourceTable, keyColumn, ','.join('?' * len(keys)))
+
+    rows = []
+    failedCount = 0
+    for row in db.execute(query, keys).fetchall():
+        key, text, blobHash = row[:3]
+        try:
+            parsed = parser(ReadStoredText(db, text, blobHash) or '')
+        except Exception:
+            traceback.print_exc()
+            print('Could not parse %s "%s"' % (sourceName, key), file=sys.stderr)
+            failedCount += 1
+            continue
+
+        extracted = (key,) + tuple(row[3:]) + parsed
+        if blobColumn is not None:
+            extracted += (blobHash,)
+        rows.append(extracted + (EXTRACTOR_VERSION,))
+
+    return sourceName, rows, failedCount
+
+def ExtractSource(db, filename, sourceName, mapChunks, chunkSize, extractAll):
+    source = EXTRACT_SOURCES[sourceName]
+    keys = GetKeysToExtract(db, source, extractAll)
+    if len(keys) == 0:
+        print('  %s: nothing new to extract' % sourceName)
+        return
+
+    chunks = [(filename, sourceName, keys[i:i + chunkSize]) for i in range(0, len(keys), chunkSize)]
+    doneCount = 0
+    failedCount = 0
+    startTime = time.monotonic()
+    for chunkSourceName, rows, chunkFailedCount in mapChunks(ExtractChunk, chunks):
+        if len(rows) > 0:
+            db.executemany('INSERT OR REPLACE INTO %s VALUES(%s);' % (source[5], ','.join('?' * len(rows[0]))), rows)
+            db.commit()
+        doneCount += len(rows)
+        failedCount += chunkFailedCount
+        print('  %s: %d/%d extracted' % (sourceName, doneCount, len(keys)))
+
+    elapsed = time.monotonic() - startTime
+    print('  %s: %d rows in %.1f seconds (%.0f/s), %d could not be parsed' % (sourceName, doneCount, elapsed, doneCount / max(elapsed, 0.001), failedCount))
+
+def ExtractApp(appID, mapChunks, chunkSize, extractAll):
+    filename = 'data/%s/meta.db' % appID
+    if not os.path.exists(filename):
+        print('No database at "%s"' % filename)
+        return
+
+    print('Extracting "%s"' % filename)
+    db = OpenDatabase(filename)
+    CreateExtractedTables(db)
+    tables = set(row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table';"))
+    for sourceName, source in EXTRACT_SOURCES.items():
+        if source[0] in tables:
+            ExtractSource(db, filename, sourceName, mapChunks, chunkSize, extractAll)
+    db.close()
+
+
+# The worker processes import this file too (on platforms that don't fork), so only the main one should run it
+if __name__ == '__main__':
+    appIDs, flags = ParseArgs(sys.argv[1:])
+
+    if len(appIDs) < 1:
+        print('Please provide app ids as cmd line args')
+    else:
+        workerCount = max(1, GetIntFlag(flags, 'workers', os.cpu_count() or 1))
+        chunkSize = max(1, GetIntFlag(flags, 'chunk-size', EXTRACT_CHUNK_SIZE))
+
+        if workerCount == 1:
+            for appID in appIDs:
+                ExtractApp(appID, map, chunkSize, 'all' in flags)
+        else:
+            # Started before any database is opened, so nothing is inherited across a fork
+            with multiprocessing.Pool(workerCount) as pool:
+                for appID in appIDs:
+                    ExtractApp(appID, pool.imap_unordered, chunkSize, 'all' in flags)
@@ -0,0 +1,76 @@
+# Prints a stretch of a Twitch VOD's chat from the database dl_twitch_vod_chat.py made
+# Usage: python replay_twitch_chat.py {VOD_ID} --start=1:20:00 --end=1:30:00
+#
+# Options:
+#  --start=T    Where to start, as seconds or H:MM:SS (default: the start of the VOD)
+#  --end=T      Where to stop (default: the end of the VOD)
+#  --db=FILE    The database to read (default: vod_chat.db)
+#
+# Each line is "[H:MM:SS] DisplayName: message". Only the messages in the window are read, through the
+# (vodID, offsetSec) index on ChatMessages. VODs that were downloaded before that table existed get it filled in
+# from their JSON the first time they're replayed.
+#
+# Dependencies:
+#  - Python 3
+#  - anarchivist_twitchchat.py, anarchivist_dbwriter.py, anarchivist_blobstore.py and anarchivist_args.py from this repo
+
+import os
+import sys
+
+from anarchivist_args import ParseArgs
+from anarchivist_dbwriter import OpenDatabase
+from anarchivist_twitchchat import CreateChatMessageTable, ReplayChat, HasChatMessages, BackfillChatMessages
+
+USAGE = 'Usage: python replay_twitch_chat.py {VOD_ID} --start=1:20:00 --end=1:30:00'
+
+# Returns the time in seconds, or None if it isn't seconds or H:MM:SS
+def ParseTime(text):
+    seconds = 0
+    try:
+        for part in text.split(':'):
+            seconds = seconds * 60 + float(part)
+    except ValueError:
+        return None
+    return seconds
+
+# Returns (ok, seconds), where seconds is default if the flag isn't there
+def GetTimeFlag(flags, name, default):
+    if name not in flags:
+        return (True, default)
+    # A bare --start (without "=T") comes through as True
+    seconds = ParseTime(flags[name]) if isinstance(flags[name], str) else None
+    if seconds is None:
+        print('--%s needs a time, as seconds or H:MM:SS' % name)
+        return (False, None)
+    return (True, seconds)
+
+def FormatTime(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+def ReplayVOD(db, vodID, startSec, endSec):
+    if not HasChatMessages(db, vodID):
+        print('Filling in messages for vod "%s"...' % vodID, file=sys.stderr)
+        print('   added %d' % BackfillChatMessages(db, vodID), file=sys.stderr)
+
+    for id, offsetSec, commenterID, commenterName, commenterDisplayName, body, userColor, emotes in ReplayChat(db, vodID, startSec, endSec):
+        print('[%s] %s: %s' % (FormatTime(offsetSec), commenterDisplayName or commenterName, body))
+
+
+vodIDs, flags = ParseArgs(sys.argv[1:])
+
+startOK, startSec = GetTimeFlag(flags, 'start', 0)
+endOK, endSec = GetTimeFlag(flags, 'end', None)
+
+if len(vodIDs) != 1:
+    print('Please specify one VOD id')
+    print(USAGE)
+elif not startOK or not endOK:
+    print(USAGE)
+elif not os.path.exists(flags.get('db', 'vod_chat.db')):
+    print('No such database "%s"' % flags.get('db', 'vod_chat.db'))
+else:
+    db = OpenDatabase(flags.get('db', 'vod_chat.db'))
+    CreateChatMessageTable(db)
+    ReplayVOD(db, vodIDs[0], startSec, endSec)
+    db.close()
@@ -0,0 +1,72 @@
+# Searches the text of archived tweets, Steam discussion replies and Twitch chat
+# Usage: python search_archive.py "{QUERY}" {DB_FILE1} {DB_FILE2} ...
+#
+# Options:
+#  --limit=N   How many hits to show (default 20)
+#
+# Without any database files, it searches every archive under the current directory: data/*/meta.db, */tweets.db
+# and vod_chat.db. The query is FTS5 syntax: words, "exact phrases", AND/OR/NOT, prefix* (quote the whole thing for the shell).
+#
+# Hits are ranked by bm25 across all the databases, best first, each as
+#   [source] key (where it's from)
+#       ...a snippet with the [matching] words in brackets...
+#
+# Uses the indexes from anarchivist_search.py: the scripts keep them up to date, and build_search_index.py adds them
+# to databases from before they did. Databases without any index are skipped.
+#
+# Dependencies:
+#  - Python 3
+#  - anarchivist_search.py, anarchivist_html.py, anarchivist_dbwriter.py and anarchivist_args.py from this repo
+
+import os
+import sys
+import glob
+import sqlite3
+
+from anarchivist_args import ParseArgs, GetIntFlag
+from anarchivist_dbwriter import OpenDatabase
+from anarchivist_search import Search, GetTables, SEARCHERS
+
+DEFAULT_SEARCH_LIMIT = 20
+
+def FindArchives():
+    filenames = sorted(glob.glob('data/*/meta.db')) + sorted(glob.glob('*/tweets.db'))
+    if os.path.exists('vod_chat.db'):
+        filenames.append('vod_chat.db')
+    return filenames
+
+def SearchArchives(query, filenames, limit):
+    hits = []
+    for filename in filenames:
+        if not os.path.exists(filename):
+            print('No database at "%s"' % filename, file=sys.stderr)
+            continue
+
+        db = OpenDatabase(filename)
+        tables = GetTables(db)
+        if not any(indexName in tables for indexName, searcher in SEARCHERS):
+            print('"%s" has no search index, run build_search_index.py on it' % filename, file=sys.stderr)
+        else:
+            try:
+                hits.extend((hit, filename) for hit in Search(db, query, limit))
+            except sqlite3.OperationalError as e:
+                print('Bad query "%s": %s' % (query, str(e)), file=sys.stderr)
+                db.close()
+                return []
+        db.close()
+
+    hits.sort(key=lambda entry: entry[0].score)
+    return hits[:limit]
+
+
+args, flags = ParseArgs(sys.argv[1:])
+
+if len(args) < 1:
+    print('Please provide a query (and optionally database files) as cmd line args')
+else:
+    filenames = args[1:] or FindArchives()
+    hits = SearchArchives(args[0], filenames, GetIntFlag(flags, 'limit', DEFAULT_SEARCH_LIMIT))
+    for hit, filename in hits:
+        print('[%s] %s (%s, in %s)' % (hit.source, hit.key, hit.context, filename))
+        print('    %s' % hit.snippet.replace('\n', ' '))
+    print('%d hits' % len(hits), file=sys.stderr)
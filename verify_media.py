@@ -0,0 +1,178 @@
+# Checks downloaded media against the manifest the scripts keep of it, and downloads broken files again
+# Usage: python verify_media.py {DB_FILE1} {DB_FILE2} ...
+#
+# Options:
+#  --repair      Download the files that are missing or don't match their manifest row again, from the URL in the row
+#  --quick       Only compare sizes, instead of hashing every file
+#  --workers=N   Check (and download) N files at once (default 8)
+#  --adopt       First add the media files that are on disk but have no row (downloaded before there was a manifest) to
+#                the manifest. Run this once on an archive from before the manifest, before crawling it again: the
+#                scripts only go by the manifest, so they'd download those files all over again
+#
+# Works on data/{APP_ID}/meta.db and {USERNAME}/tweets.db: every row of the MediaManifest table (see anarchivist_manifest.py)
+# is checked against the file at its path, relative to the database's directory. A file is:
+#  - missing if it isn't there
+#  - truncated if it's shorter than when it was downloaded, or the wrong size if it's longer
+#  - corrupt if it's the right size but its SHA-256 doesn't match
+# Files adopted from before the manifest existed are only as good as they were when they were adopted, so this can't tell
+# whether those were complete to begin with. They have no URL either, so --repair can't download them again.
+#
+# --adopt looks in the directories the scripts put media in (MEDIA_DIRECTORIES, under the database's directory), and
+# hashes the files that aren't in the manifest yet on the worker threads. Leftover .part files aren't adopted.
+#
+# With --repair, a file is only replaced once the new download is complete, and its row is updated with the new size and
+# hash (and the time). If a download fails, the row is left alone, so the file shows up again next time.
+#
+# The database can be checked while a script is writing to it, but don't --repair the media of a target that's being crawled.
+#
+# Dependencies:
+#  - Python 3
+#  - anarchivist_manifest.py, anarchivist_http.py, anarchivist_dbwriter.py and anarchivist_args.py from this repo
+
+import os
+import sys
+import time
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+from anarchivist_args import ParseArgs, GetIntFlag
+from anarchivist_http import GetHostPool, DownloadToFile
+from anarchivist_dbwriter import OpenDatabase
+from anarchivist_manifest import HashFile, CreateManifestTable
+
+VERIFY_WORKER_COUNT = 8
+
+# Commit the repaired rows every so often, so an interrupted repair doesn't have to start over
+REPAIR_COMMIT_INTERVAL = 100
+
+# The same for adopted rows, which are a lot cheaper to redo
+ADOPT_COMMIT_INTERVAL = 1000
+
+# Where the scripts put media, relative to the database's directory: Steam's screenshots and guide/workshop images,
+# Twitter's images and videos
+MEDIA_DIRECTORIES = ('screenshots', 'guideIMG', 'workshopIMG', 'Images', 'Videos')
+
+# Returns None if the file matches its row, otherwise what's wrong with it
+def CheckFile(filename, size, contentHash, quick):
+    try:
+        actualSize = os.path.getsize(filename)
+    except OSError:
+        return 'missing'
+    if actualSize < size:
+        return 'truncated'
+    if actualSize != size:
+        return 'wrong size'
+    if not quick and HashFile(filename)[1] != contentHash:
+        return 'corrupt'
+    return None
+
+# Returns (size, contentHash) of the new download, or None if it failed
+def RepairFile(filename, url):
+    if url is None:
+        return None
+    parts = urlparse(url)
+    urlPath = parts.path + ('?' + parts.query if parts.query else '')
+    if not DownloadToFile(GetHostPool(parts.netloc, parts.scheme == 'https'), urlPath, filename):
+        return None
+    return HashFile(filename)
+
+# Returns (path, problem, repaired), where repaired is the new (size, contentHash) if it was downloaded again
+def VerifyRow(rootDir, row, quick, repair):
+    path, url, size, contentHash = row
+    filename = os.path.join(rootDir, path)
+    problem = CheckFile(filename, size, contentHash, quick)
+    repaired = None
+    if problem is not None and repair:
+        try:
+            repaired = RepairFile(filename, url)
+        except Exception as e:
+            print('Error downloading "%s" again: "%s"' % (url, str(e)), file=sys.stderr)
+    return (path, problem, repaired)
+
+# Paths (relative to rootDir) of the files in the media directories, other than partial downloads
+def FindMediaFiles(rootDir):
+    for directory in MEDIA_DIRECTORIES:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(rootDir, directory)):
+            for name in filenames:
+                if not name.endswith('.part') and not name.endswith('.tmp'):
+                    yield os.path.relpath(os.path.join(dirpath, name), rootDir)
+
+# Adds the media files that don't have a row to the manifest, with no url or fetchedAt
+def AdoptFiles(db, rootDir, executor, rows):
+    knownPaths = set(row[0] for row in rows)
+    paths = [path for path in FindMediaFiles(rootDir) if path not in knownPaths]
+    print('Adopting %d files from before the manifest...' % len(paths))
+
+    adoptedCount = 0
+    for path, result in zip(paths, executor.map(lambda path: AdoptFile(rootDir, path), paths)):
+        if result is None:
+            continue
+        db.execute('INSERT OR IGNORE INTO MediaManifest VALUES(?,NULL,?,?,NULL);', (path, result[0], result[1]))
+        adoptedCount += 1
+        if adoptedCount % ADOPT_COMMIT_INTERVAL == 0:
+            db.commit()
+    db.commit()
+    print('Adopted %d files' % adoptedCount)
+
+# Returns (size, contentHash), or None if the file couldn't be read
+def AdoptFile(rootDir, path):
+    try:
+        return HashFile(os.path.join(rootDir, path))
+    except OSError as e:
+        print('Could not read "%s": %s' % (path, str(e)), file=sys.stderr)
+        return None
+
+def VerifyDatabase(dbFilename, executor, quick, repair, adopt):
+    db = OpenDatabase(dbFilename)
+    if adopt:
+        CreateManifestTable(db)
+    elif db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'MediaManifest';").fetchone() is None:
+        print('"%s" has no media manifest' % dbFilename)
+        db.close()
+        return
+
+    rootDir = os.path.dirname(dbFilename) or '.'
+    rows = db.execute('SELECT path, url, size, contentHash FROM MediaManifest;').fetchall()
+    # The adopted files were just hashed, so only the rows that were already there get checked
+    if adopt:
+        AdoptFiles(db, rootDir, executor, rows)
+    print('Checking %d files for "%s"...' % (len(rows), dbFilename))
+
+    problemCounts = {}
+    repairedCount = 0
+    for path, problem, repaired in executor.map(lambda row: VerifyRow(rootDir, row, quick, repair), rows):
+        if problem is None:
+            continue
+        problemCounts[problem] = problemCounts.get(problem, 0) + 1
+        if repaired is None:
+            print('%s: %s' % (problem, path))
+            continue
+
+        print('%s: %s (downloaded again)' % (problem, path))
+        db.execute('UPDATE MediaManifest SET size = ?, contentHash = ?, fetchedAt = ? WHERE path = ?;', (repaired[0], repaired[1], int(time.time()), path))
+        repairedCount += 1
+        if repairedCount % REPAIR_COMMIT_INTERVAL == 0:
+            db.commit()
+
+    db.commit()
+    db.close()
+
+    problemCount = sum(problemCounts.values())
+    summary = ', '.join('%d %s' % (count, problem) for problem, count in sorted(problemCounts.items()))
+    print('"%s": %d files ok, %d with problems%s' % (dbFilename, len(rows) - problemCount, problemCount, ' (%s)' % summary if problemCount > 0 else ''))
+    if repair:
+        print('Downloaded %d of them again' % repairedCount)
+
+
+dbFilenames, flags = ParseArgs(sys.argv[1:])
+
+if len(dbFilenames) < 1:
+    print('Please specify at least one database')
+else:
+    workerCount = max(1, GetIntFlag(flags, 'workers', VERIFY_WORKER_COUNT))
+    with ThreadPoolExecutor(workerCount) as executor:
+        for dbFilename in dbFilenames:
+            if not os.path.exists(dbFilename):
+                print('No such database "%s"' % dbFilename)
+                continue
+            VerifyDatabase(dbFilename, executor, 'quick' in flags, 'repair' in flags, 'adopt' in flags)
@@ -0,0 +1,70 @@
+# Looks up a URL in the WARC files the scripts wrote with --warc
+# Usage: python warc_lookup.py {URL} --at=20200101120000
+#        python warc_lookup.py --repair --dir=warc
+#
+# Options:
+#  --dir=DIR     Where the WARC files are (default: warc)
+#  --at=TIME     Show the capture closest to TIME (YYYYMMDDhhmmss, or any prefix of it, e.g. 2020 or 202001)
+#                instead of the latest
+#  --list        Just list every capture of the URL (time, status, type, size, file)
+#  --save=FILE   Write the capture's body to FILE instead of printing it
+#  --repair      Sort the indexes of WARC files that a run never finished (it was killed) into their .cdx files.
+#                Only while nothing is writing to the directory: it can't tell a dead run's files from a live one's
+#
+# The URL is matched the way replay tools match it (SURT form: host reversed, no "www.", query arguments sorted), so
+# "https://steamcommunity.com/app/440/homecontent/?p=2" finds the capture whatever order its query was sent in.
+# Captures are found with a binary search through each WARC file's CDX index, see anarchivist_warc.py.
+#
+# Bodies are printed as they were sent: if the server gzipped one, so is what --save writes.
+#
+# Dependencies:
+#  - Python 3
+#  - anarchivist_warc.py, anarchivist_http.py and anarchivist_args.py from this repo
+
+import os
+import sys
+
+from anarchivist_args import ParseArgs
+from anarchivist_warc import FindCaptures, FindClosestCapture, ReadCapture, FinishOpenIndexes, DEFAULT_WARC_DIRECTORY
+
+def PrintCapture(entry):
+    print('%s  %s  %-24s %9d  %s' % (entry.timestamp, entry.status, entry.mimeType, entry.length, entry.filename))
+
+
+urls, flags = ParseArgs(sys.argv[1:])
+directory = flags.get('dir', DEFAULT_WARC_DIRECTORY)
+
+if not os.path.isdir(directory):
+    print('There is no WARC directory "%s"' % directory)
+elif 'repair' in flags:
+    openCount = len([name for name in os.listdir(directory) if name.endswith('.cdx.open')])
+    FinishOpenIndexes(directory)
+    print('Finished %d indexes' % openCount)
+elif len(urls) != 1:
+    print('Please specify one URL')
+elif 'list' in flags:
+    captures = FindCaptures(directory, urls[0])
+    for entry in captures:
+        PrintCapture(entry)
+    print('%d captures' % len(captures))
+else:
+    if 'at' in flags:
+        entry = FindClosestCapture(directory, urls[0], flags['at'])
+    else:
+        captures = FindCaptures(directory, urls[0])
+        entry = captures[-1] if len(captures) > 0 else None
+
+    if entry is None:
+        print('No captures of "%s"' % urls[0])
+    else:
+        warcHeader, httpHeader, payload = ReadCapture(directory, entry)
+        PrintCapture(entry)
+        print(httpHeader.decode('iso-8859-1'))
+        print('')
+        if 'save' in flags:
+            with open(flags['save'], 'wb') as f:
+                f.write(payload)
+            print('Saved %d bytes to "%s"' % (len(payload), flags['save']))
+        else:
+            sys.stdout.buffer.write(payload)
+            sys.stdout.flush()